@@ -26,6 +26,39 @@ class BarTable(DBTable):
         'c',
     )
 
+class BazTable(DBTable):
+    table_name = 'baz'
+    memoize    = True
+    id_field   = 'id'
+    key_fields = [ 'a', 'b' ]
+    fields     = (
+        'id',
+        'a',
+        'b',
+    )
+
+class NegativeBazTable(DBTable):
+    table_name            = 'baz'
+    memoize               = True
+    memoize_negative_ttl  = 60
+    memoize_negative_size = 10
+    id_field              = 'id'
+    key_fields            = [ 'a', 'b' ]
+    fields                = (
+        'id',
+        'a',
+        'b',
+    )
+
+class ArrayTable(DBTable):
+    table_name = 'array_tbl'
+    slots      = True
+    key_fields = [ 'a' ]
+    fields     = (
+        'a',
+        'b',
+    )
+
 class DBTableTest(DBTestCase):
     setup_database = True
 
@@ -34,13 +67,25 @@ class DBTableTest(DBTestCase):
         self.db_mgr.yield_all()
 
         FooTable.conn = self.db_mgr.name('conn')
+        FooTable.conn.autocommit = False
         BarTable.conn = self.db_mgr.name('conn')
+        BazTable.conn = self.db_mgr.name('conn')
+        NegativeBazTable.conn = self.db_mgr.name('conn')
+        ArrayTable.conn = self.db_mgr.name('conn')
+        BazTable.clear_cache()
+        NegativeBazTable.clear_cache()
 
         execute(self.conn(), "DROP TABLE IF EXISTS foo")
         execute(self.conn(), "CREATE TABLE foo (a INTEGER, b INTEGER DEFAULT 1)")
 
         execute(self.conn(), "DROP TABLE IF EXISTS bar")
         execute(self.conn(), "CREATE TABLE bar (a INTEGER PRIMARY KEY, b INTEGER, c INTEGER)")
+
+        execute(self.conn(), "DROP TABLE IF EXISTS baz")
+        execute(self.conn(), "CREATE TABLE baz (id SERIAL PRIMARY KEY, a INTEGER, b TEXT, UNIQUE (a, b))")
+
+        execute(self.conn(), "DROP TABLE IF EXISTS array_tbl")
+        execute(self.conn(), "CREATE TABLE array_tbl (a INTEGER PRIMARY KEY, b INTEGER[])")
         self.conn().commit()
 
     def test_find_by(self):
@@ -53,6 +98,18 @@ class DBTableTest(DBTestCase):
             { 'a' : 1, 'b' : 3 },
         ], key=lambda x: x['b']))
 
+    def test_find_by__lists_and_operators(self):
+        FooTable.bulk_insert([ FooTable(a = x, b = x * 10) for x in range(10) ])
+        self.assertEqual(sorted(x.a for x in FooTable.find_by(a__any = [ 1, 3, 5, 100 ])), [ 1, 3, 5 ])
+        self.assertEqual(sorted(x.a for x in FooTable.find_by(a = (1, 3))), [ 1, 3 ])
+        self.assertEqual(sorted(x.a for x in FooTable.find_by(a__gte = 7)), [ 7, 8, 9 ])
+        self.assertEqual(sorted(x.a for x in FooTable.find_by(a__gt = 2, b__between = (10, 50))), [ 3, 4, 5 ])
+        self.assertEqual(list(FooTable.find_by(a__any = [])), [])
+
+    def test_find_by__stream(self):
+        FooTable.bulk_insert([ FooTable(a = 1, b = x) for x in range(5) ])
+        self.assertEqual(sorted(x.b for x in FooTable.find_by(a = 1, stream = True)), list(range(5)))
+
     def test_insert(self):
         f1 = FooTable(a = 1, b = 2).update()
         f2 = FooTable(a = 1, b = 2).update()
@@ -121,6 +178,33 @@ class DBTableTest(DBTestCase):
         )
 
 
+    def test_update__dirty_fields(self):
+        f1 = BarTable(a = 1, b = 2, c = 3).update()
+        self.assertFalse(f1.should_update())
+
+        f1.b = 2
+        self.assertFalse(f1.should_update())
+
+        f1.b = 4
+        f1.c = 5
+        f1.c = 3
+        self.assertEqual(f1._dirty, { 'b', 'c' })
+        self.assertTrue(f1.should_update())
+
+        f1.update()
+        self.assertEqual(f1._dirty, None)
+        self.assertEqual(f1.db_fields['b'], 4)
+
+    def test_update__deterministic_sql(self):
+        f1 = BarTable(a = 1, b = 2, c = 3).update()
+        f2 = BarTable(a = 2, b = 2, c = 3).update()
+
+        # The same changed fields always produce the same SQL, whatever order they were changed in
+        f1.b, f1.c = 4, 5
+        f2.c, f2.b = 6, 7
+        self.assertEqual(f1._update_sql()[0], f2._update_sql()[0])
+        self.assertIn('SET b = %(b)s, c = %(c)s', f1._update_sql()[0])
+
     def test_update__inserts_when_not_in_database(self):
         f1 = FooTable(a = 1, b = 2)
         f1.update()
@@ -203,3 +287,287 @@ class DBTableTest(DBTestCase):
 
         with self.assertRaises(PgOperationalError):
             execute(self.db_mgr.name("conn2"), "select * from bar for update nowait")
+
+    def test_slots(self):
+        obj = ArrayTable(a = 1)
+        self.assertFalse(hasattr(obj, '__dict__'))
+        with self.assertRaises(AttributeError):
+            obj.c = 1
+
+    def test_update__mutable_values(self):
+        execute(self.conn(), "INSERT INTO array_tbl (a, b) VALUES (1, ARRAY[1])")
+
+        obj = ArrayTable.find_by_key(1)
+        self.assertFalse(obj.should_update())
+
+        obj.b.append(2)
+        self.assertTrue(obj.should_update())
+        self.assertEqual(obj.db_fields['b'], [ 1 ])
+
+        obj.update()
+        self.assertEqual(obj.db_fields['b'], [ 1, 2 ])
+        self.assertFalse(obj.should_update())
+
+    def test_find_or_create_many(self):
+        objs = BarTable.find_or_create_many([ 1 ], [ 2 ], [ 1 ])
+        self.assertEqual([ x.a for x in objs ], [ 1, 2, 1 ])
+
+    def test_bulk_insert(self):
+        objs = FooTable.bulk_insert([ FooTable(a = x) for x in range(5) ], chunk_size = 2)
+        FooTable.conn.commit()
+
+        self.assertEqual([ x.to_dict() for x in objs ], [ { 'a' : x, 'b' : 1 } for x in range(5) ])
+        self.assertTrue(all(x.db_fields for x in objs))
+
+        self.assertSqlResults(self.conn(), """
+            SELECT *
+            FROM foo
+            ORDER BY a, b
+        """,
+            [ 'a', 'b', ],
+            [   0,   1, ],
+            [   1,   1, ],
+            [   2,   1, ],
+            [   3,   1, ],
+            [   4,   1, ],
+        )
+
+    def test_bulk_insert__matches_rows(self):
+        objs = [ FooTable(a = 1), FooTable(a = 1, b = 1), FooTable(a = 2, b = 3) ]
+        rows = [ { 'a' : 2, 'b' : 3 }, { 'a' : 1, 'b' : 2 }, { 'a' : 1, 'b' : 1 } ]
+        self.assertEqual([ (x, y) for x, y in FooTable._match_rows(objs, rows, None) ], [
+            (objs[2], rows[0]),
+            (objs[0], rows[1]),
+            (objs[1], rows[2]),
+        ])
+
+        # Rows are matched by key when the objects set one
+        objs = [ BarTable(a = 1, b = 2), BarTable(a = 2, b = 3) ]
+        rows = [ { 'a' : 2, 'b' : 5, 'c' : None }, { 'a' : 1, 'b' : 4, 'c' : None } ]
+        self.assertEqual(BarTable._match_rows(objs, rows, [ 'a' ]), [ (objs[1], rows[0]), (objs[0], rows[1]) ])
+
+        with self.assertRaises(DBTableError):
+            BarTable._match_rows(objs, [ { 'a' : 3, 'b' : 1, 'c' : None } ], [ 'a' ])
+
+    def test_bulk_upsert(self):
+        BarTable(a = 1, b = 2, c = 3).update()
+        objs = BarTable.bulk_upsert([
+            BarTable(a = 1, b = 4, c = 5),
+            BarTable(a = 2, b = 6, c = 7),
+        ])
+        BarTable.conn.commit()
+
+        self.assertEqual([ x.db_fields['b'] for x in objs ], [ 4, 6 ])
+        self.assertSqlResults(self.conn(), """
+            SELECT *
+            FROM bar
+            ORDER BY a
+        """,
+            [ 'a', 'b', 'c', ],
+            [   1,   4,   5, ],
+            [   2,   6,   7, ],
+        )
+
+    def test_copy_in(self):
+        count = BarTable.copy_in([
+            BarTable(a = 1, b = 2, c = 3),
+            { 'a' : 2, 'b' : 3 },
+        ])
+        BarTable.conn.commit()
+
+        self.assertEqual(count, 2)
+        self.assertSqlResults(self.conn(), """
+            SELECT *
+            FROM bar
+            ORDER BY a
+        """,
+            [ 'a', 'b', 'c',  ],
+            [   1,   2,   3,  ],
+            [   2,   3, None, ],
+        )
+
+    def test_copy_in__arrays(self):
+        count = ArrayTable.copy_in([
+            ArrayTable(a = 1, b = [ 1, 2 ]),
+            { 'a' : 2, 'b' : [] },
+            { 'a' : 3, 'b' : [ None ] },
+        ])
+        ArrayTable.conn.commit()
+
+        self.assertEqual(count, 3)
+        self.assertEqual([ x.b for x in sorted(ArrayTable.find_by(a__any = [ 1, 2, 3 ]), key = lambda x: x.a) ], [ [ 1, 2 ], [], [ None ] ])
+
+    def test_find_by_ids(self):
+        objs = BazTable.bulk_insert([ BazTable(a = x, b = str(x)) for x in range(3) ])
+        ids = [ x.id for x in objs ]
+        BazTable.clear_cache()
+
+        found = BazTable.find_by_ids([ ids[2], -1, ids[0], ids[2] ])
+        self.assertEqual([ x and x.a for x in found ], [ 2, None, 0, 2 ])
+        self.assertIs(BazTable.find_by_ids([ ids[0] ])[0], found[2])
+
+    def test_find_by_keys(self):
+        BarTable.bulk_insert([ BarTable(a = x) for x in range(3) ])
+        self.assertEqual([ x and x.a for x in BarTable.find_by_keys([ (2,), (5,), (0,) ]) ], [ 2, None, 0 ])
+
+        BazTable.bulk_insert([ BazTable(a = x, b = str(x)) for x in range(3) ])
+        BazTable.clear_cache()
+
+        found = BazTable.find_by_keys([ (1, '1'), (1, '2'), (0, '0') ])
+        self.assertEqual([ x and x.a for x in found ], [ 1, None, 0 ])
+        self.assertIs(BazTable.find_by_key(1, '1'), found[0])
+
+    def test_memoize_negative(self):
+        NegativeBazTable.id_cache.stats.clear()
+        NegativeBazTable.key_cache.stats.clear()
+
+        self.assertEqual(NegativeBazTable.find_by_key(1, '1'), None)
+        self.assertEqual(NegativeBazTable.find_by_ids([ 100, 101 ]), [ None, None ])
+
+        # Missing rows are remembered until they expire, even if another process inserts them
+        execute(self.conn(), "INSERT INTO baz (id, a, b) VALUES (100, 1, '1')")
+        self.assertEqual(NegativeBazTable.find_by_key(1, '1'), None)
+        self.assertEqual(NegativeBazTable.find_by_id(100), None)
+        self.assertEqual(NegativeBazTable.find_by_keys([ (1, '1') ]), [ None ])
+        self.assertEqual(NegativeBazTable.key_cache.stats['negative_hit'], 2)
+        self.assertEqual(NegativeBazTable.id_cache.stats['negative_hit'], 1)
+
+        # Rows created through the table replace the cached miss
+        self.assertEqual(NegativeBazTable.find_by_key(2, '2'), None)
+        obj = NegativeBazTable(a = 2, b = '2').update()
+        self.assertEqual(NegativeBazTable.find_by_key(2, '2').id, obj.id)
+
+        NegativeBazTable.clear_cache()
+        self.assertEqual(NegativeBazTable.find_by_key(1, '1').id, 100)
+
+        # The number of remembered misses is limited separately from found rows
+        for x in range(20):
+            NegativeBazTable.find_by_id(-x)
+        self.assertEqual(len(NegativeBazTable.id_cache.negative), 10)
+
+    def test_memoize_shm_names(self):
+        class ShmBazTable(DBTable):
+            table_name      = 'baz'
+            memoize         = True
+            memoize_backend = 'shm'
+            id_field        = 'id'
+            fields          = ( 'id', 'a', 'b' )
+
+        class ShmBazIdTable(DBTable):
+            table_name      = 'baz'
+            memoize         = True
+            memoize_backend = 'shm'
+            id_field        = 'id'
+            fields          = ( 'id', )
+
+        try:
+            # Classes on the same table don't share their caches
+            self.assertNotEqual(ShmBazTable.id_cache.name, ShmBazIdTable.id_cache.name)
+            self.assertIn('ShmBazTable', ShmBazTable.id_cache.name)
+        finally:
+            for cls in (ShmBazTable, ShmBazIdTable):
+                cls.id_cache.unlink()
+                cls.key_cache.unlink()
+
+    def test_session(self):
+        BarTable.bulk_insert([ BarTable(a = x, b = x) for x in range(3) ])
+        BarTable.conn.commit()
+
+        with DBSession() as session:
+            b0 = session.find_by_key(BarTable, 0)
+            self.assertIs(session.find_by_keys(BarTable, [ (0,) ])[0], b0)
+
+            b0.b = 10
+            session.add(BarTable(a = 3, b = 3))
+            session.delete(session.find_by_key(BarTable, 1))
+
+            self.assertSqlResults(self.conn(), "SELECT * FROM bar ORDER BY a",
+                [ 'a', 'b', 'c',  ],
+                [   0,   0, None, ],
+                [   1,   1, None, ],
+                [   2,   2, None, ],
+            )
+
+        self.assertEqual(b0.db_fields['b'], 10)
+        self.assertFalse(b0.should_update())
+        self.assertSqlResults(self.conn(), "SELECT * FROM bar ORDER BY a",
+            [ 'a', 'b', 'c',  ],
+            [   0,  10, None, ],
+            [   2,   2, None, ],
+            [   3,   3, None, ],
+        )
+
+    def test_session__mutable_values(self):
+        execute(self.conn(), "INSERT INTO array_tbl (a, b) VALUES (1, ARRAY[1])")
+        self.conn().commit()
+
+        with DBSession() as session:
+            obj = session.find_by_key(ArrayTable, 1)
+            values = obj.b
+            values.append(2)
+            session.flush()
+
+            values.append(3)
+            self.assertTrue(obj.should_update())
+
+        self.assertEqual(obj.db_fields['b'], [ 1, 2, 3 ])
+        self.assertSqlResults(self.conn(), "SELECT * FROM array_tbl",
+            [ 'a', 'b',         ],
+            [   1, [ 1, 2, 3 ], ],
+        )
+
+    def test_session__rolls_back_on_error(self):
+        with self.assertRaises(ValueError):
+            with DBSession() as session:
+                session.add(BarTable(a = 1, b = 1))
+                session.flush()
+                raise ValueError()
+
+        self.assertSqlResults(self.conn(), "SELECT * FROM bar ORDER BY a",
+            [ 'a', 'b', 'c',  ],
+        )
+
+    def test_session__lost_updates(self):
+        BarTable.bulk_insert([ BarTable(a = x, b = x) for x in range(2) ])
+        BarTable.conn.commit()
+
+        QueryStats.clear()
+        with self.assertRaises(DBTableError):
+            with DBSession() as session:
+                b0, b1 = session.find_by_keys(BarTable, [ (0,), (1,) ])
+                b0.b = 10
+                b1.b = 11
+                execute(self.conn(), "DELETE FROM bar WHERE a = 0")
+
+        # The batch is recorded, and the session's other update is rolled back
+        self.assertTrue(any(x.startswith('UPDATE bar') for x in QueryStats.stats))
+        self.assertSqlResults(self.conn(), "SELECT * FROM bar ORDER BY a",
+            [ 'a', 'b', 'c',  ],
+            [   1,   1, None, ],
+        )
+
+class PreparedDBTableTest(DBTableTest):
+    tables = [ FooTable, BarTable, BazTable ]
+
+    def setUp(self):
+        super(PreparedDBTableTest, self).setUp()
+        for table in self.tables:
+            table.prepare = True
+
+    def tearDown(self):
+        super(PreparedDBTableTest, self).tearDown()
+        for table in self.tables:
+            table.prepare = False
+
+    def test_statement_cache(self):
+        cache = statement_cache(BarTable.conn)
+        cache.clear(BarTable.conn)
+        cache.stats.clear()
+
+        BarTable(a = 1, b = 2).update()
+        BarTable(a = 2, b = 3).update()
+        self.assertEqual(BarTable.find_by_key(1).b, 2)
+        self.assertEqual(BarTable.find_by_key(2).b, 3)
+
+        self.assertEqual(len(cache.statements), 2)
+        self.assertEqual(cache.stats, { 'hit' : 2, 'miss' : 2 })
@@ -1,11 +1,19 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 from builtins import *
 
+import asyncio
+import collections
+import functools
+import itertools
+import os
+import shutil
 import sys
+import tempfile
 import threading
 import time
 
 import wizzat.decorators
+import wizzat.textutil
 from wizzat.decorators import *
 from wizzat.testutil   import *
 
@@ -17,6 +25,7 @@ class MemoizeTest(TestCase):
         'obj'          : (False, True),
         'max_bytes'    : (None, 100),
         'max_size'     : (None, 2),
+        'policy'       : ('lru', 'slru'),
         'until'        : (False, lambda: time.time() + .01),
     }
 
@@ -43,6 +52,336 @@ class MemoizeTest(TestCase):
         self.assertEqual(func.stats['call'], 6)
         self.assertEqual(func.stats['miss'], 4)
 
+    def test_expired_entries_removed_on_write(self):
+        expiration = [ time.time() + 0.05 ]
+        cache = create_cache_obj(until = lambda: expiration[0], max_size = 3)
+
+        cache[1] = 1
+        cache[2] = 2
+        time.sleep(0.1)
+
+        # Expired entries are reclaimed before live ones are evicted
+        expiration[0] = time.time() + 60
+        cache[3] = 3
+        cache[4] = 4
+        cache[5] = 5
+        self.assertEqual(sorted(cache.keys()), [ 3, 4, 5 ])
+
+        # Replacing keys leaves stale heap entries behind, which are compacted
+        for _ in range(100):
+            cache[5] = 5
+        self.assertLess(len(cache.expiries), 30)
+        self.assertEqual(cache.expire(time.time() + 61), 3)
+        self.assertEqual(len(cache), 0)
+
+    def test_option__sweep_interval(self):
+        @memoize(until = lambda: time.time() + 0.05, sweep_interval = 0.05)
+        def func(x):
+            return x
+
+        func(1)
+        func(2)
+        self.assertEqual(len(func.cache), 2)
+
+        # The sweeper expires entries from its own thread, so only thread safe caches are swept
+        self.assertIsInstance(func.cache, wizzat.decorators.ShardedCache)
+
+        time.sleep(0.3)
+        self.assertEqual(len(func.cache), 0)
+
+        @memoize(until = lambda: time.time() + 0.05, sweep_interval = 0.05, threads = True)
+        def threaded(x):
+            return x
+
+        threaded(1)
+        time.sleep(0.3)
+        self.assertEqual(len(threaded.cache), 0)
+
+    def test_sweeper_survives_failing_caches(self):
+        class BrokenCache(object):
+            def expire(self, now = None):
+                raise RuntimeError("OrderedDict mutated during iteration")
+
+        broken = BrokenCache()
+        cache  = create_cache_obj(until = lambda: time.time() + 0.5, threads = True)
+        cache[1] = 1
+
+        wizzat.decorators.CacheSweeper.register(broken, 0.01)
+        wizzat.decorators.CacheSweeper.register(cache, 0.01)
+        wizzat.decorators.CacheSweeper.sweep(time.time() + 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_option__stale_while_revalidate(self):
+        self.called = 0
+
+        @memoize(until = lambda: time.time() + 0.1, stale_while_revalidate = 10, threads = True)
+        def func(x):
+            self.called += 1
+            time.sleep(0.2)
+            return self.called
+
+        self.assertEqual(func(1), 1)
+        time.sleep(0.15)
+
+        # One thread refreshes the stale value, while the others get the stale value immediately
+        results = []
+        threads = [ threading.Thread(target = lambda: results.append(func(1))) for _ in range(3) ]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+
+        for thread in threads[1:]:
+            thread.join()
+        self.assertLess(time.time() - start, 0.15)
+
+        threads[0].join()
+        self.assertEqual(sorted(results), [ 1, 1, 2 ])
+        self.assertEqual(func.stats['stale'], 2)
+        self.assertEqual(func(1), 2)
+
+        # Without threads, the stale value is refreshed by the caller
+        @memoize(until = lambda: time.time() + 0.05, stale_while_revalidate = 10)
+        def unthreaded(x):
+            self.called += 1
+            return self.called
+
+        first = unthreaded(1)
+        time.sleep(0.1)
+        self.assertEqual(unthreaded(1), first + 1)
+
+    def test_option__backend(self):
+        self.called = 0
+
+        @memoize(backend = 'shm', name = 'test_option__backend', max_bytes = 64 * 1024)
+        def func(x):
+            self.called += 1
+            return [ x ] * 3
+
+        try:
+            func.cache.clear()
+            self.assertEqual(func(1), [ 1, 1, 1 ])
+            self.assertEqual(func(1), [ 1, 1, 1 ])
+            self.assertEqual(self.called, 1)
+            self.assertEqual(len(func.cache), 1)
+
+            # A forked worker sees and adds to the same cache
+            pid = os.fork()
+            if pid == 0:
+                os._exit(0 if func(1) == [ 1, 1, 1 ] and self.called == 1 and func(2) else 1)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+            self.assertEqual(func(2), [ 2, 2, 2 ])
+            self.assertEqual(self.called, 1)
+            self.assertEqual(func.stats['miss'], 1)
+        finally:
+            func.cache.unlink()
+
+        self.assertRaises(ValueError, memoize(backend = 'shm', obj = True), func)
+        self.assertRaises(ValueError, memoize(backend = 'memcache'), func)
+
+    def test_option__name(self):
+        cache1 = create_cache_obj(backend = 'shm', name = 'test_option__name', max_bytes = 64 * 1024, max_size = 16)
+        cache2 = create_cache_obj(backend = 'shm', name = 'test_option__name', max_bytes = 64 * 1024, max_size = 16)
+        try:
+            cache1.clear()
+            cache1['a'] = { 'b' : 1 }
+            self.assertEqual(cache2['a'], { 'b' : 1 })
+            self.assertEqual(cache2.get('c'), None)
+
+            # Values which don't fit in a slot aren't cached
+            cache1['a'] = 'x' * 5000
+            self.assertNotIn('a', cache2)
+
+            # Full probe windows evict the first unreferenced slot
+            for x in range(100):
+                cache1[x] = x
+            self.assertLessEqual(len(cache1), 16)
+            self.assertEqual(cache1[99], 99)
+
+            # Tables of a different size can't share a name
+            self.assertRaises(ValueError, create_cache_obj, backend = 'shm', name = 'test_option__name', max_bytes = 1024 * 1024)
+        finally:
+            cache1.unlink()
+
+        self.assertRaises(ValueError, create_cache_obj, backend = 'shm')
+
+    def test_shm_expiry(self):
+        cache = create_cache_obj(backend = 'shm', name = 'test_shm_expiry', max_bytes = 64 * 1024, until = lambda: time.time() + 0.05)
+        try:
+            cache.clear()
+            cache['a'] = 1
+            cache['b'] = 2
+            self.assertEqual(cache['a'], 1)
+
+            time.sleep(0.1)
+            self.assertRaises(KeyError, lambda: cache['a'])
+            self.assertEqual(cache.expire(), 1)
+            self.assertEqual(len(cache), 0)
+        finally:
+            cache.unlink()
+
+    def test_shm_options(self):
+        self.called = 0
+
+        @memoize(backend = 'shm', name = 'test_shm_options', max_bytes = 64 * 1024, ignore_nulls = True,
+            until = lambda: time.time() + 0.05, stale_while_revalidate = 10)
+        def func(x):
+            self.called += 1
+            return x or None
+
+        try:
+            func.cache.clear()
+            func(0)
+            self.assertEqual(len(func.cache), 0)
+
+            func(1)
+            self.assertFalse(func.cache.is_stale((func.__wrapped__, 1)))
+            time.sleep(0.1)
+
+            # The expired result is kept for stale_while_revalidate, and refreshed on the next call
+            self.assertTrue(func.cache.is_stale((func.__wrapped__, 1)))
+            self.assertEqual(func.cache.expire(), 0)
+            self.assertEqual(func(1), 1)
+            self.assertEqual(self.called, 3)
+            self.assertFalse(func.cache.is_stale((func.__wrapped__, 1)))
+        finally:
+            func.cache.unlink()
+
+        for kwargs in [ { 'policy' : 'lfu' }, { 'sizeof' : 'deep' } ]:
+            self.assertRaises(ValueError, create_cache_obj, backend = 'shm', name = 'test_shm_options', **kwargs)
+
+    def make_persist_path(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        return os.path.join(path, 'memoize.db')
+
+    def persisted_func(self, **kwargs):
+        @memoize(persist = self.persist_path, name = 'persisted_func', **kwargs)
+        def func(x):
+            self.called += 1
+            return [ x ] * 3
+
+        return func
+
+    def test_option__persist(self):
+        self.called = 0
+        self.persist_path = self.make_persist_path()
+
+        func = self.persisted_func()
+        self.assertEqual(func(1), [ 1, 1, 1 ])
+        self.assertEqual(func(1), [ 1, 1, 1 ])
+        self.assertEqual(self.called, 1)
+
+        # A restarted process reads results from disk instead of calling the function
+        for kwargs in [ {}, { 'threads' : True } ]:
+            restarted = self.persisted_func(**kwargs)
+            self.assertEqual(restarted(1), [ 1, 1, 1 ])
+            self.assertEqual(self.called, 1)
+            self.assertEqual(restarted.stats['miss'], 0)
+
+        # Unpicklable results are only cached in memory
+        unpicklable = memoize(persist = self.persist_path)(lambda x: lambda: x)
+        unpicklable(1)
+        self.assertEqual(len(unpicklable.cache), 1)
+        self.assertEqual(len(unpicklable.cache.disk), 0)
+
+        func.cache.clear()
+        self.assertEqual(len(func.cache.disk), 0)
+
+        self.assertRaises(ValueError, memoize(persist = self.persist_path, obj = True), func)
+
+    def test_persist_expiry(self):
+        self.called = 0
+        self.persist_path = self.make_persist_path()
+
+        func = self.persisted_func(until = lambda: time.time() + 0.05)
+        func(1)
+        func(2)
+
+        time.sleep(0.1)
+        restarted = self.persisted_func(until = lambda: time.time() + 0.05)
+        restarted(1)
+        self.assertEqual(self.called, 3)
+        self.assertEqual(restarted.cache.disk.expire(), 1)
+        self.assertEqual(len(restarted.cache.disk), 1)
+
+        # Values read from disk or prewarmed keep their original expiration in memory
+        func = self.persisted_func(until = lambda: time.time() + 0.2)
+        func(3)
+        time.sleep(0.1)
+        for kwargs in [ {}, { 'prewarm' : 10 } ]:
+            restarted = self.persisted_func(until = lambda: time.time() + 0.2, **kwargs)
+            restarted(3)
+        self.assertEqual(self.called, 4)
+
+        time.sleep(0.15)
+        restarted(3)
+        self.assertEqual(self.called, 5)
+
+    def test_option__persist_bytes(self):
+        self.called = 0
+        self.persist_path = self.make_persist_path()
+
+        func = self.persisted_func(persist_bytes = 1000)
+        for x in range(100):
+            func(x)
+
+        # The least recently used results are deleted
+        self.assertLessEqual(func.cache.disk.current_size, 1000)
+        self.assertIn((func.__wrapped__, 99), func.cache.disk)
+        self.assertNotIn((func.__wrapped__, 0), func.cache.disk)
+
+        # Other functions' results in the same file are not evicted for this one
+        @memoize(persist = self.persist_path, name = 'other_func')
+        def other(x):
+            return x
+
+        other(1)
+        for x in range(100, 200):
+            func(x)
+        self.assertIn((other.__wrapped__, 1), other.cache.disk)
+
+    def test_option__persist_batches_reads(self):
+        self.called = 0
+        self.persist_path = self.make_persist_path()
+
+        func = self.persisted_func()
+        func(1)
+
+        restarted = self.persisted_func()
+        restarted(1)
+        disk = restarted.cache.disk
+        self.assertEqual(len(disk.accesses), 1)
+        self.assertEqual(disk.conn.execute("SELECT hits FROM memoize").fetchone()[0], 0)
+
+        disk.flush()
+        self.assertEqual(disk.accesses, {})
+        self.assertEqual(disk.conn.execute("SELECT hits FROM memoize").fetchone()[0], 1)
+
+    def test_option__prewarm(self):
+        self.called = 0
+        self.persist_path = self.make_persist_path()
+
+        func = self.persisted_func()
+        for x in range(10):
+            func(x)
+
+        # Results read back from disk most often are loaded first
+        for _ in range(3):
+            restarted = self.persisted_func()
+            restarted(7)
+            restarted(3)
+        restarted(3)
+
+        # Reads are counted in memory until the batch fills or the process exits
+        restarted.cache.disk.close()
+
+        prewarmed = self.persisted_func(prewarm = 2)
+        self.assertEqual(sorted(key[1] for key in prewarmed.cache.memory), [ 3, 7 ])
+        self.assertEqual(prewarmed(3), [ 3, 3, 3 ])
+        self.assertEqual(self.called, 10)
+
     def test_option__disable_kw(self):
         self.called = 0
 
@@ -60,6 +399,77 @@ class MemoizeTest(TestCase):
         self.assertEqual(func.stats['call'], 4)
         self.assertEqual(func.stats['miss'], 2)
 
+    def test_keys_bind_arguments(self):
+        self.called = 0
+
+        @memoize()
+        def func(a, b = 2, *args, **kwargs):
+            self.called += 1
+            return a, b, args, kwargs
+
+        self.assertEqual(func(1), (1, 2, (), {}))
+        self.assertEqual(func(1, 2), (1, 2, (), {}))
+        self.assertEqual(func(1, b = 2), (1, 2, (), {}))
+        self.assertEqual(func(a = 1, b = 2), (1, 2, (), {}))
+        self.assertEqual(self.called, 1)
+
+        self.assertEqual(func(1, 2, 3, c = 4, d = 5), (1, 2, (3,), { 'c' : 4, 'd' : 5 }))
+        self.assertEqual(func(1, 2, 3, d = 5, c = 4), (1, 2, (3,), { 'c' : 4, 'd' : 5 }))
+        self.assertEqual(self.called, 2)
+
+        with self.assertRaises(TypeError):
+            func()
+
+    def test_keys_keyword_only_arguments(self):
+        @memoize(threads=True)
+        def func(a, *, b, c = 3):
+            return a + b + c
+
+        self.assertEqual(func(1, b = 2), 6)
+        self.assertEqual(func(a = 1, b = 2, c = 3), 6)
+        self.assertEqual(func(1, c = 1, b = 1), 3)
+        self.assertEqual(func.stats['miss'], 2)
+
+    def test_keys_unhashable_defaults(self):
+        @memoize()
+        def func(a, opts = {}, *, tags = []):
+            return a, opts, tags
+
+        self.assertEqual(func(1), (1, {}, []))
+        self.assertEqual(func(1), (1, {}, []))
+        self.assertEqual(func(a = 1), (1, {}, []))
+        self.assertEqual(func.stats['miss'], 2)
+
+    @skip_performance
+    def test_key_performance(self):
+        def plain(a, b = 2):
+            return a
+
+        cached = functools.lru_cache(maxsize = None)(plain)
+        memoized = memoize()(plain)
+        memoized_generic = memoize()(lambda *args, **kwargs: args)
+        memoized_disable_kw = memoize(disable_kw = True)(plain)
+
+        rows = []
+        for name, func in [
+                ('lru_cache', cached),
+                ('memoize', memoized),
+                ('memoize(disable_kw)', memoized_disable_kw),
+                ('memoize(*args, **kwargs)', memoized_generic),
+            ]:
+            for call_name, call in [
+                    ('f(1)',      lambda: func(1)),
+                    ('f(1, 2)',   lambda: func(1, 2)),
+                    ('f(1, b=2)', lambda: func(1, b = 2)),
+                ]:
+                call()
+                start = time.time()
+                for _ in range(200000):
+                    call()
+                rows.append([ name, call_name, int((time.time() - start) * 1e9 / 200000) ])
+
+        print(wizzat.textutil.text_table([ 'Cache', 'Call', 'ns/op' ], rows))
+
     def test_option__ignore_nulls(self):
         @memoize(ignore_nulls = True)
         def func(*args, **kwargs):
@@ -73,6 +483,52 @@ class MemoizeTest(TestCase):
         self.assertEqual(func.stats['call'], 4)
         self.assertEqual(func.stats['miss'], 3)
 
+    def test_option__negative_until(self):
+        self.called = 0
+
+        @memoize(until = lambda: time.time() + 60, negative_until = lambda: time.time() + 0.05)
+        def func(x):
+            self.called += 1
+            return x
+
+        func(1)
+        func(None)
+        func(1)
+        func(None)
+        self.assertEqual(self.called, 2)
+        self.assertEqual(func.stats['negative_hit'], 1)
+        self.assertEqual(len(func.cache.positive), 1)
+        self.assertEqual(len(func.cache.negative), 1)
+
+        # Negative results expire on their own schedule
+        time.sleep(0.1)
+        func(1)
+        func(None)
+        self.assertEqual(self.called, 3)
+
+        @memoize(threads = True, negative_until = lambda: time.time() + 60)
+        def threaded(x):
+            self.called += 1
+
+        threaded(1)
+        threaded(1)
+        self.assertEqual(threaded.stats['negative_hit'], 1)
+
+    def test_option__negative_size(self):
+        @memoize(max_size = 2, negative_size = 3)
+        def func(x):
+            return x if x > 0 else None
+
+        for x in range(-10, 10):
+            func(x)
+
+        # Negative results don't evict real results, or the other way around
+        self.assertEqual(len(func.cache.positive), 2)
+        self.assertEqual(len(func.cache.negative), 3)
+        self.assertEqual(func(9), 9)
+        self.assertEqual(func(0), None)
+        self.assertEqual(func.stats['negative_hit'], 1)
+
     def test_option__max_bytes(self):
         try:
             sys.getsizeof(5)
@@ -110,6 +566,94 @@ class MemoizeTest(TestCase):
         self.assertEqual(func.cache.current_size / payload_size, 2)
         self.assertEqual(func.stats['miss'], 4)
 
+    def test_option__sizeof(self):
+        payload = [ { 'a' : x, 'b' : str(x) } for x in range(100) ]
+
+        @memoize(max_bytes = 10**6, sizeof = 'shallow')
+        def shallow(x):
+            return payload
+
+        @memoize(max_bytes = 10**6)
+        def deep(x):
+            return payload
+
+        @memoize(max_bytes = 10**6, sizeof = 'pickle')
+        def pickled(x):
+            return payload
+
+        @memoize(max_bytes = 3, sizeof = lambda value: 1)
+        def counted(x):
+            return payload
+
+        for func in (shallow, deep, pickled, counted):
+            func(1)
+
+        self.assertEqual(shallow.cache.current_size, sys.getsizeof(payload))
+        self.assertEqual(deep.cache.current_size, wizzat.decorators.deep_sizeof(payload))
+        self.assertGreater(deep.cache.current_size, 100 * sys.getsizeof(payload[0]))
+        self.assertEqual(pickled.cache.current_size, wizzat.decorators.pickle_sizeof(payload))
+
+        for x in range(5):
+            counted(x)
+        self.assertEqual(len(counted.cache), 3)
+        self.assertEqual(counted.cache.current_size, 3)
+
+        self.assertRaises(ValueError, memoize(max_bytes = 1, sizeof = 'unknown'), counted)
+
+    def test_deep_sizeof(self):
+        class Slotted(object):
+            __slots__ = ('a', 'b')
+
+        obj = Slotted()
+        obj.a = [ 1, 2, 3 ]
+        shared = 'x' * 1000
+
+        self.assertEqual(wizzat.decorators.deep_sizeof(obj), sys.getsizeof(obj) + wizzat.decorators.deep_sizeof(obj.a))
+        self.assertEqual(wizzat.decorators.deep_sizeof([ shared, shared ]), sys.getsizeof([ shared, shared ]) + sys.getsizeof(shared))
+        self.assertEqual(wizzat.decorators.deep_sizeof(Slotted), 0)
+
+    def test_max_bytes_accounting(self):
+        size = wizzat.decorators.deep_sizeof
+        cache = create_cache_obj(max_bytes = 10**6, until = lambda: time.time() + 0.05)
+
+        cache['a'] = 'x' * 100
+        cache['a'] = 'x' * 10 # Replaced
+        cache['b'] = 'x' * 1000
+        self.assertEqual(cache.current_size, size('x' * 10) + size('x' * 1000))
+
+        del cache['b']
+        self.assertEqual(cache.current_size, size('x' * 10))
+
+        time.sleep(0.1)
+        self.assertEqual(cache.get('a'), None) # Expired
+        self.assertEqual(cache.current_size, 0)
+
+        cache['c'] = 'x' * 10
+        cache.popitem()
+        self.assertEqual(cache.current_size, 0)
+
+        cache['d'] = 'x' * 10
+        cache.clear()
+        self.assertEqual(cache.current_size, 0)
+
+    def test_max_bytes_pop(self):
+        cache = create_cache_obj(max_bytes = 1000, sizeof = lambda value: 100)
+
+        for x in range(10):
+            cache[x] = x
+            self.assertEqual(cache.pop(x), x)
+        self.assertEqual(cache.current_size, 0)
+        self.assertEqual(cache.pop(1, 'missing'), 'missing')
+        self.assertRaises(KeyError, cache.pop, 1)
+
+        # Popped bytes are credited back, so the cache still holds as much as before
+        for x in range(10):
+            cache[x] = x
+        self.assertEqual(len(cache), 10)
+        self.assertEqual(cache.popitem(), (9, 9))
+        self.assertEqual(cache.popitem(False), (0, 0))
+        self.assertEqual(cache.current_size, 800)
+
     def test_option__max_size(self):
         @memoize(max_size = 2)
         def func(*args, **kwargs):
@@ -139,6 +683,85 @@ class MemoizeTest(TestCase):
         self.assertEqual(len(func.cache), 2)
         self.assertEqual(func.stats['miss'], 4)
 
+    def test_option__policy(self):
+        @memoize(max_size = 2)
+        def lru(x):
+            return x
+
+        lru(1)
+        lru(2)
+        lru(1) # Hits refresh recency, LRU=1,2
+        lru(3) # LRU=3,1
+        lru(1)
+        self.assertEqual(lru.stats['miss'], 3)
+        self.assertEqual(sorted(lru.cache.values()), [ 1, 3 ])
+
+        @memoize(max_size = 3, policy = 'lfu')
+        def lfu(x):
+            return x
+
+        for x in [ 1, 1, 1, 2, 2, 3, 4, 5 ]:
+            lfu(x)
+        self.assertEqual(sorted(lfu.cache.values()), [ 1, 2, 5 ])
+        self.assertEqual(sorted(lfu.cache.counts.values()), [ 1, 2, 3 ])
+
+        @memoize(max_size = 5, policy = 'slru')
+        def slru(x):
+            return x
+
+        for x in [ 1, 2, 1, 2 ] + list(range(10, 20)):
+            slru(x)
+        # The scan of one-time keys only evicts from probation
+        self.assertEqual(sorted(slru.cache.values()), [ 1, 2, 17, 18, 19 ])
+
+        lfu.cache.clear()
+        self.assertEqual(len(lfu.cache), 0)
+        self.assertEqual(lfu.cache.counts, {})
+
+        self.assertRaises(ValueError, memoize(max_size = 1, policy = 'random'), lru)
+
+    def test_policy_pop(self):
+        for policy in sorted(wizzat.decorators.cache_policies):
+            cache = create_cache_obj(max_size = 2, policy = policy)
+            cache[1] = 1
+            self.assertEqual(cache.pop(1), 1)
+            cache[5] = 5
+            cache.popitem()
+
+            # Popped keys are forgotten by the policy, so they are never chosen for eviction
+            for x in range(2, 5):
+                cache[x] = x
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(sorted(cache.values()), [ 3, 4 ])
+
+    @skip_performance
+    def test_policy_performance(self):
+        import bisect, random
+
+        def zipf_keys(num_keys, skew, count, seed = 0):
+            weights = list(itertools.accumulate(1.0 / (x ** skew) for x in range(1, num_keys + 1)))
+            rand = random.Random(seed)
+            return [ bisect.bisect(weights, rand.random() * weights[-1]) for _ in range(count) ]
+
+        rows = []
+        for skew in (0.8, 1.0, 1.2):
+            keys = zipf_keys(10000, skew, 200000)
+            for policy in sorted(wizzat.decorators.cache_policies):
+                @memoize(max_size = 500, policy = policy, disable_kw = True)
+                def func(x):
+                    return x
+
+                start = time.time()
+                for key in keys:
+                    func(key)
+                duration = time.time() - start
+
+                hit_ratio = 1.0 - 1.0 * func.stats['miss'] / func.stats['call']
+                rows.append([ skew, policy, '{:.3f}'.format(hit_ratio), int(duration * 1e9 / len(keys)) ])
+                self.assertTrue(0 < hit_ratio < 1)
+
+        print(wizzat.textutil.text_table([ 'Zipf Skew', 'Policy', 'Hit Ratio', 'ns/op' ], rows))
+
     def test_option__obj(self):
         class F(object):
             @memoize(obj=True)
@@ -171,24 +794,184 @@ class MemoizeTest(TestCase):
         self.assertEqual(F.f.stats['miss'], 4)
 
     def test_option__threads(self):
+        self.called = 0
+
+        @memoize(threads=True)
+        def f(x):
+            self.called += 1
+            time.sleep(.25)
+            return x
+
+        # The same key is computed once, while different keys compute in parallel
         start = time.time()
+        threads = [ threading.Thread(target = f, args = (x % 2,)) for x in range(6) ]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
 
-        class T(threading.Thread):
-            def run(self):
-                self.f()
+        self.assertLess(time.time() - start, .45)
+        self.assertEqual(self.called, 2)
+        self.assertEqual(f.stats['call'], 6)
+        self.assertEqual(f.stats['miss'], 2)
+        self.assertEqual(len(f.cache), 2)
 
-            @memoize(threads=True)
-            def f(*args, **kwargs):
-                time.sleep(.25)
+    def test_option__threads__errors_are_retried(self):
+        self.called = 0
 
-        threads = [ T() for _ in range(3) ]
+        @memoize(threads=True)
+        def f(x):
+            self.called += 1
+            time.sleep(.1)
+            if self.called == 1:
+                raise ValueError()
+            return x
+
+        results = []
+        def run():
+            try:
+                results.append(f(1))
+            except ValueError:
+                results.append('error')
+
+        threads = [ threading.Thread(target = run) for _ in range(3) ]
         for thread in threads:
             thread.start()
 
         for thread in threads:
             thread.join()
 
-        self.assertTrue(time.time() - start > .75)
+        self.assertEqual(sorted(results, key=str), [ 1, 1, 'error' ])
+        self.assertEqual(self.called, 2)
+
+    def test_coroutine(self):
+        self.called = 0
+
+        @memoize()
+        async def f(x):
+            self.called += 1
+            await asyncio.sleep(.1)
+            return x
+
+        async def run():
+            # Concurrent awaits share a single call
+            results = await asyncio.gather(*[ f(x % 2) for x in range(6) ])
+            self.assertEqual(results, [ 0, 1, 0, 1, 0, 1 ])
+            self.assertEqual(await f(1), 1)
+
+        asyncio.run(run())
+        self.assertEqual(self.called, 2)
+        self.assertEqual(f.stats['call'], 7)
+        self.assertEqual(f.stats['miss'], 2)
+        self.assertEqual(len(f.cache), 2)
+
+    def test_coroutine__errors_are_not_cached(self):
+        self.called = 0
+
+        @memoize()
+        async def f(x):
+            self.called += 1
+            if self.called == 1:
+                raise ValueError()
+            return x
+
+        async def run():
+            with self.assertRaises(ValueError):
+                await f(1)
+            self.assertEqual(await f(1), 1)
+            self.assertEqual(await f(1), 1)
+
+        asyncio.run(run())
+        self.assertEqual(self.called, 2)
+
+    def test_coroutine__cancelled_awaiter(self):
+        self.called = 0
+
+        @memoize()
+        async def f(x):
+            self.called += 1
+            await asyncio.sleep(.1)
+            return x
+
+        async def run():
+            # Cancelling one awaiter doesn't cancel the call the others are waiting on
+            first = asyncio.ensure_future(f(1))
+            await asyncio.sleep(0)
+            second = asyncio.ensure_future(f(1))
+            await asyncio.sleep(0)
+            first.cancel()
+
+            self.assertEqual(await second, 1)
+            self.assertTrue(first.cancelled())
+            self.assertEqual(await f(1), 1)
+
+        asyncio.run(run())
+        self.assertEqual(self.called, 1)
+
+    def test_coroutine__options(self):
+        class F(object):
+            @memoize(obj=True, max_size=1, until=lambda: time.time() + .1)
+            async def f(self, x):
+                return x
+
+        async def run():
+            obj = F()
+            await obj.f(1)
+            await obj.f(1)
+            await obj.f(2)
+            await obj.f(1)
+            self.assertEqual(len(obj.__memoize_cache__), 1)
+            await asyncio.sleep(.2)
+            await obj.f(1)
+
+        asyncio.run(run())
+        self.assertEqual(F.f.stats['miss'], 4)
+
+    def test_coroutine__stale_while_revalidate(self):
+        self.called = 0
+
+        @memoize(until=lambda: time.time() + .1, stale_while_revalidate=1)
+        async def f(x):
+            self.called += 1
+            await asyncio.sleep(.05)
+            return self.called
+
+        async def run():
+            self.assertEqual(await f(1), 1)
+            await asyncio.sleep(.15)
+            # The stale value is returned while it is refreshed in the background
+            self.assertEqual(await f(1), 1)
+            await asyncio.sleep(.1)
+            self.assertEqual(await f(1), 2)
+
+        asyncio.run(run())
+        self.assertEqual(f.stats['stale'], 1)
+        self.assertEqual(f.stats['miss'], 2)
+
+    def test_option__shards(self):
+        @memoize(threads=True, shards=4, max_size=8)
+        def f(x):
+            return x
+
+        self.assertEqual(len(f.cache.shards), 4)
+        for x in range(100):
+            f(x)
+
+        self.assertEqual(len(f.cache), 8)
+        self.assertTrue(all(len(x) == 2 for x in f.cache.shards))
+
+        @memoize(threads=True, max_size=2)
+        def g(x):
+            return x
+
+        self.assertEqual(len(g.cache.shards), 2)
+
+        # The remainder goes to the first shards, so the limits add up to the total
+        cache = create_cache_obj(threads = True, shards = 4, max_size = 10, max_bytes = 1001, negative_size = 6)
+        self.assertEqual([ x.positive.max_size for x in cache.shards ], [ 3, 3, 2, 2 ])
+        self.assertEqual([ x.positive.max_bytes for x in cache.shards ], [ 251, 250, 250, 250 ])
+        self.assertEqual([ x.negative.max_size for x in cache.shards ], [ 2, 2, 1, 1 ])
 
     def test_option__disabled(self):
         @memoize(disabled = True)
@@ -258,3 +1041,132 @@ class MemoizeTest(TestCase):
 
         self.assertNotEqual(MemoizeResults.format_csv(), None)
         self.assertNotEqual(MemoizeResults.format_stats(), None)
+        self.assertIn('Negative Hits', MemoizeResults.format_csv())
+
+class BenchmarkTest(TestCase):
+    def setUp(self):
+        super(BenchmarkTest, self).setUp()
+        BenchResults.clear()
+
+    def test_self_and_inclusive_time(self):
+        @benchmark
+        def child():
+            time.sleep(0.02)
+
+        @benchmark
+        def parent():
+            child()
+            with bench_scope('parent.sleep'):
+                time.sleep(0.01)
+
+        parent()
+        parent()
+
+        self.assertEqual(child.bench_results.calls, 2)
+        self.assertEqual(parent.bench_results.calls, 2)
+        self.assertGreaterEqual(parent.bench_results.inclusive_ns, 60 * 1000000)
+        self.assertLess(parent.bench_results.self_ns, 5 * 1000000)
+        self.assertGreaterEqual(BenchResults.results['parent.sleep'].self_ns, 20 * 1000000)
+        self.assertGreaterEqual(child.bench_results.latency.percentile(0.5), 20 * 1000000)
+
+    def test_recursion(self):
+        @benchmark
+        def func(n):
+            time.sleep(0.01)
+            return func(n - 1) if n else 0
+
+        func(2)
+
+        # Inclusive time is only counted by the outermost call
+        stats = func.bench_results
+        self.assertEqual(stats.calls, 3)
+        self.assertLess(stats.inclusive_ns, 45 * 1000000)
+        self.assertLess(abs(stats.inclusive_ns - stats.self_ns), 5 * 1000000)
+
+    def test_threads(self):
+        @benchmark
+        def child():
+            pass
+
+        @benchmark
+        def parent():
+            child()
+
+        threads = [ threading.Thread(target = parent, name = 'bench-{}'.format(x)) for x in range(2) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        child()
+
+        names = collections.Counter({ BenchResults.thread_names[x] : calls for x, calls in child.bench_results.threads.items() })
+        self.assertEqual(names, { 'bench-0' : 1, 'bench-1' : 1, threading.current_thread().name : 1 })
+        self.assertEqual(sorted(len(x) for x in BenchResults.stacks()), [ 1, 1, 2 ])
+
+    def test_coroutine(self):
+        @benchmark
+        def child():
+            pass
+
+        @benchmark
+        async def parent():
+            await asyncio.sleep(0.01)
+            child()
+
+        async def run():
+            await asyncio.gather(parent(), parent())
+            child()
+
+        asyncio.run(run())
+
+        # Each task's calls are nested under the call that created it
+        self.assertEqual(parent.bench_results.calls, 2)
+        self.assertGreaterEqual(parent.bench_results.inclusive_ns, 20 * 1000000)
+        self.assertEqual(child.bench_results.calls, 3)
+        self.assertEqual(sorted(len(x) for x in BenchResults.stacks()), [ 1, 1, 2 ])
+
+    def test_clear_while_running(self):
+        @benchmark
+        def child():
+            time.sleep(0.01)
+
+        @benchmark
+        def parent():
+            child()
+            BenchResults.clear()
+            child()
+
+        parent()
+
+        # Calls which finish after clear() are still reported under their stacks
+        names = [ parent.bench_results.name, child.bench_results.name ]
+        self.assertEqual(child.bench_results.calls, 1)
+        self.assertEqual(parent.bench_results.calls, 1)
+        self.assertEqual(sorted(BenchResults.stacks()), sorted([ tuple(names[:1]), tuple(names) ]))
+        self.assertGreaterEqual(BenchResults.stacks()[tuple(names)], 10 * 1000000)
+
+    def test_formats(self):
+        @benchmark
+        def child():
+            pass
+
+        @benchmark
+        def parent():
+            child()
+
+        @benchmark
+        def never_called():
+            pass
+
+        parent()
+
+        self.assertIn('never_called', BenchResults.format_stats())
+        self.assertNotIn('never_called', BenchResults.format_stats(skip_no_calls = True))
+
+        csv = BenchResults.format_csv(skip_no_calls = True).splitlines()
+        self.assertEqual(csv[0], ','.join(BenchResults.headers))
+        self.assertEqual(len(csv), 3)
+
+        collapsed = [ line.rsplit(' ', 1)[0] for line in BenchResults.format_collapsed().splitlines() ]
+        names = [ parent.bench_results.name, child.bench_results.name ]
+        self.assertEqual(collapsed, sorted([ names[0], ';'.join(names) ]))
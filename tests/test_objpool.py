@@ -1,6 +1,9 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 from builtins import *
 
+import threading
+import time
+
 from wizzat.objpool import *
 from wizzat.testutil import *
 
@@ -119,6 +122,210 @@ class ObjPoolTest(TestCase):
         self.assertEqual(len(pool.ready), 1)
         self.assertEqual(len(pool.in_use), 0)
 
+    def test_obj_from_pool__returns_obj_on_exception(self):
+        pool = ObjPool()
+        with self.assertRaises(ValueError):
+            with pool.obj_from_pool() as obj:
+                raise ValueError()
+
+        self.assertEqual(len(pool.ready), 1)
+        self.assertEqual(len(pool.in_use), 0)
+
+    def test_blocking_new_obj(self):
+        pool = ObjPool(timeout = 1)
+        obj = pool.new_obj()
+
+        timer = threading.Timer(0.05, pool.yield_obj, [ obj ])
+        timer.start()
+
+        self.assertIs(pool.new_obj(), obj)
+        timer.join()
+
+    def test_blocking_new_obj__timeout(self):
+        pool = ObjPool(timeout = 1)
+        pool.new_obj()
+
+        start = time.time()
+        with self.assertRaises(ObjPoolExhausted):
+            pool.new_obj(timeout = 0.05)
+
+        self.assertTrue(time.time() - start >= 0.05)
+        self.assertEqual(len(pool.waiters), 0)
+
+    def test_blocking_new_obj__max_waiters(self):
+        pool = ObjPool(timeout = 1, max_waiters = 0)
+        pool.new_obj()
+
+        start = time.time()
+        with self.assertRaises(ObjPoolExhausted):
+            pool.new_obj()
+
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_blocking_new_obj__fifo(self):
+        pool = ObjPool(timeout = 5)
+        obj = pool.new_obj()
+        order = []
+
+        def waiter(name):
+            with pool.obj_from_pool():
+                order.append(name)
+
+        threads = []
+        for name in range(5):
+            threads.append(threading.Thread(target = waiter, args = (name,)))
+            threads[-1].start()
+
+            # Wait until the thread is in the queue before starting the next one
+            while len(pool.waiters) <= name:
+                time.sleep(0.001)
+
+        pool.yield_obj(obj)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(order, list(range(5)))
+
+    def test_check_func(self):
+        class F(object):
+            usable = True
+            closed = False
+
+        class Pool(ObjPool):
+            def new_func(self):
+                return F()
+
+            def check_func(self, obj):
+                return obj.usable
+
+            def close_func(self, obj):
+                obj.closed = True
+
+        pool = Pool()
+        obj1 = pool.new_obj()
+        pool.yield_obj(obj1)
+        obj1.usable = False
+
+        obj2 = pool.new_obj()
+        self.assertIsNot(obj1, obj2)
+        self.assertTrue(obj1.closed)
+
+    def test_slow_funcs_dont_hold_the_lock(self):
+        hang    = threading.Event()
+        release = threading.Event()
+
+        class Pool(ObjPool):
+            def new_func(self):
+                if hang.is_set():
+                    release.wait(5)
+                return object()
+
+            def check_func(self, obj):
+                if hang.is_set():
+                    release.wait(5)
+                return True
+
+        pool = Pool(max_objs = 3)
+        obj1 = pool.new_obj()
+        obj2 = pool.new_obj()
+        pool.yield_obj(obj1)
+        hang.set()
+
+        # One thread hangs checking obj1, and another hangs creating a new object
+        threads = [ threading.Thread(target = pool.new_obj) for _ in range(2) ]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+
+        # Other threads can still see that the pool is exhausted and return objects
+        start = time.time()
+        self.assertRaises(ObjPoolExhausted, pool.new_obj)
+        pool.yield_obj(obj2)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(pool.stats()['in_use'], 1)
+
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(pool.in_use), 2)
+        self.assertEqual(len(pool.ready), 1)
+
+    def test_put_func_failure_discards_obj(self):
+        class Pool(ObjPool):
+            def put_func(self, obj):
+                raise ValueError()
+
+        pool = Pool()
+        pool.yield_obj(pool.new_obj())
+        self.assertEqual(len(pool.ready), 0)
+        self.assertEqual(len(pool.in_use), 0)
+
+    def test_max_lifetime(self):
+        pool = ObjPool(max_lifetime = 0.05)
+        obj1 = pool.new_obj()
+        pool.yield_obj(obj1)
+        self.assertIs(pool.new_obj(), obj1)
+
+        time.sleep(0.06)
+        pool.yield_obj(obj1)
+        self.assertEqual(len(pool.ready), 0)
+        self.assertIsNot(pool.new_obj(), obj1)
+
+    def test_max_idle(self):
+        pool = ObjPool(max_idle = 0.05)
+        obj1 = pool.new_obj()
+        pool.yield_obj(obj1)
+
+        time.sleep(0.06)
+        self.assertIsNot(pool.new_obj(), obj1)
+
+    def test_reaper(self):
+        pool = ObjPool(min_objs = 1, max_objs = 2, max_idle = 0.05, reap_interval = 0.01)
+        try:
+            obj1 = pool.ready[0]
+            time.sleep(0.2)
+
+            self.assertEqual(len(pool.ready), 1)
+            self.assertIsNot(pool.ready[0], obj1)
+        finally:
+            pool.close()
+
+        self.assertEqual(len(pool.ready), 0)
+
+    def test_stats(self):
+        pool = ObjPool(max_objs = 2)
+        obj1 = pool.new_obj()
+        obj2 = pool.new_obj()
+        with self.assertRaises(ObjPoolExhausted):
+            pool.new_obj()
+        pool.yield_obj(obj1)
+        pool.discard_obj(obj2)
+
+        stats = pool.stats()
+        self.assertEqual(stats['ready'], 1)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['utilization'], 0.0)
+        self.assertEqual(stats['acquired'], 2)
+        self.assertEqual(stats['created'], 2)
+        self.assertEqual(stats['evicted'], 1)
+        self.assertEqual(stats['exhausted'], 1)
+        self.assertEqual(pool.wait_us.num_values, 2)
+        self.assertEqual(pool.hold_us.num_values, 1)
+
+    def test_find_leaks(self):
+        pool = ObjPool(leak_threshold = 0.01, leak_sample_rate = 1.0)
+        obj = pool.new_obj()
+        self.assertEqual(pool.find_leaks(), [])
+
+        time.sleep(0.02)
+        leaks = pool.find_leaks()
+        self.assertEqual(len(leaks), 1)
+        self.assertIs(leaks[0][0], obj)
+        self.assertTrue('test_find_leaks' in ''.join(leaks[0][2]))
+
+        pool.yield_obj(obj)
+        self.assertEqual(pool.find_leaks(), [])
+
     def test_yield_all(self):
         pool = ObjPool(max_objs = 2)
         obj1 = pool.new_obj()
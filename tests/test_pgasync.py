@@ -0,0 +1,258 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import psycopg2
+import sys
+import time
+from wizzat.testutil import *
+from wizzat.objpool import ObjPoolExhausted, ObjPoolOwnershipError
+
+if sys.version_info >= (3, 7):
+    import asyncio
+    from wizzat import pgasync
+
+class PgAsyncTest(TestCase):
+    db_info = {
+        'host'     : 'localhost',
+        'port'     : 5432,
+        'user'     : 'wizzat',
+        'password' : 'wizzat',
+        'database' : 'wizzatpy_testdb',
+    }
+
+    def setUp(self):
+        super(PgAsyncTest, self).setUp()
+        if sys.version_info < (3, 7):
+            self.skipTest("pgasync requires python 3.7+")
+
+    def run_async(self, coro):
+        return asyncio.run(asyncio.wait_for(coro, 10))
+
+    def test_fetch_results(self):
+        async def run():
+            conn = await pgasync.async_pg_conn(dict(self.db_info))
+            try:
+                results = await pgasync.fetch_results(conn, "SELECT 1 AS foobar UNION ALL SELECT %(x)s AS foobar", x = 2)
+                self.assertEqual([ x['foobar'] for x in results ], [ 1, 2 ])
+
+                row = await pgasync.fetch_one(conn, "SELECT %(x)s AS foobar", x = 3)
+                self.assertEqual(row['foobar'], 3)
+
+                rows = [ x[0] async for x in pgasync.iter_results(conn, "SELECT generate_series(1, 3)") ]
+                self.assertEqual(rows, [ 1, 2, 3 ])
+            finally:
+                conn.close()
+
+        self.run_async(run())
+
+    def test_execute(self):
+        async def run():
+            conn = await pgasync.async_pg_conn(dict(self.db_info))
+            try:
+                await pgasync.execute(conn, "CREATE TEMPORARY TABLE pgasync_test (a INTEGER)")
+                await pgasync.execute(conn, "INSERT INTO pgasync_test VALUES (%(a)s)", a = 5)
+                row = await pgasync.fetch_one(conn, "SELECT count(*) AS cnt FROM pgasync_test")
+                self.assertEqual(row['cnt'], 1)
+            finally:
+                conn.close()
+
+        self.run_async(run())
+
+    def test_queries_run_concurrently(self):
+        async def run():
+            pool = pgasync.AsyncConnMgr(self.db_info, max_objs = 3)
+
+            async def sleep():
+                async with pool.acquire() as conn:
+                    await pgasync.execute(conn, "SELECT pg_sleep(0.3)")
+
+            start = time.time()
+            await asyncio.gather(*[ sleep() for _ in range(3) ])
+            self.assertLess(time.time() - start, 0.8)
+            self.assertEqual(len(pool.ready), 3)
+            pool.close()
+
+        self.run_async(run())
+
+    def test_acquire_returns_conn(self):
+        async def run():
+            pool = pgasync.AsyncConnMgr(self.db_info, max_objs = 1)
+            async with pool.acquire() as conn1:
+                self.assertEqual(pool.in_use, { conn1 })
+                with self.assertRaises(ObjPoolExhausted):
+                    await pool.new_obj()
+
+            async with pool.acquire() as conn2:
+                self.assertIs(conn1, conn2)
+
+            with self.assertRaises(ObjPoolOwnershipError):
+                pool.yield_obj(conn1)
+
+            pool.close()
+
+        self.run_async(run())
+
+    def test_fill(self):
+        async def run():
+            pool = pgasync.AsyncConnMgr(self.db_info, min_objs = 2, max_objs = 2)
+            await pool.fill()
+            self.assertEqual(len(pool.ready), 2)
+            pool.close()
+            self.assertEqual(len(pool.ready), 0)
+
+        self.run_async(run())
+
+    def test_waiters_are_fifo(self):
+        async def run():
+            pool = pgasync.AsyncConnMgr(self.db_info, max_objs = 1, timeout = None)
+            order = []
+
+            async def worker(i):
+                async with pool.acquire() as conn:
+                    order.append(i)
+                    await pgasync.execute(conn, "SELECT pg_sleep(0.05)")
+
+            await asyncio.gather(*[ worker(i) for i in range(5) ])
+            self.assertEqual(order, list(range(5)))
+            self.assertEqual(len(pool.ready), 1)
+            pool.close()
+
+        self.run_async(run())
+
+    def test_timeout(self):
+        async def run():
+            pool = pgasync.AsyncConnMgr(self.db_info, max_objs = 1, timeout = 0.1)
+            conn = await pool.new_obj()
+
+            start = time.time()
+            with self.assertRaises(ObjPoolExhausted):
+                await pool.new_obj()
+            self.assertGreaterEqual(time.time() - start, 0.09)
+            self.assertEqual(len(pool.waiters), 0)
+
+            pool.yield_obj(conn)
+            self.assertIs(await pool.new_obj(), conn)
+            pool.yield_obj(conn)
+            pool.close()
+
+        self.run_async(run())
+
+    def test_max_waiters(self):
+        async def run():
+            pool = pgasync.AsyncConnMgr(self.db_info, max_objs = 1, timeout = 1, max_waiters = 1)
+            conn = await pool.new_obj()
+            waiter = asyncio.ensure_future(pool.new_obj())
+            await asyncio.sleep(0.01)
+
+            with self.assertRaises(ObjPoolExhausted):
+                await pool.new_obj()
+
+            pool.yield_obj(conn)
+            self.assertIs(await waiter, conn)
+            pool.yield_obj(conn)
+            pool.close()
+
+        self.run_async(run())
+
+    def test_cancelled_waiter_passes_conn_on(self):
+        async def run():
+            pool = pgasync.AsyncConnMgr(self.db_info, max_objs = 1, timeout = None)
+            conn = await pool.new_obj()
+            waiter1 = asyncio.ensure_future(pool.new_obj())
+            waiter2 = asyncio.ensure_future(pool.new_obj())
+            await asyncio.sleep(0.01)
+
+            # waiter1 is handed the connection but cancelled before it runs
+            pool.yield_obj(conn)
+            waiter1.cancel()
+
+            self.assertIs(await waiter2, conn)
+            self.assertTrue(waiter1.cancelled())
+            pool.yield_obj(conn)
+            pool.close()
+
+        self.run_async(run())
+
+    def test_closed_conns_are_replaced(self):
+        async def run():
+            pool = pgasync.AsyncConnMgr(self.db_info, max_objs = 1)
+            async with pool.acquire() as conn1:
+                pass
+
+            conn1.close()
+            async with pool.acquire() as conn2:
+                self.assertIsNot(conn1, conn2)
+                row = await pgasync.fetch_one(conn2, "SELECT 1 AS one")
+                self.assertEqual(row['one'], 1)
+
+            pool.close()
+
+        self.run_async(run())
+
+    def test_max_lifetime(self):
+        async def run():
+            pool = pgasync.AsyncConnMgr(self.db_info, max_objs = 1, max_lifetime = 0.05)
+            async with pool.acquire() as conn1:
+                pass
+
+            await asyncio.sleep(0.1)
+            async with pool.acquire() as conn2:
+                self.assertIsNot(conn1, conn2)
+
+            self.assertTrue(conn1.closed)
+            pool.close()
+
+        self.run_async(run())
+
+    def test_cancelled_check_discards_conn(self):
+        class Pool(pgasync.AsyncConnMgr):
+            hang = True
+
+            async def check_func(self, conn):
+                if self.hang:
+                    await pgasync.execute(conn, "SELECT pg_sleep(1)")
+                return await super(Pool, self).check_func(conn)
+
+        async def run():
+            pool = Pool(self.db_info, max_objs = 1)
+            async with pool.acquire() as conn1:
+                pass
+
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(pool.new_obj(), 0.05)
+
+            self.assertEqual(len(pool.in_use), 0)
+            self.assertTrue(conn1.closed)
+
+            pool.hang = False
+            async with pool.acquire() as conn2:
+                self.assertIsNot(conn1, conn2)
+
+            pool.close()
+
+        self.run_async(run())
+
+    def test_failed_transactions_are_rolled_back(self):
+        async def run():
+            pool = pgasync.AsyncConnMgr(self.db_info, max_objs = 1, timeout = 1)
+            async with pool.acquire() as conn1:
+                await pgasync.execute(conn1, "BEGIN")
+                with self.assertRaises(psycopg2.Error):
+                    await pgasync.execute(conn1, "SELECT 1/0")
+
+            async with pool.acquire() as conn2:
+                self.assertIs(conn1, conn2)
+                row = await pgasync.fetch_one(conn2, "SELECT 1 AS one")
+                self.assertEqual(row['one'], 1)
+
+                # An open transaction is rolled back rather than committed
+                await pgasync.execute(conn2, "BEGIN")
+                await pgasync.execute(conn2, "CREATE TEMPORARY TABLE pgasync_rollback (a INTEGER)")
+
+            async with pool.acquire() as conn3:
+                row = await pgasync.fetch_one(conn3, "SELECT to_regclass('pg_temp.pgasync_rollback') AS tbl")
+                self.assertEqual(row['tbl'], None)
+
+            pool.close()
+
+        self.run_async(run())
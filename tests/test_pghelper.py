@@ -118,10 +118,302 @@ class PgHelperTest(TestCase):
 
         self.assertEqual(clause, 'true and bar in (%(bar)s) and foo = %(foo)s and sam is null')
 
+    def test_where_clause__operators(self):
+        clause = pghelper.sql_where_from_params(
+            a__gt      = 1,
+            a__lte     = 5,
+            b          = (1, 2),
+            c__between = (1, 10),
+            d__any     = [ 1, 2 ],
+        )
+
+        self.assertEqual(clause, 'true and a > %(a__gt)s and a <= %(a__lte)s and b in %(b)s and c between %(c__between_0)s and %(c__between_1)s and d = ANY(%(d__any)s)')
+        self.assertEqual(pghelper.sql_bind_params_from_params(a__gt = 1, c__between = (1, 10)), {
+            'a__gt'        : 1,
+            'c__between_0' : 1,
+            'c__between_1' : 10,
+        })
+
+        # Only the operator suffixes are special, so other column names may contain __
+        self.assertEqual(pghelper.sql_where_from_params(a__b = 1, a__b__gt = 2, a__like = [ 1 ]), 'true and a__b = %(a__b)s and a__b > %(a__b__gt)s and a__like in (%(a__like)s)')
+
     def test_where_clause__empty_list(self):
+        self.assertEqual(pghelper.sql_where_from_params(a = 1, b = []), 'true = false')
+        self.assertEqual(pghelper.sql_where_from_params(a = 1, b = ()), 'true = false')
+        self.assertEqual(pghelper.sql_where_from_params(a = 1, b__any = []), 'true = false')
+
+    def test_where_clause__cached_by_signature(self):
+        clause1 = pghelper.sql_where_from_params(a = [ 1, 2, 3 ], b = 1)
+        clause2 = pghelper.sql_where_from_params(a = list(range(50000)), b = 2)
+        self.assertIs(clause1, clause2)
+        self.assertNotEqual(clause1, pghelper.sql_where_from_params(a = [ 1 ], b = None))
+        self.assertNotEqual(clause1, pghelper.sql_where_from_params(a__any = [ 1 ], b = 1))
+
+    def test_where_clause__array_binding(self):
+        with psycopg2.connect(**self.db_info) as conn:
+            conn.autocommit = False
+            params = { 'x__any' : list(range(0, 50000, 2)), 'x__between' : (10, 20) }
+            rows = pghelper.fetch_results(conn, """
+                SELECT x FROM generate_series(1, 100) AS x WHERE {}
+            """.format(pghelper.sql_where_from_params(**params)), **pghelper.sql_bind_params_from_params(**params))
+
+            self.assertEqual([ row['x'] for row in rows ], [ 10, 12, 14, 16, 18, 20 ])
+
+    def test_where_clause__empty_list_with_other_params(self):
         clause = pghelper.sql_where_from_params(
             foo = True,
             bar = [ ],
         )
 
         self.assertEqual(clause, 'true = false')
+
+    def test_where_clause__array_columns(self):
+        with psycopg2.connect(**self.db_info) as conn:
+            conn.autocommit = False
+            pghelper.execute(conn, "CREATE TEMPORARY TABLE where_test (a INTEGER, b INTEGER[])")
+            pghelper.execute(conn, "INSERT INTO where_test VALUES (1, ARRAY[1, 2]), (2, ARRAY[3])")
+
+            # Lists compare the whole array, as they always have
+            params = { 'b' : [ 1, 2 ] }
+            rows = pghelper.fetch_results(conn, "SELECT a FROM where_test WHERE {}".format(pghelper.sql_where_from_params(**params)), **params)
+            self.assertEqual([ row['a'] for row in rows ], [ 1 ])
+            conn.rollback()
+
+    def test_copy_from_rows(self):
+        rows = [
+            [ 1, 'tab\there',      None,  ],
+            [ 2, 'line\nbreak\\',  '',    ],
+            [ 3, '\\N',            'abc', ],
+        ]
+
+        for format in [ 'text', 'csv' ]:
+            with psycopg2.connect(**self.db_info) as conn:
+                pghelper.execute(conn, "DROP TABLE IF EXISTS copy_test")
+                pghelper.execute(conn, "CREATE TABLE copy_test (a INTEGER, b TEXT, c TEXT)")
+
+                count = pghelper.copy_from_rows(conn, 'copy_test', [ 'a', 'b', 'c' ], iter(rows),
+                    format      = format,
+                    buffer_size = 7,
+                )
+
+                self.assertEqual(count, 3)
+                self.assertEqual([ list(x) for x in pghelper.fetch_results(conn, "SELECT * FROM copy_test ORDER BY a") ], rows)
+                conn.rollback()
+
+    def test_copy_from_rows__arrays_and_bytea(self):
+        rows = [
+            [ 1, [ 1, None, 3 ], [ 'a,b', 'quote"', 'back\\slash', 'NULL', '{}' ], b'\x00\xffab',          { 'a' : [ 1 ] }, ],
+            [ 2, [],             [ 'tab\there', None ],                         bytearray(b'\n\\'),    None,           ],
+            [ 3, [ [ 1, 2 ] ],   [ '' ],                                         memoryview(b''),         {},             ],
+        ]
+
+        for format in [ 'text', 'csv' ]:
+            with psycopg2.connect(**self.db_info) as conn:
+                pghelper.execute(conn, "DROP TABLE IF EXISTS copy_test")
+                pghelper.execute(conn, "CREATE TABLE copy_test (a INTEGER, b INTEGER[], c TEXT[], d BYTEA, e JSONB)")
+
+                count = pghelper.copy_from_rows(conn, 'copy_test', [ 'a', 'b', 'c', 'd', 'e' ], iter(rows), format = format)
+                self.assertEqual(count, 3)
+
+                results = [ list(x) for x in pghelper.fetch_results(conn, "SELECT * FROM copy_test ORDER BY a") ]
+                self.assertEqual([ x[:3] + [ bytes(x[3]), x[4] ] for x in results ], [ x[:3] + [ bytes(x[3]), x[4] ] for x in rows ])
+                conn.rollback()
+
+    def test_copy_row_stream__reads_in_chunks(self):
+        fp = pghelper.CopyRowStream([ [ 1, 'a' ], [ 2, None ] ])
+        self.assertEqual(fp.read(3), '1\ta')
+        self.assertEqual(fp.read(100), '\n2\t\\N\n')
+        self.assertEqual(fp.read(100), '')
+
+    def test_iter_results__server_side(self):
+        for autocommit in [ False, True ]:
+            with psycopg2.connect(**self.db_info) as conn:
+                conn.autocommit = autocommit
+                results = pghelper.iter_results(conn, "SELECT generate_series(1, 10) AS foobar",
+                    server_side = True,
+                    itersize    = 3,
+                )
+
+                self.assertEqual([ x['foobar'] for x in results ], list(range(1, 11)))
+
+    def test_conn_mgr__replaces_closed_connections(self):
+        mgr = pghelper.ConnMgr(self.db_info, validate_interval = 0)
+        conn1 = mgr.new_obj()
+        conn1.autocommit = True
+        mgr.yield_obj(conn1)
+        self.assertFalse(conn1.autocommit)
+
+        conn1.close()
+        conn2 = mgr.new_obj()
+        self.assertIsNot(conn1, conn2)
+        self.assertEqual(pghelper.fetch_one(conn2, "SELECT 1 AS foobar")['foobar'], 1)
+        mgr.yield_obj(conn2)
+        mgr.close()
+
+    def test_execute_many(self):
+        with psycopg2.connect(**self.db_info) as conn:
+            conn.autocommit = False
+            pghelper.execute(conn, "CREATE TEMPORARY TABLE execute_many_test (a INTEGER, b TEXT)")
+            pghelper.execute_many(conn, "INSERT INTO execute_many_test VALUES (%(a)s, %(b)s)", (
+                { 'a' : x, 'b' : str(x) } for x in range(250)
+            ), page_size = 100)
+
+            pghelper.execute_many(conn, "UPDATE execute_many_test SET b = %(b)s WHERE a = %(a)s", [
+                { 'a' : 1, 'b' : 'one' },
+                { 'a' : 2, 'b' : 'two' },
+            ])
+
+            rows = pghelper.fetch_results(conn, "SELECT a, b FROM execute_many_test ORDER BY a")
+            self.assertEqual(len(rows), 250)
+            self.assertEqual([ tuple(x) for x in rows[:4] ], [ (0, '0'), (1, 'one'), (2, 'two'), (3, '3') ])
+
+    def test_execute_statements(self):
+        with psycopg2.connect(**self.db_info) as conn:
+            conn.autocommit = False
+            pghelper.execute(conn, "CREATE TEMPORARY TABLE execute_statements_test (a INTEGER, b TEXT)")
+            pghelper.execute_many(conn, "INSERT INTO execute_statements_test VALUES (%(a)s, %(b)s)", [
+                { 'a' : x, 'b' : str(x) } for x in range(5)
+            ])
+
+            counts = pghelper.execute_statements(conn, [
+                ("UPDATE execute_statements_test SET b = %(b)s WHERE a = %(a)s RETURNING *", { 'a' : 1, 'b' : '100%' }),
+                ("UPDATE execute_statements_test SET b = %(b)s WHERE a = %(a)s RETURNING *", { 'a' : 9, 'b' : 'x' }),
+                ("DELETE FROM execute_statements_test WHERE a >= %(a)s RETURNING *", { 'a' : 3 }),
+            ], page_size = 2)
+
+            self.assertEqual(counts, [ 1, 0, 2 ])
+            rows = pghelper.fetch_results(conn, "SELECT a, b FROM execute_statements_test ORDER BY a")
+            self.assertEqual([ tuple(x) for x in rows ], [ (0, '0'), (1, '100%'), (2, '2') ])
+
+    def test_execute_values(self):
+        with psycopg2.connect(**self.db_info) as conn:
+            conn.autocommit = False
+            pghelper.execute(conn, "CREATE TEMPORARY TABLE execute_values_test (a INTEGER, b TEXT)")
+            rows = pghelper.execute_values(conn, "INSERT INTO execute_values_test VALUES %s RETURNING a",
+                [ (x, "it's {}%".format(x)) for x in range(250) ],
+                page_size = 100,
+                fetch     = True,
+            )
+            self.assertEqual([ x['a'] for x in rows ], list(range(250)))
+
+            pghelper.execute_values(conn, """
+                UPDATE execute_values_test SET b = data.b
+                FROM (VALUES %s) AS data (a, b)
+                WHERE execute_values_test.a = data.a
+            """, [ (1, 'one'), (2, 'two') ], template = '(%s::INTEGER, %s)')
+
+            rows = pghelper.fetch_results(conn, "SELECT a, b FROM execute_values_test ORDER BY a")
+            self.assertEqual([ tuple(x) for x in rows[:4] ], [ (0, "it's 0%"), (1, 'one'), (2, 'two'), (3, "it's 3%") ])
+
+            # %% escapes before and after the placeholder are unescaped like any other statement
+            rows = pghelper.execute_values(conn, """
+                SELECT data.a FROM (VALUES %s) AS data (a, b)
+                WHERE data.b LIKE '%%s' AND '100%%' LIKE '%%%%'
+            """, [ (1, 'xs'), (2, 'y') ], fetch = True)
+            self.assertEqual([ x['a'] for x in rows ], [ 1 ])
+
+            for sql in [ "SELECT 1", "SELECT '%%s'", "INSERT INTO execute_values_test VALUES %s, %s" ]:
+                self.assertRaises(ValueError, pghelper.execute_values, conn, sql, [ (1, 'a') ])
+
+    def test_batch_logging_is_sampled(self):
+        logged = []
+        def log_func(cur, sql, bind_params):
+            logged.append(cur.mogrify(sql, bind_params))
+
+        pghelper.set_sql_log_func(log_func)
+        try:
+            with psycopg2.connect(**self.db_info) as conn:
+                conn.autocommit = False
+                pghelper.execute(conn, "CREATE TEMPORARY TABLE batch_log_test (a INTEGER)")
+                pghelper.execute_many(conn, "INSERT INTO batch_log_test VALUES (%(a)s)", [ { 'a' : x } for x in range(25) ], page_size = 10)
+                pghelper.execute_values(conn, "INSERT INTO batch_log_test VALUES %s", [ (x,) for x in range(25) ], page_size = 10)
+        finally:
+            pghelper.set_sql_log_func(None)
+
+        self.assertEqual(logged, [
+            b"CREATE TEMPORARY TABLE batch_log_test (a INTEGER)",
+            b"INSERT INTO batch_log_test VALUES (0)",
+            b"INSERT INTO batch_log_test VALUES (10)",
+            b"INSERT INTO batch_log_test VALUES (20)",
+            b"INSERT INTO batch_log_test VALUES (0)",
+            b"INSERT INTO batch_log_test VALUES (10)",
+            b"INSERT INTO batch_log_test VALUES (20)",
+        ])
+
+    def test_query_stats(self):
+        pghelper.QueryStats.clear()
+        with psycopg2.connect(**self.db_info) as conn:
+            conn.autocommit = False
+            for x in range(3):
+                pghelper.fetch_results(conn, """
+                    SELECT generate_series(1, %(x)s)
+                """, x = x + 1)
+
+            rows = [ x for x in pghelper.iter_results(conn, "SELECT generate_series(1, 5)", server_side = True) ]
+            with self.assertRaises(psycopg2.ProgrammingError):
+                pghelper.execute(conn, "SELECT * FROM no_such_table")
+
+        stats = pghelper.QueryStats.stats
+        self.assertEqual(stats['SELECT generate_series(1, %(x)s)']['calls'], 3)
+        self.assertEqual(stats['SELECT generate_series(1, %(x)s)']['rows'], 6)
+        self.assertEqual(stats['SELECT generate_series(1, %(x)s)']['latency_us'].num_values, 3)
+        self.assertEqual(stats['SELECT generate_series(1, 5)']['rows'], 5)
+        self.assertEqual(stats['SELECT * FROM no_such_table']['errors'], 1)
+
+        table = pghelper.QueryStats.format_stats()
+        self.assertTrue(table.startswith("Query Stats By Shape"))
+        self.assertIn("SELECT generate_series(1, %(x)s)", table)
+
+    def test_query_stats__early_exit(self):
+        pghelper.QueryStats.clear()
+        with psycopg2.connect(**self.db_info) as conn:
+            for row in pghelper.iter_results(conn, "SELECT generate_series(1, 10)"):
+                break
+
+            results = pghelper.iter_results(conn, "SELECT generate_series(1, 20)", server_side = True)
+            next(results)
+            results.close()
+
+        # Stopping before the last row isn't counted as an error
+        stats = pghelper.QueryStats.stats
+        self.assertEqual([ stats['SELECT generate_series(1, 10)'][x] for x in [ 'calls', 'rows', 'errors' ] ], [ 1, 1, 0 ])
+        self.assertEqual([ stats['SELECT generate_series(1, 20)'][x] for x in [ 'calls', 'rows', 'errors' ] ], [ 1, 1, 0 ])
+
+    def test_query_stats__prepared(self):
+        pghelper.QueryStats.clear()
+        with psycopg2.connect(**self.db_info) as conn1, psycopg2.connect(**self.db_info) as conn2:
+            sql1 = "SELECT %(a)s::int + 1"
+            sql2 = "SELECT pg_sleep(%(a)s)"
+            self.assertEqual(pghelper.prepare(conn1, sql1, a = 1), pghelper.prepare(conn2, sql2, a = 0))
+
+            pghelper.fetch_results(conn1, pghelper.prepare(conn1, sql1, a = 1), a = 1)
+            pghelper.fetch_results(conn2, pghelper.prepare(conn2, sql2, a = 0), a = 0)
+
+        stats = pghelper.QueryStats.stats
+        self.assertEqual(sorted(x for x in stats if 'EXECUTE' in x), [])
+        self.assertEqual(stats[sql1]['calls'], 1)
+        self.assertEqual(stats[sql2]['calls'], 1)
+
+    def test_query_shape(self):
+        self.assertEqual(pghelper.QueryStats.shape("""
+            INSERT INTO foo (a, b)
+            VALUES (%(a_0)s, %(b_0)s),
+                   (%(a_1)s, DEFAULT),
+                   (%(a_2)s, %(b_2)s)
+        """), "INSERT INTO foo (a, b) VALUES (%(a_N)s, %(b_N)s), ...")
+
+    def test_slow_query_log(self):
+        logged = []
+        def log_func(cur, sql, bind_params, elapsed, rows):
+            logged.append((cur.mogrify(sql, bind_params), rows))
+
+        pghelper.set_slow_query_threshold(0.05, log_func)
+        try:
+            with psycopg2.connect(**self.db_info) as conn:
+                conn.autocommit = False
+                pghelper.fetch_results(conn, "SELECT 1")
+                pghelper.fetch_results(conn, "SELECT pg_sleep(%(x)s)", x = 0.1)
+        finally:
+            pghelper.set_slow_query_threshold(None)
+
+        self.assertEqual(logged, [ (b"SELECT pg_sleep(0.1)", 1) ])
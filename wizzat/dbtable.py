@@ -2,24 +2,36 @@ from __future__ import (absolute_import, division, print_function, unicode_liter
 from builtins import *
 from future.utils import with_metaclass
 
+import collections
 import copy
+import itertools
+import time
 import types
 import wizzat.decorators
 from wizzat.pghelper import *
-from wizzat.util import set_defaults
+from wizzat.util import chunks, set_defaults
 
 __all__ = [
+    'DBSession',
     'DBTable',
     'DBTableError',
     'DBTableConfigError',
     'DBTableImmutableFieldError',
 ]
 
+# Distinguishes ids and keys which aren't cached from those cached as missing
+_missing = object()
+
 class DBTableError(Exception): pass
 class DBTableConfigError(DBTableError): pass
 class DBTableImmutableFieldError(DBTableError): pass
 
 class DBTableMeta(type):
+    def __new__(mcs, name, bases, dct):
+        if dct.get('slots'):
+            dct.setdefault('__slots__', ())
+        return super(DBTableMeta, mcs).__new__(mcs, name, bases, dct)
+
     def __init__(cls, name, bases, dct):
         super(DBTableMeta, cls).__init__(name, bases, dct)
         if 'table_name' not in dct or not isinstance(dct['table_name'], str):
@@ -51,15 +63,19 @@ class DBTableMeta(type):
                 raise DBTableConfigError('key field {} not in fields'.format(field))
 
         if dct.get('memoize'):
-            cls.id_cache = wizzat.decorators.create_cache_obj(
-                max_size  = dct.get('memoize_size', 0),
-                max_bytes = dct.get('memoize_bytes', 0),
+            negative_ttl = dct.get('memoize_negative_ttl')
+            cache_kwargs = dict(
+                max_size       = dct.get('memoize_size', 0),
+                max_bytes      = dct.get('memoize_bytes', 0),
+                backend        = dct.get('memoize_backend', 'local'),
+                negative_until = (lambda: time.time() + negative_ttl) if negative_ttl else None,
+                negative_size  = dct.get('memoize_negative_size', 0),
             )
 
-            cls.key_cache = wizzat.decorators.create_cache_obj(
-                max_size  = dct.get('memoize_size', 0),
-                max_bytes = dct.get('memoize_bytes', 0),
-            )
+            # Classes on the same table may hold different fields, so a shared cache is named for the class
+            cache_name    = wizzat.decorators.SharedMemoryCache.func_name(cls)
+            cls.id_cache  = wizzat.decorators.create_cache_obj(name = '{}_id_cache'.format(cache_name), **cache_kwargs)
+            cls.key_cache = wizzat.decorators.create_cache_obj(name = '{}_key_cache'.format(cache_name), **cache_kwargs)
 
         cls._conn = None
         cls.default_funcs = {}
@@ -69,6 +85,26 @@ class DBTableMeta(type):
             if func_name in dct:
                 cls.default_funcs[field] = dct[func_name]
 
+            def getter(self, field=field):
+                value = self._data[field]
+
+                # Mutable values are shared with db_fields until they are read, and may be changed in place after
+                if type(value) in (dict, list) and value is self.db_fields.get(field):
+                    value = self._data[field] = copy.deepcopy(value)
+                    self.mark_dirty(field)
+
+                return value
+
+            def setter(self, new_value, field=field):
+                if new_value != self._data.get(field):
+                    self.mark_dirty(field)
+                self._data[field] = new_value
+
+            setattr(cls, field, property(
+                getter,
+                setter,
+            ))
+
 
 class DBTable(with_metaclass(DBTableMeta)):
     """
@@ -87,45 +123,104 @@ class DBTable(with_metaclass(DBTableMeta)):
     memoize_bytes:      int, maximum size objects to cache from the database (LRU ejection).
                         Note that there are two caches, and while references are shared the
                         cache size here is not absolute.
+    memoize_backend:    string, 'local' or 'shm' to share the caches between processes on the host
+                        (see memoize).  Cached objects are copies rather than shared references.
+    memoize_negative_ttl:  float, seconds to remember that an id or key does not exist, so repeated
+                        lookups of missing rows don't query the database.  Rows inserted by other
+                        processes are not found until it expires.
+    memoize_negative_size: int, maximum number of missing ids and keys to remember (LRU ejection)
     default_{field}:    func, define functions for default behaviors.  These functions are executed
                         in order of definition in the fields array.
+    slots:              bool, give objects __slots__ instead of a __dict__.  This saves memory when
+                        loading many rows, but objects cannot have attributes other than fields.
+    prepare:            bool, PREPAREs the generated SQL once per connection and EXECUTEs it afterwards.
+                        See pghelper.prepare.
 
     """
+    __slots__     = ( 'db_fields', '_data', '_dirty' )
     memoize       = False
+    memoize_negative_ttl  = None
+    memoize_negative_size = 0
+    prepare       = False
+    slots         = False
     table_name    = ''
     id_field      = ''
     key_fields    = []
     fields        = []
 
     def __init__(self, _is_in_db = False, **kwargs):
-        self.db_fields = kwargs if _is_in_db else {}
-
-        for field in self.fields:
-            if field in kwargs:
-                field_value = kwargs[field]
-            elif field in self.default_funcs:
-                field_value = self.default_funcs[field](self)
-            else:
-                field_value = None
-
-            setattr(self, field, copy.deepcopy(field_value))
+        if _is_in_db:
+            self.load_row(kwargs)
+        else:
+            self.db_fields = {}
+            self._data = {}
+            self._dirty = None
+
+            for field in self.fields:
+                if field in kwargs:
+                    self._data[field] = kwargs[field]
+                elif field in self.default_funcs:
+                    self._data[field] = self.default_funcs[field](self)
+                else:
+                    self._data[field] = None
 
         self.on_init()
         self.cache_obj(self)
 
+    def load_row(self, row):
+        """
+        Sets the object's fields and db_fields from a database row.
+        Values are shared with db_fields rather than copied, and mutable values are copied when they are first read.
+        """
+        self.db_fields = dict(row)
+        self._data = dict(self.db_fields)
+        self._dirty = None
+
+    def mark_dirty(self, field):
+        """
+        Marks a field as possibly changed since it was loaded.  Only dirty fields are considered by update().
+        """
+        if self._dirty is None:
+            self._dirty = set()
+        self._dirty.add(field)
+
     def on_init(self):
         pass
 
     @classmethod
-    def check_key_cache(cls, key_fields):
+    def prepared_sql(cls, sql, bind_params):
+        if cls.prepare:
+            return prepare(cls.conn, sql, **bind_params)
+        return sql
+
+    @classmethod
+    def check_key_cache(cls, key_fields, default = None):
         if cls.memoize:
             cache_key = tuple(key_fields)
-            return cls.key_cache.get(cache_key, None)
+            return cls.key_cache.get(cache_key, default)
+        return default
 
     @classmethod
-    def check_id_cache(cls, id):
+    def check_id_cache(cls, id, default = None):
         if cls.memoize:
-            return cls.id_cache.get(id, None)
+            return cls.id_cache.get(id, default)
+        return default
+
+    @classmethod
+    def cache_missing_id(cls, id):
+        """
+        Remembers that an id does not exist, when negative caching is configured.
+        """
+        if cls.memoize and (cls.memoize_negative_ttl or cls.memoize_negative_size):
+            cls.id_cache[id] = None
+
+    @classmethod
+    def cache_missing_key(cls, key_fields):
+        """
+        Remembers that a key does not exist, when negative caching is configured.
+        """
+        if cls.memoize and (cls.memoize_negative_ttl or cls.memoize_negative_size):
+            cls.key_cache[tuple(key_fields)] = None
 
     @classmethod
     def cache_obj(cls, obj):
@@ -146,6 +241,9 @@ class DBTable(with_metaclass(DBTableMeta)):
 
     @classmethod
     def uncache_obj(cls, obj):
+        if not cls.memoize:
+            return
+
         if cls.id_field:
             cache_key = getattr(obj, cls.id_field)
             cls.id_cache.pop(cache_key, None)
@@ -156,19 +254,92 @@ class DBTable(with_metaclass(DBTableMeta)):
 
     @classmethod
     def find_by_id(cls, id):
-        obj = cls.check_id_cache(id)
-        if obj:
+        obj = cls.check_id_cache(id, _missing)
+        if obj is not _missing:
             return obj
 
-        return cls.find_one(**{ cls.id_field : id })
+        obj = cls.find_one(**{ cls.id_field : id })
+        if obj is None:
+            cls.cache_missing_id(id)
+        return obj
 
     @classmethod
     def find_by_key(cls, *keys):
-        obj = cls.check_key_cache(keys)
-        if obj:
+        obj = cls.check_key_cache(keys, _missing)
+        if obj is not _missing:
             return obj
 
-        return cls.find_one(**{ field : value for field,value in zip(cls.key_fields, keys) })
+        obj = cls.find_one(**{ field : value for field,value in zip(cls.key_fields, keys) })
+        if obj is None:
+            cls.cache_missing_key(keys)
+        return obj
+
+    @classmethod
+    def find_by_ids(cls, ids, chunk_size = 1000):
+        """
+        Returns the objects for many ids in input order, with None for ids which do not exist.
+        Cached objects are used where possible and the rest are fetched in chunked queries.
+        """
+        ids = list(ids)
+        found = { id : cls.check_id_cache(id, _missing) for id in ids }
+        misses = [ id for id, obj in found.items() if obj is _missing ]
+
+        for chunk in chunks(misses, chunk_size):
+            sql = """
+                SELECT *
+                FROM {table_name}
+                WHERE {id_field} = ANY(%(ids)s)
+            """.format(
+                table_name = cls.table_name,
+                id_field   = cls.id_field,
+            )
+
+            for obj in cls.find_by_sql(cls.prepared_sql(sql, { 'ids' : chunk }), ids = chunk):
+                found[getattr(obj, cls.id_field)] = obj
+
+        for id in misses:
+            if found[id] is _missing:
+                found[id] = None
+                cls.cache_missing_id(id)
+
+        return [ found[id] for id in ids ]
+
+    @classmethod
+    def find_by_keys(cls, keys, chunk_size = 1000):
+        """
+        Returns the objects for many key tuples in input order, with None for keys which do not exist.
+        Cached objects are used where possible and the rest are fetched in chunked queries.
+        """
+        keys = [ tuple(key) for key in keys ]
+        found = { key : cls.check_key_cache(key, _missing) for key in keys }
+        misses = [ key for key, obj in found.items() if obj is _missing ]
+
+        for chunk in chunks(misses, chunk_size):
+            if len(cls.key_fields) == 1:
+                filter_clause = '{} = ANY(%(keys)s)'.format(cls.key_fields[0])
+                bind_keys = [ key[0] for key in chunk ]
+            else:
+                filter_clause = '({}) IN %(keys)s'.format(', '.join(cls.key_fields))
+                bind_keys = tuple(chunk)
+
+            sql = """
+                SELECT *
+                FROM {table_name}
+                WHERE {filter_clause}
+            """.format(
+                table_name    = cls.table_name,
+                filter_clause = filter_clause,
+            )
+
+            for obj in cls.find_by_sql(cls.prepared_sql(sql, { 'keys' : bind_keys }), keys = bind_keys):
+                found[tuple(getattr(obj, field) for field in cls.key_fields)] = obj
+
+        for key in misses:
+            if found[key] is _missing:
+                found[key] = None
+                cls.cache_missing_key(key)
+
+        return [ found[key] for key in keys ]
 
     @classmethod
     def find_one(cls, **kwargs):
@@ -189,14 +360,154 @@ class DBTable(with_metaclass(DBTableMeta)):
 
     @classmethod
     def find_or_create_many(cls, *rows):
+        return [ cls.find_or_create(*row) for row in rows ]
+
+    @classmethod
+    def bulk_insert(cls, objs, chunk_size = 1000):
+        """
+        Inserts objects with one multi-row INSERT per chunk_size objects, and returns them.
+        None values are written as DEFAULT, matching update() for new objects.
+        """
+        return cls._bulk_insert(objs, chunk_size, None)
+
+    @classmethod
+    def bulk_upsert(cls, objs, conflict_fields = None, chunk_size = 1000):
+        """
+        Inserts objects with one INSERT ... ON CONFLICT DO UPDATE per chunk_size objects, and returns them.
+        conflict_fields defaults to key_fields and must match a unique index.  Rows that already exist
+        have every field except conflict_fields and id_field overwritten.  A chunk may not contain the
+        same conflict key twice.
+        """
+        conflict_fields = conflict_fields or cls.key_fields
+        if not conflict_fields:
+            raise DBTableConfigError("bulk_upsert requires conflict_fields or key_fields")
+
+        return cls._bulk_insert(objs, chunk_size, conflict_fields)
+
+    @classmethod
+    def copy_in(cls, rows, columns = None, format = 'text', buffer_size = 65536):
+        """
+        Streams objects or dicts into the table with COPY, and returns the number of rows copied.
+        This is the fastest way to load large amounts of data, but it does not run the insert hooks,
+        fill db_fields, or cache objects.  None values become NULL: restrict columns to let the
+        database fill in defaults.
+        """
+        columns = columns or cls.fields
+
+        def encode(row):
+            if isinstance(row, DBTable):
+                return [ getattr(row, field) for field in columns ]
+            else:
+                return [ row.get(field) for field in columns ]
+
+        return copy_from_rows(cls.conn, cls.table_name, columns, (encode(row) for row in rows),
+            format      = format,
+            buffer_size = buffer_size,
+        )
+
+    @classmethod
+    def _bulk_insert(cls, objs, chunk_size, conflict_fields):
+        objs = list(objs)
+        for chunk in chunks(objs, chunk_size):
+            for obj in chunk:
+                obj.on_insert()
+
+            sql, bind_params = cls._bulk_insert_sql(chunk, conflict_fields)
+            rows = fetch_results(cls.conn, sql, **bind_params)
+            assert len(rows) == len(chunk)
+
+            for obj, row in cls._match_rows(chunk, rows, conflict_fields):
+                obj.load_row(row)
+                obj.after_insert()
+                cls.cache_obj(obj)
+
+        return objs
+
+    @classmethod
+    def _match_fields(cls, obj, conflict_fields):
+        for fields in (conflict_fields, cls.key_fields, [ cls.id_field ] if cls.id_field else None):
+            if fields and all(getattr(obj, x) is not None for x in fields):
+                return tuple(fields)
+
+        return tuple(x for x in cls.fields if getattr(obj, x) is not None)
+
+    @classmethod
+    def _match_rows(cls, objs, rows, conflict_fields):
+        """
+        Pairs objects with their RETURNING rows, which Postgres does not guarantee to be in input order.
+        Rows are matched by the conflict fields, key fields or id field when an object sets them, and
+        otherwise by every field it sets.  Objects which set the same values are interchangeable.
+        """
+        by_values = collections.defaultdict(collections.deque)
+        field_sets = []
+        for obj in objs:
+            fields = cls._match_fields(obj, conflict_fields)
+            if fields not in field_sets:
+                field_sets.append(fields)
+            by_values[fields, tuple(getattr(obj, x) for x in fields)].append(obj)
+
+        # Try larger field sets first, so an object which set fewer fields doesn't take a more specific match
+        field_sets.sort(key = len, reverse = True)
+
+        pairs = []
         for row in rows:
-            return cls.find_or_create(*row)
+            for fields in field_sets:
+                matches = by_values.get((fields, tuple(row[x] for x in fields)))
+                if matches:
+                    pairs.append((matches.popleft(), row))
+                    break
+            else:
+                raise DBTableError("Unable to match a returned row to an inserted {}: {!r}".format(cls.__name__, dict(row)))
+
+        return pairs
 
     @classmethod
-    def find_by(cls, for_update = False, nowait = False, **kwargs):
+    def _bulk_insert_sql(cls, objs, conflict_fields):
+        bind_params = {}
+        values = []
+        for idx, obj in enumerate(objs):
+            row = []
+            for field in cls.fields:
+                value = getattr(obj, field)
+                if value is None:
+                    row.append('DEFAULT')
+                else:
+                    bind_name = '{}_{}'.format(field, idx)
+                    bind_params[bind_name] = value
+                    row.append('%({})s'.format(bind_name))
+            values.append('({})'.format(', '.join(row)))
+
+        if conflict_fields:
+            update_fields = [ x for x in cls.fields if x not in conflict_fields and x != cls.id_field ]
+
+            # DO NOTHING would not return existing rows, so always update at least one field
+            update_fields = update_fields or conflict_fields[:1]
+            on_conflict = "ON CONFLICT ({conflict_fields}) DO UPDATE SET {field_equality}".format(
+                conflict_fields = ', '.join(conflict_fields),
+                field_equality  = ', '.join([ '{0} = EXCLUDED.{0}'.format(x) for x in update_fields ]),
+            )
+        else:
+            on_conflict = ''
+
+        sql = """
+            INSERT INTO {table_name} ({fields})
+            VALUES {values}
+            {on_conflict}
+            RETURNING *
+        """.format(
+            table_name  = cls.table_name,
+            fields      = ', '.join(cls.fields),
+            values      = ',\n'.join(values),
+            on_conflict = on_conflict,
+        )
+
+        return sql, bind_params
+
+    @classmethod
+    def find_by(cls, for_update = False, nowait = False, stream = False, **kwargs):
         """
-        Returns rows which match all key/value pairs
-        Additionally, accepts for_update = True/False, nowait = True/False
+        Returns rows which match all key/value pairs (see sql_where_from_params for lists and operators)
+        Additionally, accepts for_update = True/False, nowait = True/False, stream = True/False
         """
         for_update = 'for update' if for_update else ''
         nowait = 'nowait' if nowait else ''
@@ -213,11 +524,19 @@ class DBTable(with_metaclass(DBTableMeta)):
             nowait = nowait,
         )
 
-        return cls.find_by_sql(sql, **kwargs)
+        bind_params = sql_bind_params_from_params(**kwargs)
+        if not stream:
+            sql = cls.prepared_sql(sql, bind_params)
+
+        return cls.find_by_sql(sql, stream = stream, **bind_params)
 
     @classmethod
-    def find_by_sql(cls, sql, **bind_params):
-        for row in iter_results(cls.conn, sql, **bind_params):
+    def find_by_sql(cls, sql, stream = False, **bind_params):
+        """
+        Yields objects for the rows returned by sql.
+        stream = True fetches rows through a server side cursor, for scans too large to hold in memory.
+        """
+        for row in iter_results(cls.conn, sql, server_side = stream, **bind_params):
             yield cls(_is_in_db = True, **row)
 
     def rowlock(self, nowait = False):
@@ -247,13 +566,17 @@ class DBTable(with_metaclass(DBTableMeta)):
             nowait        = nowait
         )
 
-        execute(self.conn, sql, **bind_params)
+        execute(self.conn, self.prepared_sql(sql, bind_params), **bind_params)
 
         return self
 
     def should_update(self):
-        curr_values = self.to_dict()
-        return any(curr_values[field] != self.db_fields[field] for field in self.fields)
+        """
+        Returns whether any dirty field differs from the database.  Clean objects return immediately.
+        """
+        if not self._dirty:
+            return False
+        return any(self._data[field] != self.db_fields[field] for field in self._dirty)
 
     def update(self, force = False):
         """
@@ -287,7 +610,7 @@ class DBTable(with_metaclass(DBTableMeta)):
         """
         Inserts a row into the database, and returns that row.
         """
-        kv = { x:y for x,y in self.to_dict().items() if y != None }
+        kv = { x:y for x,y in self._data.items() if y != None }
         fields = kv.keys()
         values = [ kv[x] for x in fields ]
         sql = "INSERT INTO {table_name} ({fields}) VALUES ({values}) RETURNING *".format(
@@ -296,21 +619,28 @@ class DBTable(with_metaclass(DBTableMeta)):
             values = ', '.join([ "%({})s".format(x) for x in fields ]),
         )
 
-        self.db_fields = fetch_results(self.conn, sql, **kv)[0]
-        assert self.db_fields
-
-        for k, v in self.db_fields.items():
-            setattr(self, k, copy.deepcopy(v))
+        self.load_row(fetch_results(self.conn, self.prepared_sql(sql, kv), **kv)[0])
 
     def _update(self, force = False):
         """
         Updates a row in the database, and returns that row.
         """
-        new_values = self.to_dict()
-        bind_params = { x : new_values[x] for x in self.fields if new_values[x] != self.db_fields[x] }
-        if not bind_params:
+        sql, bind_params = self._update_sql(force)
+        if not sql:
+            self._dirty = None
             return self
 
+        self.load_row(fetch_results(self.conn, self.prepared_sql(sql, bind_params), **bind_params)[0])
+
+    def _update_sql(self, force = False):
+        """
+        Returns the UPDATE statement and bind params for the dirty fields, or (None, None) if nothing changed.
+        """
+        # Sorted, so the same changed fields always produce the same SQL (and one prepared statement)
+        changed = [ x for x in sorted(self._dirty or ()) if self._data[x] != self.db_fields[x] ]
+        if not changed:
+            return None, None
+
         # Verify id field didn't change
         if self.id_field:
             if getattr(self, self.id_field) != self.db_fields[self.id_field]:
@@ -330,7 +660,8 @@ class DBTable(with_metaclass(DBTableMeta)):
                         getattr(self, key_field),
                     ))
 
-        field_equality = ', '.join([ "{0} = %({0})s".format(x) for x in bind_params.keys() ])
+        field_equality = ', '.join([ "{0} = %({0})s".format(x) for x in changed ])
+        bind_params = { x : self._data[x] for x in changed }
 
         if self.id_field:
             fields = [ self.id_field ]
@@ -353,10 +684,7 @@ class DBTable(with_metaclass(DBTableMeta)):
             filter_clause  = filter_clause,
         )
 
-        self.db_fields = fetch_results(self.conn, sql, **bind_params)[0]
-        assert self.db_fields
-        for k, v in self.db_fields.items():
-            setattr(self, k, copy.deepcopy(v))
+        return sql, bind_params
 
     def delete(self):
         """
@@ -365,6 +693,16 @@ class DBTable(with_metaclass(DBTableMeta)):
         if not self.db_fields:
             return []
 
+        sql, bind_params = self._delete_sql()
+        objs = fetch_results(self.conn, self.prepared_sql(sql, bind_params), **bind_params)
+        assert objs
+
+        return objs
+
+    def _delete_sql(self):
+        """
+        Returns the DELETE statement and bind params for the row.
+        """
         if self.id_field:
             fields = [ self.id_field ]
         elif self.key_fields:
@@ -384,10 +722,7 @@ class DBTable(with_metaclass(DBTableMeta)):
             filter_clause = filter_clause,
         )
 
-        objs = fetch_results(self.conn, sql, **bind_params)
-        assert objs
-
-        return objs
+        return sql, bind_params
 
     def to_dict(self):
         return { field : getattr(self, field) for field in self.fields }
@@ -406,3 +741,158 @@ class DBTable(with_metaclass(DBTableMeta)):
     def get_conn(cls, new_conn):
         cls._conn = new_conn
 
+
+
+class DBSession(object):
+    """
+    A unit of work for DBTable objects.  The session keeps an identity map per table, so
+    finding the same row twice returns the same object, and queues inserts, updates and deletes.
+    On exit the queue is flushed grouped by table and operation, with one round trip per chunk,
+    and committed.  If the block raises, the connections are rolled back instead.
+
+    with DBSession() as session:
+        foo = session.find_by_id(FooTable, 1)
+        foo.b = 2                           # Updated on flush, no add() required
+        session.add(FooTable(a = 1, b = 2)) # Inserted on flush
+        session.delete(bar)                 # Deleted on flush
+
+    Updates do not use RETURNING, so db_fields are set from the written values.
+    """
+    def __init__(self, chunk_size = 1000):
+        self.chunk_size = chunk_size
+        self.id_maps    = collections.defaultdict(wizzat.decorators.create_cache_obj)
+        self.key_maps   = collections.defaultdict(wizzat.decorators.create_cache_obj)
+        self.tracked    = collections.OrderedDict()
+        self.deleted    = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type:
+            self.rollback()
+            return
+
+        try:
+            self.flush()
+        except Exception:
+            self.rollback()
+            raise
+
+        self.commit()
+
+    def add(self, obj):
+        """
+        Tracks an object.  New objects are inserted on flush, and changed objects are updated.
+        """
+        cls = type(obj)
+        self.tracked.setdefault(cls, collections.OrderedDict())[id(obj)] = obj
+
+        if obj.db_fields:
+            if cls.id_field:
+                self.id_maps[cls][obj.db_fields[cls.id_field]] = obj
+            if cls.key_fields:
+                self.key_maps[cls][tuple(obj.db_fields[x] for x in cls.key_fields)] = obj
+
+        return obj
+
+    def delete(self, obj):
+        """
+        Queues an object for deletion on flush.
+        """
+        cls = type(obj)
+        self.tracked.get(cls, {}).pop(id(obj), None)
+        if obj.db_fields:
+            self.deleted.setdefault(cls, collections.OrderedDict())[id(obj)] = obj
+
+    def find_by_id(self, cls, id):
+        return self.find_by_ids(cls, [ id ])[0]
+
+    def find_by_key(self, cls, *keys):
+        return self.find_by_keys(cls, [ keys ])[0]
+
+    def find_by_ids(self, cls, ids):
+        id_map = self.id_maps[cls]
+        ids = list(ids)
+        misses = [ x for x in ids if x not in id_map ]
+        for obj in cls.find_by_ids(misses, chunk_size = self.chunk_size):
+            if obj:
+                self.add(obj)
+
+        return [ id_map.get(x) for x in ids ]
+
+    def find_by_keys(self, cls, keys):
+        key_map = self.key_maps[cls]
+        keys = [ tuple(x) for x in keys ]
+        misses = [ x for x in keys if x not in key_map ]
+        for obj in cls.find_by_keys(misses, chunk_size = self.chunk_size):
+            if obj:
+                self.add(obj)
+
+        return [ key_map.get(x) for x in keys ]
+
+    def flush(self):
+        """
+        Writes all queued changes.  Inserts and updates run in the order tables were first seen,
+        and deletes in reverse order, so parent rows are written before and deleted after children.
+        """
+        for cls, objs in self.tracked.items():
+            new_objs = [ x for x in objs.values() if not x.db_fields ]
+            if new_objs:
+                cls.bulk_insert(new_objs, chunk_size = self.chunk_size)
+                for obj in new_objs:
+                    self.add(obj)
+
+        for cls, objs in self.tracked.items():
+            changed_objs = [ x for x in objs.values() if x.should_update() ]
+            for obj in changed_objs:
+                obj.on_update()
+
+            self.execute_batch(cls, [ obj._update_sql() for obj in changed_objs ])
+
+            for obj in changed_objs:
+                # The caller may still hold mutable values and change them in place, so db_fields gets
+                # a copy and those fields stay dirty to be compared on the next flush
+                obj.db_fields.update({ x : copy.deepcopy(obj._data[x]) for x in obj._dirty })
+                obj._dirty = { x for x in obj._dirty if type(obj._data[x]) in (dict, list) } or None
+                obj.after_update()
+
+        for cls, objs in reversed(list(self.deleted.items())):
+            self.execute_batch(cls, [ obj._delete_sql() for obj in objs.values() ])
+            for obj in objs.values():
+                cls.uncache_obj(obj)
+                self.id_maps[cls].pop(obj.db_fields.get(cls.id_field), None)
+                self.key_maps[cls].pop(tuple(obj.db_fields.get(x) for x in cls.key_fields), None)
+
+        self.deleted.clear()
+
+    def execute_batch(self, cls, statements):
+        """
+        Sends the statements to the server chunk_size at a time, and raises DBTableError if any
+        of them matched no rows (eg, a row deleted or rekeyed by another transaction).
+        """
+        counts = execute_statements(cls.conn, statements, page_size = self.chunk_size)
+        missed = [ sql for (sql, _), count in zip(statements, counts) if not count ]
+        if missed:
+            raise DBTableError("{} of {} statements for {} matched no rows:{}".format(
+                len(missed),
+                len(statements),
+                cls.table_name,
+                missed[0],
+            ))
+
+    def connections(self):
+        conns = []
+        for cls in itertools.chain(self.tracked, self.deleted):
+            if cls.conn not in conns:
+                conns.append(cls.conn)
+        return conns
+
+    def commit(self):
+        for conn in self.connections():
+            conn.commit()
+
+    def rollback(self):
+        for conn in self.connections():
+            conn.rollback()
+        self.deleted.clear()
@@ -3,16 +3,39 @@ from builtins import *
 from future.utils import exec_, iteritems, iterkeys
 
 import collections
+import contextlib
 import functools
 import io
 import io
+import heapq
+import inspect
 import itertools
+import logging
 import os
+import pickle
 import sys
 import threading
 import time
+import types
+import weakref
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident
+
+# The wall clock stands in where there's no perf_counter_ns (python < 3.7)
+perf_counter_ns = getattr(time, 'perf_counter_ns', None) or (lambda: int(time.time() * 1e9))
 
 import wizzat.textutil
+from wizzat.mathutil import Percentile
+from wizzat.diskcache import DiskCache
+from wizzat.shmcache import SharedMemoryCache
 from wizzat.util import (
     swallow,
     OfflineError,
@@ -22,7 +45,12 @@ from wizzat.util import (
 
 __all__ = [
     'BenchResults',
+    'BenchStats',
     'MemoizeResults',
+    'NegativeCache',
+    'ShardedCache',
+    'TieredCache',
+    'bench_scope',
     'benchmark',
     'coroutine',
     'memoize',
@@ -75,6 +103,8 @@ class MemoizeResults(object):
             - Calls
             - Hits
             - Misses
+            - Negative Hits (hits on cached None results, with negative_until or negative_size)
+            - Bytes (the cache's current size, when max_bytes is set)
         """
 
         rows = []
@@ -84,6 +114,8 @@ class MemoizeResults(object):
                 stats['call'],                                                      # 'Calls',
                 stats['call'] - stats['miss'],                                      # 'Hits',
                 stats['miss'],                                                      # 'Misses',
+                stats['negative_hit'],                                              # 'Negative Hits',
+                cls.caches[func].current_size,                                      # 'Bytes',
             ])
 
         table = wizzat.textutil.text_table([
@@ -91,6 +123,8 @@ class MemoizeResults(object):
             'Calls',
             'Hits',
             'Misses',
+            'Negative Hits',
+            'Bytes',
         ], rows)
 
         return "Memoize Stats By Function\n\n" + table
@@ -104,6 +138,8 @@ class MemoizeResults(object):
             - Calls
             - Hits
             - Misses
+            - Negative Hits
+            - Bytes (the cache's current size, when max_bytes is set)
         """
         fp = io.StringIO()
         fp.write(",".join([
@@ -111,6 +147,8 @@ class MemoizeResults(object):
             'Calls',
             'Hits',
             'Misses',
+            'Negative Hits',
+            'Bytes',
         ]))
         fp.write("\n")
 
@@ -120,76 +158,578 @@ class MemoizeResults(object):
                 stats['call'],                                                      # 'Calls',
                 stats['call'] - stats['miss'],                                      # 'Hits',
                 stats['miss'],                                                      # 'Misses',
+                stats['negative_hit'],                                              # 'Negative Hits',
+                cls.caches[func].current_size,                                      # 'Bytes',
             ] ]))
             fp.write("\n")
 
         return fp.getvalue()
 
-def release(lock):
-    swallow(RuntimeError, lock.release)
+class ShardedCache(object):
+    """
+    A thread safe cache split into shards by key hash, each with its own lock.
+    Concurrent misses on the same key compute the value once while the other
+    callers wait for it, and misses on different keys compute in parallel.
+    Used by memoize(threads=True).
+    """
+    def __init__(self, shards, gen_cache):
+        self.shards  = [ gen_cache(idx) for idx in range(shards) ]
+        self.locks   = [ threading.Lock() for _ in range(shards) ]
+        self.flights = [ {} for _ in range(shards) ]
+
+    def shard_idx(self, key):
+        return hash(key) % len(self.shards)
 
-def construct_cache_func_definition(threads, disable_kw, obj, verbose, **kwargs):
-    if threads:
-        threadlock   = "lock.acquire()"
-        threadunlock = "release(lock)"
+    def get_or_compute(self, key, func, args, kwargs, stats):
+        idx = self.shard_idx(key)
+        shard, lock, flights = self.shards[idx], self.locks[idx], self.flights[idx]
+
+        while True:
+            with lock:
+                try:
+                    value = shard[key]
+                    if not shard.stale_while_revalidate or not shard.is_stale(key):
+                        return value
+                    stale = True
+                except KeyError:
+                    stale = False
+
+                flight = flights.get(key)
+                if flight is None:
+                    flight = flights[key] = [ threading.Event(), False, None ]
+                    break
+                elif stale:
+                    # Another thread is already refreshing this key
+                    stats['stale'] += 1
+                    return value
+
+            # Another thread is computing this key.  If it raises, retry the call here.
+            flight[0].wait()
+            if flight[1]:
+                return flight[2]
+
+        try:
+            stats['miss'] += 1
+            value = func(*args, **kwargs)
+            flight[1:] = [ True, value ]
+
+            with lock:
+                shard[key] = value
+        finally:
+            with lock:
+                flights.pop(key, None)
+            flight[0].set()
+
+        return value
+
+    def __getitem__(self, key):
+        idx = self.shard_idx(key)
+        with self.locks[idx]:
+            return self.shards[idx][key]
+
+    def __setitem__(self, key, value):
+        idx = self.shard_idx(key)
+        with self.locks[idx]:
+            self.shards[idx][key] = value
+
+    def __delitem__(self, key):
+        idx = self.shard_idx(key)
+        with self.locks[idx]:
+            del self.shards[idx][key]
+
+    def __contains__(self, key):
+        idx = self.shard_idx(key)
+        with self.locks[idx]:
+            return key in self.shards[idx]
+
+    def __len__(self):
+        return sum(len(x) for x in self.shards)
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        idx = self.shard_idx(key)
+        with self.locks[idx]:
+            return self.shards[idx].pop(key, *default)
+
+    def is_stale(self, key):
+        idx = self.shard_idx(key)
+        with self.locks[idx]:
+            return self.shards[idx].is_stale(key)
+
+    def clear(self):
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                shard.clear()
+
+    def expire(self, now = None):
+        removed = 0
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                removed += shard.expire(now)
+        return removed
+
+    @property
+    def current_size(self):
+        return sum(x.current_size for x in self.shards)
+
+class TieredCache(object):
+    """
+    An in memory cache backed by a DiskCache.  Misses in memory are read from disk and kept
+    in memory, and new values are written to both.  Used by memoize(persist=path).
+    """
+    def __init__(self, memory, disk):
+        self.memory = memory
+        self.disk   = disk
+
+    @property
+    def stale_while_revalidate(self):
+        return getattr(self.memory, 'stale_while_revalidate', 0)
+
+    def __getitem__(self, key):
+        try:
+            return self.memory[key]
+        except KeyError:
+            expiration, value = self.disk.lookup(key)
+            self.memory.put(key, value, expiration)
+            return value
+
+    def __setitem__(self, key, value):
+        self.memory[key] = value
+        self.disk[key] = value
+
+    def __delitem__(self, key):
+        self.disk.pop(key, None)
+        del self.memory[key]
+
+    def __contains__(self, key):
+        return key in self.memory or key in self.disk
+
+    def __len__(self):
+        return len(self.memory)
+
+    def warm(self, key, value, expiration = 0):
+        """
+            Puts a value read from disk in memory, without writing it back.
+        """
+        self.memory.put(key, value, expiration)
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        self.disk.pop(key, None)
+        return self.memory.pop(key, *default)
+
+    def is_stale(self, key):
+        return self.memory.is_stale(key)
+
+    def clear(self):
+        self.memory.clear()
+        self.disk.clear()
+
+    def expire(self, now = None):
+        self.disk.expire(now)
+        return self.memory.expire(now)
+
+    @property
+    def current_size(self):
+        return self.memory.current_size
+
+class NegativeCache(object):
+    """
+    Keeps None results in a separate cache with its own expiration and size limit, so lookups of
+    things which don't exist are cached without evicting real results, and are retried sooner.
+    Hits on None results are counted in stats['negative_hit'].
+    Used by memoize(negative_until=..., negative_size=...).
+    """
+    def __init__(self, positive, negative, stats):
+        self.positive = positive
+        self.negative = negative
+        self.stats    = stats
+
+    @property
+    def stale_while_revalidate(self):
+        return getattr(self.positive, 'stale_while_revalidate', 0)
+
+    def __getitem__(self, key):
+        try:
+            return self.positive[key]
+        except KeyError:
+            value = self.negative[key]
+            self.stats['negative_hit'] += 1
+            return value
+
+    def __setitem__(self, key, value):
+        if value is None:
+            swallow(KeyError, self.positive.__delitem__, key)
+            self.negative[key] = value
+        else:
+            swallow(KeyError, self.negative.__delitem__, key)
+            self.positive[key] = value
+
+    def __delitem__(self, key):
+        try:
+            del self.positive[key]
+        except KeyError:
+            del self.negative[key]
+
+    def __contains__(self, key):
+        return key in self.positive or key in self.negative
+
+    def __len__(self):
+        return len(self.positive) + len(self.negative)
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+            del self[key]
+            return value
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+
+    def is_stale(self, key):
+        return self.positive.is_stale(key) if key in self.positive else self.negative.is_stale(key)
+
+    def clear(self):
+        self.positive.clear()
+        self.negative.clear()
+
+    def expire(self, now = None):
+        return self.positive.expire(now) + self.negative.expire(now)
+
+    @property
+    def current_size(self):
+        return self.positive.current_size + self.negative.current_size
+
+# Names used by the generated memo_func, which a specialized signature must not shadow
+memo_func_names = frozenset([
+    'args', 'asyncio', 'cache', 'cache_task_result', 'defaults', 'func', 'functools', 'gen_cache',
+    'hasattr', 'inflight', 'isinstance', 'key', 'kwargs', 'memo_func', 'setattr', 'ShardedCache',
+    'sorted', 'stale', 'stats', 'task', 'tuple', 'value',
+])
+
+def construct_signature(func):
+    """
+    Describes how a memo_func with the same signature as func builds its key and calls func.
+    Every argument is bound to its parameter, so f(1, 2), f(1, b=2) and f(a=1, b=2) share a key.
+    Returns None when func has no usable signature or an unhashable default, and the generic *args, **kwargs wrapper is needed.
+    """
+    try:
+        params = list(inspect.signature(func).parameters.values())
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+    # *args and **kwargs are renamed to match the generic wrapper
+    if any(x.name in memo_func_names for x in params if x.kind not in (x.VAR_POSITIONAL, x.VAR_KEYWORD)):
+        return None
+
+    defaults   = {}
+    signature  = []
+    key        = []
+    positional = []
+    keyword    = []
+    var_args   = var_kwargs = False
+    for idx, param in enumerate(params):
+        name = param.name
+        if param.kind == param.VAR_POSITIONAL:
+            var_args = True
+            signature.append('*args')
+            key.append('args')
+            continue
+        elif param.kind == param.VAR_KEYWORD:
+            var_kwargs = True
+            signature.append('**kwargs')
+            key.append('tuple(sorted(kwargs.items())) if kwargs else ()')
+            continue
+        elif param.kind == param.KEYWORD_ONLY:
+            if not var_args and '*' not in signature:
+                signature.append('*')
+            keyword.append(name)
+        else:
+            positional.append(name)
+
+        if param.default is param.empty:
+            signature.append(name)
+        else:
+            # Defaults are part of the key, so an unhashable one needs the generic wrapper
+            try:
+                hash(param.default)
+            except TypeError:
+                return None
+            defaults[name] = param.default
+            signature.append("{0}=defaults['{0}']".format(name))
+
+        if param.kind == param.POSITIONAL_ONLY and (idx + 1 == len(params) or params[idx + 1].kind != param.POSITIONAL_ONLY):
+            signature.append('/')
+
+        key.append(name)
+
+    args = "({},)".format(", ".join(positional)) if positional else "()"
+    if var_args:
+        args = "args" if not positional else args + " + args"
+
+    if keyword:
+        kwargs = "{{{}}}".format(", ".join("'{0}': {0}".format(x) for x in keyword))
+        kwargs = "dict(kwargs, **{})".format(kwargs) if var_kwargs else kwargs
     else:
-        threadlock   = ""
-        threadunlock = "pass"
+        kwargs = "kwargs" if var_kwargs else "{}"
+
+    call = list(positional)
+    if var_args:
+        call.append('*args')
+    call.extend("{0}={0}".format(x) for x in keyword)
+    if var_kwargs:
+        call.append('**kwargs')
+
+    return {
+        'signature' : ", ".join(signature),
+        'key'       : "(func, {},)".format(", ".join(key)) if key else "(func,)",
+        'call'      : ", ".join(call),
+        'args'      : args,
+        'kwargs'    : kwargs,
+        'first'     : positional[0] if positional and params[0].name == positional[0] else 'args[0]',
+        'defaults'  : defaults,
+    }
 
-    if disable_kw:
-        setup_key = "(func, args)"
+def construct_cache_func_definition(threads, disable_kw, obj, verbose, until, stale_while_revalidate, backend, is_async = False, signature = None, **kwargs):
+    if disable_kw or not signature:
+        signature = {
+            'signature' : '*args, **kwargs',
+            'call'      : '*args, **kwargs',
+            'args'      : 'args',
+            'kwargs'    : 'kwargs',
+            'first'     : 'args[0]',
+        }
+        if disable_kw:
+            setup_key = "(func, args)"
+        else:
+            # Calls without kwargs skip sorting them
+            setup_key = "(func, args, tuple(sorted(kwargs.items()))) if kwargs else (func, args)"
     else:
-        setup_key = "(func, args, tuple(sorted(zip(iteritems(kwargs)))))"
+        setup_key = signature['key']
 
     if obj:
-        generate_cache = 'if not hasattr(args[0], "__memoize_cache__"): setattr(args[0], "__memoize_cache__", gen_cache())'
-        get_cache = 'cache = args[0].__memoize_cache__'
+        generate_cache = 'if not hasattr({first}, "__memoize_cache__"): setattr({first}, "__memoize_cache__", gen_cache())'.format(**signature)
+        get_cache = 'cache = {first}.__memoize_cache__'.format(**signature)
     else:
         generate_cache = ''
         get_cache = ''
 
+    lookup = """try:
+        return cache[key]
+    except KeyError:
+        stats['miss'] += 1
+        value = cache[key] = func({call})
+        return value"""
+
+    if until and stale_while_revalidate:
+        # Without threads there is nobody else to serve the stale value to, so refresh it now
+        lookup = """try:
+        value = cache[key]
+        if not cache.is_stale(key): return value
+    except KeyError:
+        pass
+    stats['miss'] += 1
+    value = cache[key] = func({call})
+    return value"""
+
+    if backend == 'shm':
+        # The shared memory cache does its own locking
+        threads = False
+
+    if threads and obj:
+        # Another memoized method may have already given the object a cache without threads
+        lookup = "if isinstance(cache, ShardedCache): return cache.get_or_compute(key, func, {args}, {kwargs}, stats)\n    " + lookup
+    elif threads:
+        lookup = "return cache.get_or_compute(key, func, {args}, {kwargs}, stats)"
+
+    if is_async:
+        # Concurrent awaits of a key share one task, which caches its result when it succeeds.
+        # A stale result is returned immediately while the task refreshes it.
+        lookup = """stale = False
+    try:
+        value = cache[key]
+        {check_stale}
+    except KeyError:
+        pass
+    task = inflight.get(key)
+    if task is None:
+        stats['miss'] += 1
+        task = inflight[key] = asyncio.ensure_future(func({call}))
+        task.add_done_callback(functools.partial(cache_task_result, cache, inflight, key))
+    if stale:
+        stats['stale'] += 1
+        return value
+    return await asyncio.shield(task)""".format(
+            check_stale = "if not cache.is_stale(key): return value\n        stale = True" if until and stale_while_revalidate else "return value",
+            call        = "{call}",
+        )
+
+    lookup = lookup.format(**signature)
+
     result = """
 @functools.wraps(func)
-def memo_func(*args, **kwargs):
+{async_def}def memo_func({params}):
     {generate_cache}
     {get_cache}
     stats['call'] += 1
     key = {setup_key}
-    {threadlock}
-    try:
-        return cache[key]
-    except KeyError:
-        stats['miss'] += 1
-        value = cache[key] = func(*args, **kwargs)
-        return value
-    finally:
-        {threadunlock}
-""".format(**locals())
+    {lookup}
+""".format(async_def = 'async ' if is_async else '', params = signature['signature'], **locals())
 
     if verbose:
         print(result)
 
     return result
 
-def construct_cache_obj_definition(max_size, max_bytes, until, ignore_nulls, verbose, **kwargs):
-    if max_size or max_bytes:
-        superclass     = 'collections.OrderedDict'
-        remove_old_key = "if key in self: self.pop(key)" # Enables LRU behavior
-    else:
-        superclass     = 'dict'
-        remove_old_key = ''
+class LFUPolicy(object):
+    """
+    Least frequently used eviction for bounded memoize caches, with ties evicted in LRU order.
+    Keys are kept in buckets by hit count so hits and evictions are O(1).
+    """
+    def __init__(self, *args, **kwargs):
+        super(LFUPolicy, self).__init__(*args, **kwargs)
+        self.counts    = {}
+        self.buckets   = collections.defaultdict(collections.OrderedDict)
+        self.min_count = 0
+
+    def admit(self, key):
+        self.counts[key] = 1
+        self.buckets[1][key] = None
+        self.min_count = 1
+
+    def touch(self, key):
+        count = self.counts[key]
+        self.unbucket(key, count)
+        self.counts[key] = count + 1
+        self.buckets[count + 1][key] = None
+
+    def forget(self, key):
+        self.unbucket(key, self.counts.pop(key))
+
+    def unbucket(self, key, count):
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+            if count == self.min_count:
+                self.min_count = min(self.buckets) if self.buckets else 0
+
+    def evict(self):
+        del self[next(iter(self.buckets[self.min_count]))]
+
+    def clear(self):
+        super(LFUPolicy, self).clear()
+        self.counts.clear()
+        self.buckets.clear()
+        self.min_count = 0
+
+
+class SLRUPolicy(object):
+    """
+    Segmented LRU eviction for bounded memoize caches.  New keys enter a probation segment,
+    and move to a protected segment when they are hit.  Keys are evicted from probation first,
+    so a scan of one-time keys can't flush out frequently used keys.
+    """
+    protected_ratio = 0.8
+
+    def __init__(self, *args, **kwargs):
+        super(SLRUPolicy, self).__init__(*args, **kwargs)
+        self.probation = collections.OrderedDict()
+        self.protected = collections.OrderedDict()
+
+    def admit(self, key):
+        self.probation[key] = None
+
+    def touch(self, key):
+        if key in self.protected:
+            self.protected[key] = self.protected.pop(key)
+            return
+
+        del self.probation[key]
+        self.protected[key] = None
+
+        # The protected segment overflows back into the most recently used end of probation
+        max_protected = max(1, int(self.protected_ratio * (self.max_size or len(self))))
+        while len(self.protected) > max_protected:
+            demoted, _ = self.protected.popitem(False)
+            self.probation[demoted] = None
+
+    def forget(self, key):
+        self.probation.pop(key, None)
+        self.protected.pop(key, None)
+
+    def evict(self):
+        del self[next(iter(self.probation or self.protected))]
+
+    def clear(self):
+        super(SLRUPolicy, self).clear()
+        self.probation.clear()
+        self.protected.clear()
+
+cache_policies = {
+    'lru'  : None,
+    'lfu'  : LFUPolicy,
+    'slru' : SLRUPolicy,
+}
+
+def construct_cache_obj_definition(max_size, max_bytes, until, ignore_nulls, verbose, policy = 'lru', stale_while_revalidate = 0, **kwargs):
+    if policy not in cache_policies:
+        raise ValueError("Unknown cache policy: {}".format(policy))
+
+    bases  = 'dict'
+    admit  = ''
+    touch  = ''
+    forget = ''
+    evict  = ''
+    remove_old_key = ''
+    if (max_size or max_bytes) and policy == 'lru':
+        bases          = 'collections.OrderedDict'
+        remove_old_key = "if key in self: del self[key]" # Enables LRU behavior
+        evict          = "self.popitem(False)"
+        if sys.version_info.major >= 3:
+            touch = "{}.move_to_end(self, key)".format(bases)
+    elif max_size or max_bytes:
+        bases          = 'Policy, dict'
+        remove_old_key = "if key in self: del self[key]"
+        admit          = "self.admit(key)"
+        touch          = "self.touch(key)"
+        forget         = "self.forget(key)"
+        evict          = "self.evict()"
+    superclass = bases.split(', ')[-1]
 
     if max_bytes:
-        byte_filter = "while self and self.current_size > self.max_bytes: self.popitem(False)"
-        bytes_incr  = "self.current_size += sys.getsizeof(value)"
-        bytes_decr  = "self.current_size -= sys.getsizeof(value)"
+        # The size charged for each key is remembered, so it is credited back exactly on replace, eviction and expiry
+        byte_filter = "while self and self.current_size > self.max_bytes: {}".format(evict)
+        bytes_init  = "self.sizes = {}"
+        bytes_incr  = "size = self.sizes[key] = sizeof(value); self.current_size += size"
+        bytes_decr  = "self.current_size -= self.sizes.pop(key)"
+        bytes_clear = "self.sizes.clear()"
     else:
         byte_filter = ""
-        bytes_incr = ""
-        bytes_decr = ""
+        bytes_init  = ""
+        bytes_incr  = ""
+        bytes_decr  = ""
+        bytes_clear = ""
 
     if max_size:
-        size_filter = "while self and len(self) > self.max_size: self.popitem(False)"
+        size_filter = "while self and len(self) > self.max_size: {}".format(evict)
     else:
         size_filter = ""
 
@@ -199,43 +739,120 @@ def construct_cache_obj_definition(max_size, max_bytes, until, ignore_nulls, ver
         null_filter = ""
 
     if until:
-        until_check = "if expiration < time.time(): del self[key]; raise KeyError(key)"
+        until_check = "if expiration + self.stale_while_revalidate < time.time(): del self[key]; raise KeyError(key)"
         until_call  = "expiration = self.expire_func()"
+        until_keep  = "expiration = expiration or self.expire_func()"
         result_expr = "(expiration, value)"
+        expiry_init = "self.expiries = []; self.sequence = itertools.count()"
+        expiry_push = "heapq.heappush(self.expiries, (expiration, next(self.sequence), key))"
+        expire      = "self.expire()"
+        is_stale    = "return {}.__getitem__(self, key)[0] < time.time()".format(superclass)
     else:
         until_check = ""
         until_call  = ""
+        until_keep  = ""
         result_expr = "value"
+        expiry_init = "self.expiries = []"
+        expiry_push = ""
+        expire      = ""
+        is_stale    = "return False"
+
+    store = '; '.join(x for x in [ "{}.__setitem__(self, key, {})".format(superclass, result_expr), bytes_incr, admit, expiry_push ] if x)
 
     definition = """
-class Cache({superclass}):
+class Cache({bases}):
     current_size = 0
     max_bytes    = max_bytes
     max_size     = max_size
     expire_func  = staticmethod(expire_func)
+    stale_while_revalidate = stale_while_revalidate
+
+    def __init__(self, *args, **kwargs):
+        super(Cache, self).__init__(*args, **kwargs)
+        {bytes_init}
+        {expiry_init}
 
     def __delitem__(self, key):
-        value = {superclass}.__getitem__(self, key)
-        {bytes_decr}
         {superclass}.__delitem__(self, key)
+        {bytes_decr}
+        {forget}
 
     def __getitem__(self, key):
         {result_expr} = {superclass}.__getitem__(self, key)
         {until_check}
+        {touch}
         return value
 
     def __setitem__(self, key, value):
         {remove_old_key}
         {until_call}
-        {null_filter}{superclass}.__setitem__(self, key, {result_expr}); {bytes_incr}
+        {null_filter}{store}
+        {expire}
         {byte_filter}
         {size_filter}
 
-    if sys.version_info.major >= 3:
-        def popitem(self, last=True):
-            key, value = {superclass}.popitem(self, last)
-            {bytes_decr}
-            return key, value
+    def put(self, key, value, expiration = 0):
+        # Stores a copy of a value which keeps its original expiration, when it has one
+        {remove_old_key}
+        {until_keep}
+        {null_filter}{store}
+        {expire}
+        {byte_filter}
+        {size_filter}
+
+    def is_stale(self, key):
+        {is_stale}
+
+    def expire(self, now = None):
+        # Entries are indexed in a heap by expiration.  Replaced and deleted keys leave stale heap
+        # entries behind, which are skipped here and dropped when the heap is rebuilt.
+        now = now or time.time()
+        removed = 0
+        while self.expiries and self.expiries[0][0] + self.stale_while_revalidate < now:
+            expiration, _, key = heapq.heappop(self.expiries)
+            if key in self and {superclass}.__getitem__(self, key)[0] == expiration:
+                del self[key]
+                removed += 1
+
+        if len(self.expiries) > 2 * len(self) + 16:
+            self.expiries = [ (entry[0], next(self.sequence), key) for key, entry in {superclass}.items(self) ]
+            heapq.heapify(self.expiries)
+
+        return removed
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    # pop and popitem go through __delitem__, so popped keys are credited back and forgotten by the policy
+    def pop(self, key, *default):
+        try:
+            {result_expr} = {superclass}.__getitem__(self, key)
+            {until_check}
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+
+        del self[key]
+        return value
+
+    def popitem(self, last = True):
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+
+        key = next(reversed(self) if last else iter(self))
+        {result_expr} = {superclass}.__getitem__(self, key)
+        del self[key]
+        return key, value
+
+    def clear(self):
+        super(Cache, self).clear()
+        self.current_size = 0
+        self.expiries = []
+        {bytes_clear}
 """.format(**locals())
 
     if verbose:
@@ -243,60 +860,308 @@ class Cache({superclass}):
 
     return definition
 
-def create_cache_obj(**kwargs):
+class CacheSweeper(object):
+    """
+    Shared daemon thread which removes expired entries from memoize(until=..., sweep_interval=...)
+    caches, so they don't hold memory until the next write.  Caches are held by weak reference.
+    Only thread safe caches (threads=True or backend='shm') can be swept from another thread.
+    """
+    caches = []
+    lock   = threading.Lock()
+    wake   = threading.Event()
+    thread = None
+
+    @classmethod
+    def register(cls, cache, interval):
+        with cls.lock:
+            cls.caches.append([ weakref.ref(cache), interval, time.time() + interval ])
+
+            if cls.thread is None:
+                cls.thread = threading.Thread(target = cls.sweep_forever, name = 'memoize sweeper')
+                cls.thread.daemon = True
+                cls.thread.start()
+
+        cls.wake.set()
+
+    @classmethod
+    def sweep(cls, now = None):
+        """
+            Expires each cache that is due to be swept, and returns the time of the next sweep.
+        """
+        now = now or time.time()
+        with cls.lock:
+            cls.caches = [ x for x in cls.caches if x[0]() is not None ]
+            entries = list(cls.caches)
+
+        for entry in entries:
+            cache = entry[0]()
+            if cache is not None and entry[2] <= now:
+                # One failing cache mustn't stop the sweeper for every other cache
+                try:
+                    cache.expire(now)
+                except Exception:
+                    logging.exception("Failed to sweep memoize cache %r", cache)
+                entry[2] = now + entry[1]
+
+        return min([ x[2] for x in entries ] or [ now + 60 ])
+
+    @classmethod
+    def sweep_forever(cls):
+        while True:
+            next_sweep = cls.sweep()
+            cls.wake.wait(max(0, next_sweep - time.time()))
+            cls.wake.clear()
+
+def deep_sizeof(obj):
+    """
+    Returns the size in bytes of obj and everything it references through containers,
+    __dict__ and __slots__.  Objects referenced more than once are counted once, and
+    classes, modules and functions are not counted.
+    """
+    seen  = set()
+    stack = [ obj ]
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _shared_types):
+            continue
+
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+            stack.extend(obj)
+
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+
+        for cls in type(obj).__mro__:
+            for slot in cls.__dict__.get('__slots__', ()):
+                if hasattr(obj, slot):
+                    stack.append(getattr(obj, slot))
+
+    return total
+
+_shared_types = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+
+def pickle_sizeof(obj):
+    """
+    Returns the length of obj's pickle, which is cheaper than deep_sizeof for large nested values.
+    """
+    return len(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+sizers = {
+    'shallow' : sys.getsizeof,
+    'deep'    : deep_sizeof,
+    'pickle'  : pickle_sizeof,
+}
+
+def create_cache_obj(stats = None, **kwargs):
+    """
+        Creates the cache for memoize(**kwargs).  Negative hits are counted in stats.
+    """
     kwargs = expand_memoize_args(kwargs)
+    stats  = collections.Counter() if stats is None else stats
+
+    if kwargs['backend'] == 'shm':
+        if not kwargs['name']:
+            raise ValueError("backend='shm' requires a name")
+
+        # Slots are evicted in CLOCK order and charged their pickled size, so other choices can't be honored
+        if kwargs['policy'] != 'lru':
+            raise ValueError("backend='shm' does not support policy={}".format(kwargs['policy']))
+        if kwargs['sizeof'] not in (None, 'pickle'):
+            raise ValueError("backend='shm' does not support sizeof={}".format(kwargs['sizeof']))
+
+        cache = SharedMemoryCache(kwargs['name'],
+            max_bytes    = kwargs['max_bytes'],
+            max_size     = kwargs['max_size'],
+            until        = kwargs['until'],
+            ignore_nulls = kwargs['ignore_nulls'],
+            stale_while_revalidate = kwargs['stale_while_revalidate'] or 0,
+        )
+        if kwargs['persist']:
+            cache = TieredCache(cache, create_disk_cache(**kwargs))
+        return create_negative_cache(cache, stats, **kwargs)
+    elif kwargs['backend'] != 'local':
+        raise ValueError("Unknown backend: {}".format(kwargs['backend']))
+
+    sizeof = kwargs['sizeof'] or 'deep'
+    if not callable(sizeof):
+        if sizeof not in sizers:
+            raise ValueError("Unknown sizeof: {}".format(sizeof))
+        sizeof = sizers[sizeof]
+
+    if kwargs['threads']:
+        # Split the size limits between the shards so they add up to the totals, and don't create
+        # shards that could never hold an item (a limit of 0 would mean no limit at all)
+        shards = kwargs['shards']
+        for limit in ('max_size', 'max_bytes', 'negative_size'):
+            if kwargs[limit]:
+                shards = min(shards, kwargs[limit])
+
+        def shard_limit(limit, idx):
+            total = kwargs[limit]
+            return total and total // shards + (1 if idx < total % shards else 0)
+
+        # The shards share one disk tier, which is only read on a miss under the shard's lock.
+        # Each shard keeps its own negative results in front of it, so they are never persisted.
+        disk = create_disk_cache(**kwargs) if kwargs['persist'] else None
+        def gen_shard(idx):
+            shard = create_cache_obj(**dict(kwargs,
+                threads        = False,
+                sweep_interval = 0,
+                persist        = None,
+                negative_until = None,
+                negative_size  = 0,
+                max_size       = shard_limit('max_size', idx),
+                max_bytes      = shard_limit('max_bytes', idx),
+            ))
+            if disk:
+                shard = TieredCache(shard, disk)
+            return create_negative_cache(shard, stats, **dict(kwargs,
+                negative_size  = shard_limit('negative_size', idx),
+            ))
+
+        cache = ShardedCache(shards, gen_shard)
+    else:
+        definition = construct_cache_obj_definition(
+            kwargs['max_size'],
+            kwargs['max_bytes'],
+            kwargs['until'],
+            kwargs['ignore_nulls'],
+            kwargs['verbose'],
+            kwargs['policy'],
+            kwargs['stale_while_revalidate'],
+        )
+
+        namespace = {
+            'expire_func'            : kwargs['until'],
+            'max_size'               : kwargs['max_size'],
+            'max_bytes'              : kwargs['max_bytes'],
+            'stale_while_revalidate' : kwargs['stale_while_revalidate'] or 0,
+            'Policy'                 : cache_policies[kwargs['policy']],
+            'sizeof'                 : sizeof,
+            'collections'            : collections,
+            'heapq'                  : heapq,
+            'itertools'              : itertools,
+            'sys'                    : sys,
+            'time'                   : time,
+        }
+
+        exec_(definition, namespace)
+        cache = namespace['Cache']()
+        if kwargs['persist']:
+            cache = TieredCache(cache, create_disk_cache(**kwargs))
+        cache = create_negative_cache(cache, stats, **kwargs)
+
+    if kwargs['until'] and kwargs['sweep_interval']:
+        CacheSweeper.register(cache, kwargs['sweep_interval'])
+
+    return cache
+
+def create_disk_cache(**kwargs):
+    if not kwargs['name']:
+        raise ValueError("persist requires a name")
+
+    return DiskCache(kwargs['persist'], kwargs['name'],
+        max_bytes = kwargs['persist_bytes'],
+        until     = kwargs['until'],
+    )
 
-    definition = construct_cache_obj_definition(
-        kwargs['max_size'],
-        kwargs['max_bytes'],
-        kwargs['until'],
-        kwargs['ignore_nulls'],
-        kwargs['verbose'],
+def create_negative_cache(cache, stats, **kwargs):
+    if not kwargs['negative_until'] and not kwargs['negative_size']:
+        return cache
+
+    negative = create_cache_obj(
+        until    = kwargs['negative_until'],
+        max_size = kwargs['negative_size'],
+        verbose  = kwargs['verbose'],
     )
 
-    namespace = {
-        'expire_func' : kwargs['until'],
-        'max_size'    : kwargs['max_size'],
-        'max_bytes'   : kwargs['max_bytes'],
-        'collections' : collections,
-        'sys'         : sys,
-        'time'        : time,
-    }
+    return NegativeCache(cache, negative, stats)
 
-    exec_(definition, namespace)
-    return namespace['Cache']()
+def prewarm_cache(cache, func, count):
+    """
+        Loads the count most read entries for func from the disk tier into memory.
+    """
+    # Negative results are never persisted, so only the positive tiers are warmed
+    shards = cache.shards if isinstance(cache, ShardedCache) else [ cache ]
+    shards = [ getattr(x, 'positive', x) for x in shards ]
+
+    for key, expiration, value in shards[0].disk.hottest(count):
+        # The disk stores the function by name
+        key = (func,) + tuple(key[1:])
+        shards[cache.shard_idx(key) if isinstance(cache, ShardedCache) else 0].warm(key, value, expiration)
+
+def cache_task_result(cache, inflight, key, task):
+    """
+    Caches the result of a memoized coroutine's task, unless it failed or was cancelled.
+    """
+    inflight.pop(key, None)
+    if not task.cancelled() and task.exception() is None:
+        cache[key] = task.result()
 
 def create_cache_func(func, **kwargs):
     kwargs = expand_memoize_args(kwargs)
-    cache_obj = func.cache = MemoizeResults.caches[func] = create_cache_obj(**kwargs)
-    stats_obj = func.stats = MemoizeResults.stats[func]  = collections.Counter()
-
-    definition = construct_cache_func_definition(**kwargs)
+    if kwargs['backend'] == 'shm' or kwargs['persist']:
+        if kwargs['obj']:
+            raise ValueError("backend='shm' and persist cannot be used with obj=True")
+        kwargs['name'] = kwargs['name'] or SharedMemoryCache.func_name(func)
+
+    is_async  = getattr(inspect, 'iscoroutinefunction', lambda x: False)(func)
+    signature = construct_signature(func) if hasattr(inspect, 'signature') else None
+    stats_obj = collections.Counter()
+    cache_obj = func.cache = MemoizeResults.caches[func] = create_cache_obj(stats_obj, **kwargs)
+    func.stats = MemoizeResults.stats[func] = stats_obj
+    if kwargs['persist'] and kwargs['prewarm']:
+        prewarm_cache(cache_obj, func, kwargs['prewarm'])
+
+    definition = construct_cache_func_definition(is_async = is_async, signature = signature, **kwargs)
     namespace = {
         'functools'   : functools,
-        'release'     : release,
         'func'        : func,
         'stats'       : stats_obj,
         'cache'       : cache_obj,
-        'zip'         : zip,
-        'iteritems'   : iteritems,
-        'lock'        : threading.RLock(),
-        'gen_cache'   : lambda: create_cache_obj(**kwargs),
+        'defaults'    : signature['defaults'] if signature else {},
+        'gen_cache'   : lambda: create_cache_obj(stats_obj, **kwargs),
+        'ShardedCache' : ShardedCache,
+        'cache_task_result' : cache_task_result,
+        'inflight'    : {},
     }
 
+    if is_async:
+        import asyncio
+        namespace['asyncio'] = asyncio
+
     exec_(definition, namespace)
     return namespace['memo_func']
 
 memoize_default_options = {
-    'until'        : None,
-    'disable_kw'   : False,
-    'ignore_nulls' : False,
-    'verbose'      : False,
-    'threads'      : False,
-    'obj'          : False,
-    'disabled'     : False,
-    'max_size'     : 0,
-    'max_bytes'    : 0,
+    'until'                  : None,
+    'disable_kw'             : False,
+    'ignore_nulls'           : False,
+    'verbose'                : False,
+    'threads'                : False,
+    'shards'                 : 16,
+    'obj'                    : False,
+    'disabled'               : False,
+    'max_size'               : 0,
+    'max_bytes'              : 0,
+    'policy'                 : 'lru',
+    'sizeof'                 : None,
+    'stale_while_revalidate' : 0,
+    'sweep_interval'         : 0,
+    'backend'                : 'local',
+    'name'                   : None,
+    'persist'                : None,
+    'persist_bytes'          : 0,
+    'prewarm'                : 0,
+    'negative_until'         : None,
+    'negative_size'          : 0,
 }
 
 def expand_memoize_args(kwargs):
@@ -305,25 +1170,57 @@ def expand_memoize_args(kwargs):
     if any(x not in memoize_default_options for x in iterkeys(kwargs)):
         raise TypeError("Received unexpected arguments to @memoize")
 
+    # The sweeper expires entries from another thread, so the cache must be thread safe
+    if kwargs['until'] and kwargs['sweep_interval'] and kwargs['backend'] == 'local':
+        kwargs['threads'] = True
+
     return kwargs
 
 
 def memoize(**kwargs):
     """
-    Memoize Function.
+    Memoize Function.  Coroutine functions are memoized by their awaited result: concurrent awaits
+    for the same arguments share one call, and exceptions are not cached.
     Arguments:
-        until:        func, memoize until time specified (seconds, using time.time)
-        disable_kw    bool, do not memoize around kwargs.  This is a significant performance benefit.
+        until:        func, memoize until time specified (seconds, using time.time).  Expired entries are
+                            removed on write, or in the background with sweep_interval.
+        stale_while_revalidate: seconds after expiration that a stale result may still be returned.  With
+                            threads, one caller refreshes it while concurrent callers get the stale result.
+        sweep_interval: seconds between removals of expired entries by a background thread (0 for none).
+                            Sweeping needs a thread safe cache, so it implies threads=True.
+        disable_kw    bool, do not memoize around kwargs.  Otherwise the wrapper has the same signature as the function
+                            and binds every argument to its parameter, so f(1, 2) and f(1, b=2) share a key.
         ignore_nulls: bool, do not store null values in the cache.  This can cause later lookups for the same key.
+        negative_until: func, cache None results until the time specified, separately from other results.  Hits
+                            on them are reported as negative hits.
+        negative_size: int, maximum number of None results to cache (LRU ejection).  Setting either negative
+                            option caches None results apart from the rest, and ignore_nulls no longer applies.
         verbose:      bool, print the constructed memoize function and cache obj
-        threads:      bool, thread safety locks around updating cache
+        threads:      bool, thread safe cache.  Concurrent calls for the same arguments compute the result once,
+                            while calls for different arguments compute in parallel.
+        shards:       int,  number of independently locked shards in a threads=True cache.  max_size and
+                            max_bytes are split evenly between the shards.
         obj:          bool, memoize to the first argument (generally, self) instead of the global cache.
                             This cache can be cleared by calling obj.__memoize_cache__.clear(), and will not be
                             cleared when clearing the global cache.
-        max_bytes:    int,  maximum number of bytes to keep in the cache, as calculated by sys.getsizeof(result).
-                            Items are evicted in LRU order.
-        max_size      int,  maximum number of items to keep in the cache.  Items are evicted in LRU order.
+        max_bytes:    int,  maximum number of bytes to keep in the cache, as calculated by sizeof.
+                            Items are evicted in policy order.  The cache's current_size is its byte total.
+        max_size      int,  maximum number of items to keep in the cache.  Items are evicted in policy order.
+        sizeof:       str,  how max_bytes sizes results: 'deep' (default, the result and everything it references),
+                            'pickle' (length of the pickled result), 'shallow' (sys.getsizeof), or a func(result)
+        policy:       str,  eviction order for max_size and max_bytes: 'lru' (least recently used, refreshed on hit),
+                            'lfu' (least frequently used) or 'slru' (segmented LRU, which resists scans)
         disabled      bool, disable memoization and return the original function instead of the memoize wrapper
+        backend:      str,  'local' (default) or 'shm', a cache of pickled results in shared memory which is shared
+                            by every process on the host using the same name.  max_bytes sets its size (default 64MB)
+                            and max_size its number of slots.  Results larger than a slot are not cached.  Slots
+                            are evicted in CLOCK order, so policy must be 'lru', and sizeof may only be 'pickle'.
+        name:         str,  name of a 'shm' or persisted cache (defaults to the function's module and name)
+        persist:      str,  path of a sqlite file used as a second cache tier which outlives the process.  Misses in
+                            memory are read from disk before calling the function.  Keys and results are pickled, and
+                            results which can't be pickled are only cached in memory.
+        persist_bytes: int, maximum size of the persisted results, with least recently used results deleted (default 256MB)
+        prewarm:      int,  number of the most read persisted results to load into memory when the function is decorated
 
     Examples:
 
@@ -358,90 +1255,280 @@ def memoize(**kwargs):
 
 memoize_property = memoize(obj=True)
 
+class ThreadLocalVar(object):
+    """
+    Stands in for contextvars.ContextVar where it doesn't exist (python < 3.7), with a value per thread.
+    """
+    def __init__(self, name, default = None):
+        self.local   = threading.local()
+        self.default = default
+
+    def get(self):
+        return getattr(self.local, 'value', self.default)
+
+    def set(self, value):
+        self.local.value = value
+
+class BenchStats(object):
+    """
+        The results of one benchmarked function or scope.  Times are in nanoseconds.
+            calls:        number of calls
+            inclusive_ns: time spent in the function, including the functions it called.  Recursive
+                          calls are only counted once.
+            self_ns:      time spent in the function, excluding benchmarked functions it called
+            latency:      Percentile of the inclusive time of each call
+            threads:      Counter of calls by thread ident (see BenchResults.thread_names)
+    """
+    def __init__(self, name):
+        self.name = name
+        self.clear()
+
+    def clear(self):
+        self.calls        = 0
+        self.inclusive_ns = 0
+        self.self_ns      = 0
+        self.latency      = Percentile()
+        self.threads      = collections.Counter()
+
+class BenchNode(object):
+    """
+        A stack of benchmarked calls, with the self time spent at the top of it.
+    """
+    __slots__ = ( 'stats', 'parent', 'children', 'self_ns', 'recursive' )
+
+    def __init__(self, stats, parent):
+        self.stats     = stats
+        self.parent    = parent
+        self.children  = {}
+        self.self_ns   = 0
+        self.recursive = False
+
+        node = parent
+        while node:
+            self.recursive = self.recursive or node.stats is stats
+            node = node.parent
+
+    def names(self):
+        return (self.parent.names() if self.parent else ()) + (self.stats.name,)
+
 class BenchResults(object):
     """
         Acts as a storage container for all benchmark results.
 
+        Benchmarked functions and scopes nest: the current scope is kept in a ContextVar, so each call
+        knows its caller in the same thread or asyncio task, and time spent in benchmarked callees is
+        subtracted from the caller's self time.  Time is measured with time.perf_counter_ns.
+
         Expected usage:
 
         @benchmark
         def foo():
-            print 'called foo!'
+            with bench_scope('foo.loop'):
+                ...
 
         for x in range(100):
             foo()
 
-        print BenchResults().format_stats() # Text table pretty
-        print BenchResults().format_csv() # For CSV
+        print BenchResults.format_stats() # Text table pretty
+        print BenchResults.format_csv() # For CSV
+        print BenchResults.format_collapsed() # For flamegraph.pl
     """
-    results = {}
+    results      = {}
+    roots        = {}
+    thread_names = {}
+    lock         = threading.Lock()
+    scope        = contextvars.ContextVar(str('wizzat_bench_scope'), default = None) if contextvars else ThreadLocalVar('wizzat_bench_scope')
+    headers      = [
+        'Function',
+        'Calls',
+        'Inclusive (ms)',
+        'Self (ms)',
+        'p50 (us)',
+        'p98 (us)',
+        'Max (us)',
+        'Threads',
+    ]
 
     @classmethod
-    def format_stats(cls, skip_no_calls = False):
+    def stats_for(cls, key, name):
+        with cls.lock:
+            if key not in cls.results:
+                cls.results[key] = BenchStats(name)
+            return cls.results[key]
+
+    @classmethod
+    def enter(cls, stats):
+        """
+            Starts a call of stats in the current scope.  Returns (parent, frame) for exit().
+        """
+        parent = cls.scope.get()
+        children = parent[1].children if parent else cls.roots
+        node = children.get(stats)
+        if node is None:
+            with cls.lock:
+                node = children.setdefault(stats, BenchNode(stats, parent[1] if parent else None))
+
+        # Frames are [ stats, stack node, start time, time spent in benchmarked callees ]
+        frame = [ stats, node, perf_counter_ns(), 0 ]
+        cls.scope.set(frame)
+        return parent, frame
+
+    @classmethod
+    def exit(cls, parent, frame):
+        elapsed = perf_counter_ns() - frame[2]
+        cls.scope.set(parent)
+
+        stats, node = frame[0], frame[1]
+        if parent:
+            parent[3] += elapsed
+
+        # Callees in concurrent asyncio tasks can outlast the caller
+        self_ns = max(0, elapsed - frame[3])
+        ident = get_ident()
+        with cls.lock:
+            stats.calls += 1
+            if not node.recursive:
+                stats.inclusive_ns += elapsed
+            stats.self_ns += self_ns
+            stats.latency.add_value(elapsed)
+            stats.threads[ident] += 1
+            node.self_ns += self_ns
+
+            if ident not in cls.thread_names:
+                cls.thread_names[ident] = threading.current_thread().name
+
+    @classmethod
+    def rows(cls, skip_no_calls = False):
         rows = []
-        for k, v in sorted(iteritems(cls.results), key=lambda x: x[1][1]):
-            if skip_no_calls and calls == 0:
+        for stats in sorted(cls.results.values(), key=lambda x: x.inclusive_ns):
+            if skip_no_calls and stats.calls == 0:
                 continue
 
-            func, cume_duration, calls = v
-            rows.append([ k.__name__, cume_duration, calls ])
+            # Percentiles are approximate, so keep them from exceeding the exact max
+            max_ns = stats.latency.percentile(1.0) or 0
+            rows.append([
+                stats.name,                                                             # 'Function',
+                stats.calls,                                                            # 'Calls',
+                '{:.3f}'.format(stats.inclusive_ns / 1e6),                              # 'Inclusive (ms)',
+                '{:.3f}'.format(stats.self_ns / 1e6),                                   # 'Self (ms)',
+                '{:.1f}'.format(min(max_ns, stats.latency.percentile(0.5) or 0) / 1e3), # 'p50 (us)',
+                '{:.1f}'.format(min(max_ns, stats.latency.percentile(0.98) or 0) / 1e3),# 'p98 (us)',
+                '{:.1f}'.format(max_ns / 1e3),                                          # 'Max (us)',
+                ' '.join('{}={}'.format(cls.thread_names.get(ident, ident), calls)      # 'Threads',
+                    for ident, calls in stats.threads.most_common(3)),
+            ])
 
-        table = wizzat.textutil.text_table([
-            'Function',
-            'Sum Duration',
-            'Calls',
-        ], rows)
+        return rows
 
+    @classmethod
+    def format_stats(cls, skip_no_calls = False):
+        """
+            Returns a text table of the results, with the most calls by thread name.
+        """
+        table = wizzat.textutil.text_table(cls.headers, cls.rows(skip_no_calls))
         return "Benchmark Results\n\n" + table
 
     @classmethod
     def format_csv(cls, skip_no_calls = False):
         fp = io.StringIO()
 
-        fp.write(", ".join([
-            'Function',
-            'Sum Duration',
-            'Calls',
-        ]))
+        fp.write(",".join(cls.headers))
         fp.write("\n")
 
-        for k, v in sorted(iteritems(cls.results), key=lambda x: x[1][1]):
-            if skip_no_calls and calls == 0:
-                continue
-
-            func, cume_duration, calls = v
-            fp.write(", ".join([ str(x) for x in [ k.__name__, cume_duration, calls ] ]))
+        for row in cls.rows(skip_no_calls):
+            fp.write(",".join([ str(x) for x in row ]))
             fp.write("\n")
 
+        return fp.getvalue()
+
+    @classmethod
+    def format_collapsed(cls):
+        """
+            Returns the self time of each stack of benchmarked calls in microseconds, in the collapsed
+            stack format read by flamegraph.pl and speedscope:
+
+            main;load;parse 1234
+        """
+        stacks = sorted(iteritems(cls.stacks()))
+        return "".join("{} {}\n".format(";".join(stack), self_ns // 1000) for stack, self_ns in stacks)
+
+    @classmethod
+    def stacks(cls):
+        """
+            Returns { (name, ...) : self time in nanoseconds } for each stack of benchmarked calls.
+            Stacks without time since the last clear() are left out.
+        """
+        with cls.lock:
+            nodes = list(cls.roots.values())
+            stacks = {}
+            while nodes:
+                node = nodes.pop()
+                if node.self_ns:
+                    stacks[node.names()] = node.self_ns
+                nodes.extend(node.children.values())
+
+        return stacks
+
     @classmethod
     def clear(cls):
-        for func, stats in iteritems(cls.results):
-            stats[1] = 0
-            stats[2] = 0
+        """
+            Resets every function's stats and stack's self time.  The stack nodes are kept, because calls
+            which are still running hold them and record their time to them when they finish.
+        """
+        with cls.lock:
+            for stats in cls.results.values():
+                stats.clear()
+
+            nodes = list(cls.roots.values())
+            while nodes:
+                node = nodes.pop()
+                node.self_ns = 0
+                nodes.extend(node.children.values())
 
 def benchmark(obj):
     """
-        Decorator for capturing function call duration and number of calls.
+        Decorator for capturing the self and inclusive time, latency percentiles and calling threads
+        of a function.  Coroutine functions are timed until their result is awaited.
 
         Works with BenchResults for display purposes.
     """
-    bench_results = obj.bench_results = BenchResults.results[obj] = [ str(obj), 0, 0]
+    name = getattr(obj, '__qualname__', obj.__name__)
+    stats = obj.bench_results = BenchResults.stats_for(obj, name)
+    enter, exit = BenchResults.enter, BenchResults.exit
+
+    if getattr(inspect, 'iscoroutinefunction', lambda x: False)(obj):
+        namespace = { 'obj' : obj, 'stats' : stats, 'enter' : enter, 'exit' : exit }
+        exec_("""
+async def benchmarker(*args, **kwargs):
+    parent, frame = enter(stats)
+    try:
+        return await obj(*args, **kwargs)
+    finally:
+        exit(parent, frame)
+""", namespace)
+        return functools.wraps(obj)(namespace['benchmarker'])
 
     @functools.wraps(obj)
     def benchmarker(*args, **kwargs):
-        start_time = time.time()
-
-        retval = obj(*args, **kwargs)
-
-        delta = time.time() - start_time
-
-        bench_results[1] += delta
-        bench_results[2] += 1
-
-        return retval
+        parent, frame = enter(stats)
+        try:
+            return obj(*args, **kwargs)
+        finally:
+            exit(parent, frame)
 
     return benchmarker
 
+@contextlib.contextmanager
+def bench_scope(name):
+    """
+        Benchmarks a block as if it were a function called name, nested in the current scope.
+    """
+    parent, frame = BenchResults.enter(BenchResults.stats_for(name, name))
+    try:
+        yield
+    finally:
+        BenchResults.exit(parent, frame)
+
 class TailRecurseException(Exception):
     def __init__(self, args, kwargs):
         self.args   = args
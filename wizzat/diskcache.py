@@ -0,0 +1,280 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import atexit
+import contextlib
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import weakref
+
+from wizzat.shmcache import SharedMemoryCache
+from wizzat.util import swallow
+
+__all__ = [
+    'DiskCache',
+]
+
+def flush_at_exit(ref):
+    cache = ref()
+    if cache is not None:
+        swallow(Exception, cache.flush)
+
+class DiskCache(object):
+    """
+        A dict-like cache of pickled values in a sqlite file, which outlives the process.
+        Used as the second tier of memoize(persist=path).
+
+        Keys are stored by the md5 of their pickle, with functions in keys identified by name (as in
+        SharedMemoryCache), so any process memoizing the same function reads the same entries.  Several
+        caches may share one file: each entry is tagged with the cache's name.
+
+        Entries count how often they are read back from disk, and hottest() returns the most read entries
+        to prewarm a new process.  Reads are counted in memory and written access_batch at a time (and at
+        exit), so a disk hit doesn't cost a write transaction.  When the cache's entries hold more than max_bytes of
+        values the least recently used of them are deleted.
+
+        Arguments:
+            filename    - the sqlite file, which is created if it doesn't exist
+            name        - identifies the cache's entries in the file
+            max_bytes   - total size of the pickled values (default 256MB)
+            until       - func returning the expiration time of a new value
+    """
+    schema = [
+        """
+            CREATE TABLE IF NOT EXISTS memoize (
+                key_hash    BLOB PRIMARY KEY,
+                name        TEXT NOT NULL,
+                key         BLOB NOT NULL,
+                value       BLOB NOT NULL,
+                size        INTEGER NOT NULL,
+                expiration  REAL NOT NULL,
+                hits        INTEGER NOT NULL DEFAULT 0,
+                accessed    REAL NOT NULL
+            )
+        """,
+        "CREATE INDEX IF NOT EXISTS memoize_hits_idx ON memoize (name, hits)",
+        "DROP INDEX IF EXISTS memoize_accessed_idx",
+        "CREATE INDEX IF NOT EXISTS memoize_name_accessed_idx ON memoize (name, accessed)",
+    ]
+    access_batch = 100
+
+    def __init__(self, filename, name, max_bytes = 0, until = None):
+        self.filename    = filename
+        self.name        = name
+        self.max_bytes   = max_bytes or 256 * 1024 * 1024
+        self.expire_func = until
+        self.size        = None
+        self.lock        = threading.Lock()
+        self.connect()
+
+        atexit.register(flush_at_exit, weakref.ref(self))
+
+    def connect(self):
+        self.pid  = os.getpid()
+        self.accesses = {}
+        self.conn = sqlite3.connect(self.filename, timeout = 30, isolation_level = None, check_same_thread = False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        for sql in self.schema:
+            self.conn.execute(sql)
+
+    @contextlib.contextmanager
+    def cursor(self):
+        # sqlite connections can't be shared with a forked child, so reconnect after a fork
+        with self.lock:
+            if self.pid != os.getpid():
+                self.connect()
+            yield self.conn
+
+    @staticmethod
+    def key_bytes(key):
+        key_bytes = SharedMemoryCache.key_bytes(key)[0]
+        return key_bytes, sqlite3.Binary(hashlib.md5(key_bytes).digest())
+
+    def __getitem__(self, key):
+        return self.lookup(key)[1]
+
+    def lookup(self, key):
+        """
+            Returns (expiration, value) for the key, so a copy of the value can keep its original expiration.
+        """
+        key_bytes, key_hash = self.key_bytes(key)
+        with self.cursor() as conn:
+            row = conn.execute("SELECT key, value, expiration FROM memoize WHERE key_hash = ?", (key_hash,)).fetchone()
+            if row is None or bytes(row[0]) != key_bytes:
+                raise KeyError(key)
+
+            now = time.time()
+            if row[2] and row[2] < now:
+                conn.execute("DELETE FROM memoize WHERE key_hash = ?", (key_hash,))
+                raise KeyError(key)
+
+            hits = self.accesses.get(key_hash, (0, now))[0]
+            self.accesses[key_hash] = (hits + 1, now)
+            if len(self.accesses) >= self.access_batch:
+                self.write_accesses(conn)
+
+        try:
+            return row[2], pickle.loads(bytes(row[1]))
+        except Exception:
+            # The value's class has changed or gone away since it was stored
+            with self.cursor() as conn:
+                conn.execute("DELETE FROM memoize WHERE key_hash = ?", (key_hash,))
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            key_bytes, key_hash = self.key_bytes(key)
+            value_bytes = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # Values which can't be pickled are only cached in memory
+            return
+
+        if len(value_bytes) > self.max_bytes:
+            return
+
+        expiration = self.expire_func() if self.expire_func else 0
+        with self.cursor() as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO memoize (key_hash, name, key, value, size, expiration, hits, accessed)
+                VALUES (?, ?, ?, ?, ?, ?, COALESCE((SELECT hits FROM memoize WHERE key_hash = ?), 0), ?)
+            """, (key_hash, self.name, sqlite3.Binary(key_bytes), sqlite3.Binary(value_bytes), len(value_bytes), expiration, key_hash, time.time()))
+
+            if self.size is not None:
+                self.size += len(value_bytes)
+            self.evict(conn)
+
+    def flush(self):
+        """
+            Writes the reads counted since the last write.
+        """
+        with self.cursor() as conn:
+            self.write_accesses(conn)
+
+    def write_accesses(self, conn):
+        """
+            Writes the hit counts and access times of the reads since the last write in one transaction.
+        """
+        if not self.accesses:
+            return
+
+        conn.execute("BEGIN")
+        try:
+            conn.executemany("UPDATE memoize SET hits = hits + ?, accessed = MAX(accessed, ?) WHERE key_hash = ?",
+                [ (hits, accessed, key_hash) for key_hash, (hits, accessed) in self.accesses.items() ])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            self.accesses = {}
+
+    def evict(self, conn):
+        """
+            Deletes this cache's least recently used entries until they hold at most 90% of max_bytes.
+            The size is only summed from the file when the running estimate (which doesn't see
+            other processes' writes and deletes) exceeds max_bytes.
+        """
+        if self.size is None or self.size > self.max_bytes:
+            self.size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM memoize WHERE name = ?", (self.name,)).fetchone()[0]
+
+        if self.size <= self.max_bytes:
+            return
+
+        self.write_accesses(conn)
+        target = self.size - int(self.max_bytes * 0.9)
+        evicted = []
+        for key_hash, size in conn.execute("SELECT key_hash, size FROM memoize WHERE name = ? ORDER BY accessed", (self.name,)):
+            if target <= 0:
+                break
+            evicted.append((key_hash,))
+            target -= size
+            self.size -= size
+
+        conn.executemany("DELETE FROM memoize WHERE key_hash = ?", evicted)
+
+    def __delitem__(self, key):
+        _, key_hash = self.key_bytes(key)
+        with self.cursor() as conn:
+            if not conn.execute("DELETE FROM memoize WHERE key_hash = ?", (key_hash,)).rowcount:
+                raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def __len__(self):
+        with self.cursor() as conn:
+            return conn.execute("SELECT COUNT(*) FROM memoize WHERE name = ?", (self.name,)).fetchone()[0]
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+            del self[key]
+            return value
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+
+    def hottest(self, count):
+        """
+            Returns [ (key, expiration, value) ] for the count most read unexpired entries.  Functions in
+            the keys are replaced by their names.
+        """
+        with self.cursor() as conn:
+            self.write_accesses(conn)
+            rows = conn.execute("""
+                SELECT key, expiration, value
+                FROM memoize
+                WHERE name = ?
+                    AND (expiration = 0 OR expiration > ?)
+                ORDER BY hits DESC, accessed DESC
+                LIMIT ?
+            """, (self.name, time.time(), count)).fetchall()
+
+        entries = []
+        for key_bytes, expiration, value_bytes in rows:
+            try:
+                entries.append((pickle.loads(bytes(key_bytes)), expiration, pickle.loads(bytes(value_bytes))))
+            except Exception:
+                pass
+
+        return entries
+
+    def expire(self, now = None):
+        """
+            Deletes expired entries, and returns how many were deleted.
+        """
+        now = now or time.time()
+        with self.cursor() as conn:
+            return conn.execute("DELETE FROM memoize WHERE name = ? AND expiration > 0 AND expiration < ?", (self.name, now)).rowcount
+
+    def clear(self):
+        """
+            Deletes every entry for this cache's name.
+        """
+        with self.cursor() as conn:
+            conn.execute("DELETE FROM memoize WHERE name = ?", (self.name,))
+            self.size = None
+
+    @property
+    def current_size(self):
+        with self.cursor() as conn:
+            return conn.execute("SELECT COALESCE(SUM(size), 0) FROM memoize WHERE name = ?", (self.name,)).fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self.conn.close()
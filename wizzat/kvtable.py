@@ -50,11 +50,15 @@ class KVTableMeta(type):
             cls.id_cache = wizzat.decorators.create_cache_obj(
                 max_size  = dct.get('memoize_size', 0),
                 max_bytes = dct.get('memoize_bytes', 0),
+                backend   = dct.get('memoize_backend', 'local'),
+                name      = '{}_id_cache'.format(dct['table_name']),
             )
 
             cls.key_cache = wizzat.decorators.create_cache_obj(
                 max_size  = dct.get('memoize_size', 0),
                 max_bytes = dct.get('memoize_bytes', 0),
+                backend   = dct.get('memoize_backend', 'local'),
+                name      = '{}_key_cache'.format(dct['table_name']),
             )
 
 
@@ -98,6 +102,8 @@ class KVTable(with_metaclass(KVTableMeta)):
     memoize_bytes:      int, maximum size objects to cache from the database (LRU ejection).
                         Note that there are two caches, and while references are shared the
                         cache size here is not absolute.
+    memoize_backend:    string, 'local' or 'shm' to share the caches between processes on the host
+                        (see memoize).  Cached objects are copies rather than shared references.
     default_{field}:    func, define functions for default behaviors.  These functions are executed
                         in order of definition in the fields array.
     """
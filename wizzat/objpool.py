@@ -4,8 +4,15 @@ from builtins import *
 import collections
 import contextlib
 import itertools
+import linecache
+import logging
+import random
+import sys
 import threading
-from wizzat.util import set_strict_defaults
+import time
+import traceback
+from wizzat.mathutil import Percentile
+from wizzat.util import set_strict_defaults, swallow
 
 __all__ = [
     'ObjPool',
@@ -15,13 +22,28 @@ __all__ = [
     'ObjPoolOwnershipError',
 ]
 
+def capture_stack(frame):
+    """
+    Returns (filename, line number, function name) for frame and its callers, outermost first.
+    Source lines aren't read until the stack is formatted.
+    """
+    stack = []
+    while frame is not None:
+        stack.append((frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def format_stack(stack):
+    return traceback.format_list([ (filename, lineno, name, linecache.getline(filename, lineno).strip() or None) for filename, lineno, name in stack ])
+
 class ObjPoolError(Exception):
     pass
 
 
 class ObjPoolExhausted(ObjPoolError):
     """
-    All objects the pool owns are in use.
+    All objects the pool owns are in use, and none was returned before the timeout.
     """
     pass
 
@@ -45,20 +67,66 @@ class ObjPool(object):
         """
             An object pool with naming support.
             Paramters:
-                min_objs: The minimum number of objects to have available
-                max_objs: The maximum number of objects to have available
+                min_objs:      The minimum number of objects to have available
+                max_objs:      The maximum number of objects to have available
+                timeout:       Seconds to wait for an object when all are in use.  0 raises
+                               ObjPoolExhausted immediately, and None waits forever.
+                max_waiters:   The maximum number of threads waiting for an object (None for no limit).
+                               Further requests raise ObjPoolExhausted immediately.
+
+                max_lifetime:  Seconds after creation that an object is closed instead of reused (None for no limit)
+                max_idle:      Seconds an object may sit unused in the pool before it is closed (None for no limit)
+                reap_interval: Seconds between runs of a background thread which closes expired objects and
+                               creates new ones to maintain min_objs (None for no thread)
+
+                leak_threshold:   Seconds an object may be held before it is reported by find_leaks() and
+                                  logged by the reaper thread (None to disable)
+                leak_sample_rate: Fraction of acquisitions which record the acquiring stack for leak reports
+
+            Waiting threads are served in FIFO order.  Objects are checked with check_func before they are
+            handed out, and objects which fail the check are closed with close_func and replaced.
+            new_func, check_func and put_func run without the pool's lock held, so a slow one only
+            blocks the thread calling it.
         """
         kwargs = set_strict_defaults(kwargs,
-            min_objs = 0,
-            max_objs = 1,
+            min_objs         = 0,
+            max_objs         = 1,
+            timeout          = 0,
+            max_waiters      = None,
+            max_lifetime     = None,
+            max_idle         = None,
+            reap_interval    = None,
+            leak_threshold   = None,
+            leak_sample_rate = 0.1,
         )
 
-        self.lock     = threading.RLock()
-        self.ready    = collections.deque()
-        self.in_use   = set()
-        self.names    = set()
-        self.min_objs = kwargs['min_objs']
-        self.max_objs = kwargs['max_objs']
+        self.lock          = threading.RLock()
+        self.cond          = threading.Condition(self.lock)
+        self.ready         = collections.deque()
+        self.in_use        = set()
+        self.names         = set()
+        self.waiters       = collections.deque()
+        self.pending       = 0
+        self.min_objs      = kwargs['min_objs']
+        self.max_objs      = kwargs['max_objs']
+        self.timeout       = kwargs['timeout']
+        self.max_waiters   = kwargs['max_waiters']
+        self.max_lifetime  = kwargs['max_lifetime']
+        self.max_idle      = kwargs['max_idle']
+        self.reap_interval = kwargs['reap_interval']
+        self.created_at    = {}
+        self.returned_at   = {}
+        self.reaper        = None
+        self.reaper_stop   = threading.Event()
+
+        self.leak_threshold   = kwargs['leak_threshold']
+        self.leak_sample_rate = kwargs['leak_sample_rate']
+        self.acquired_at      = {}
+        self.acquire_stacks   = {}
+        self.reported_leaks   = set()
+        self.counts           = collections.Counter()
+        self.wait_us          = Percentile()
+        self.hold_us          = Percentile()
 
         if self.max_objs < self.min_objs:
             raise ValueError('max_objs {} < min_objs {}'.format(
@@ -70,20 +138,37 @@ class ObjPool(object):
         for obj in objs:
             self.yield_obj(obj)
 
+        if self.reap_interval:
+            self.reaper = threading.Thread(target = self.reap_forever, name = 'ObjPool reaper')
+            self.reaper.daemon = True
+            self.reaper.start()
+
     def new_func(self):
         return object()
 
     def put_func(self, obj):
         return
 
+    def check_func(self, obj):
+        """
+            Returns whether a ready object is still usable.  Called before the object is handed out.
+        """
+        return True
+
+    def close_func(self, obj):
+        return
+
     @contextlib.contextmanager
-    def obj_from_pool(self):
+    def obj_from_pool(self, **kwargs):
         """
-            Get an object from the pool, and put it back when finished.
+            Get an object from the pool, and put it back when finished (even if the block raises).
+            Accepts the same arguments as new_obj.
         """
-        obj = self.new_obj()
-        yield obj
-        self.yield_obj(obj)
+        obj = self.new_obj(**kwargs)
+        try:
+            yield obj
+        finally:
+            self.yield_obj(obj)
 
     def name(self, name, obj = None):
         """
@@ -98,9 +183,20 @@ class ObjPool(object):
             elif existing_obj and existing_obj != obj:
                 raise ObjPoolNameError(name)
 
-            if not obj:
-                obj = self.new_obj()
+        if not obj:
+            # Get the object without holding the lock, and give it back if another thread named one first
+            obj = self.new_obj()
+            with self.lock:
+                existing_obj = getattr(self, name, None)
+                if not existing_obj:
+                    self.names.add(name)
+                    setattr(self, name, obj)
+                    return obj
 
+            self.yield_obj(obj)
+            return existing_obj
+
+        with self.lock:
             if obj not in self.in_use:
                 raise ObjPoolOwnershipError()
 
@@ -120,42 +216,301 @@ class ObjPool(object):
 
             self.names.remove(name)
             delattr(self, name)
-            self.yield_obj(obj)
 
-    def new_obj(self):
+        self.yield_obj(obj)
+
+    def new_obj(self, **kwargs):
         """
-            Gets an object from the pool.
+            Gets an object from the pool, waiting for one to be returned if all are in use.
+            Parameters:
+                timeout: Overrides the pool's timeout
         """
-        with self.lock:
-            if self.ready:
-                obj = self.ready.popleft()
-            elif len(self.in_use) < self.max_objs:
-                obj = self.new_func()
-            else:
+        kwargs = set_strict_defaults(kwargs,
+            timeout = self.timeout,
+        )
+
+        start = time.time()
+        with self.cond:
+            try:
+                obj = self.wait_for_obj(kwargs['timeout'])
+            except ObjPoolExhausted:
+                self.counts['exhausted'] += 1
+                raise
+
+        obj = self.check_out(obj)
+
+        with self.cond:
+            self.wait_us.add_value(max(0, int((time.time() - start) * 1000000)))
+            return obj
+
+    def wait_for_obj(self, timeout):
+        with self.cond:
+            # Don't jump the queue ahead of threads that are already waiting
+            if not self.waiters and self.available():
+                return self.take_obj()
+
+            if timeout == 0:
                 raise ObjPoolExhausted()
 
+            if self.max_waiters is not None and len(self.waiters) >= self.max_waiters:
+                raise ObjPoolExhausted()
+
+            ticket = object()
+            deadline = None if timeout is None else time.time() + timeout
+            self.waiters.append(ticket)
+
+            try:
+                while self.waiters[0] is not ticket or not self.available():
+                    if deadline is None:
+                        self.cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise ObjPoolExhausted()
+                        self.cond.wait(remaining)
+
+                return self.take_obj()
+            finally:
+                self.waiters.remove(ticket)
+                self.cond.notify_all()
+
+    def available(self):
+        return bool(self.ready) or len(self.in_use) + self.pending < self.max_objs
+
+    def take_obj(self):
+        """
+            Claims a ready object, or returns None after claiming capacity to create one.  Called with
+            the lock held: the claimed object is checked (or created) by check_out after it is released.
+        """
+        if self.ready:
+            obj = self.ready.popleft()
             self.in_use.add(obj)
             return obj
 
+        self.pending += 1
+        return None
+
+    def check_out(self, obj):
+        """
+            Checks a claimed ready object, replacing it while it fails, or creates an object for claimed capacity.
+        """
+        while obj is not None:
+            try:
+                if not self.is_expired(obj) and self.check_func(obj):
+                    break
+            except Exception:
+                self.discard_obj(obj)
+                raise
+
+            with self.cond:
+                self.forget_obj(obj)
+                failed, obj = obj, self.take_obj()
+            swallow(Exception, self.close_func, failed)
+
+        if obj is None:
+            try:
+                obj = self.create_obj()
+            finally:
+                with self.cond:
+                    self.pending -= 1
+                    self.cond.notify_all()
+
+        with self.cond:
+            self.returned_at.pop(obj, None)
+            self.in_use.add(obj)
+
+            self.counts['acquired'] += 1
+            self.acquired_at[obj] = time.time()
+            if self.leak_threshold is not None and random.random() < self.leak_sample_rate:
+                # Skip check_out and new_obj
+                self.acquire_stacks[obj] = capture_stack(sys._getframe(2))
+
+        return obj
+
+    def create_obj(self):
+        obj = self.new_func()
+        with self.cond:
+            self.created_at[obj] = time.time()
+            self.counts['created'] += 1
+        return obj
+
+    def is_expired(self, obj, now = None):
+        now = now or time.time()
+        if self.max_lifetime is not None and now - self.created_at.get(obj, now) > self.max_lifetime:
+            return True
+
+        if self.max_idle is not None and now - self.returned_at.get(obj, now) > self.max_idle:
+            return True
+
+        return False
+
+    def discard_obj(self, obj):
+        """
+            Removes an object from the pool entirely and closes it.
+        """
+        with self.cond:
+            self.forget_obj(obj)
+
+        swallow(Exception, self.close_func, obj)
+
+    def forget_obj(self, obj):
+        swallow(ValueError, self.ready.remove, obj)
+        self.in_use.discard(obj)
+        self.created_at.pop(obj, None)
+        self.returned_at.pop(obj, None)
+        self.acquired_at.pop(obj, None)
+        self.acquire_stacks.pop(obj, None)
+        self.counts['evicted'] += 1
+        self.cond.notify_all()
+
+    def reap(self):
+        """
+            Closes expired objects in the ready queue and creates objects until there are min_objs.
+        """
+        with self.cond:
+            now = time.time()
+            expired = [ x for x in self.ready if self.is_expired(x, now) ]
+            for obj in expired:
+                self.forget_obj(obj)
+
+        for obj in expired:
+            swallow(Exception, self.close_func, obj)
+
+        while True:
+            with self.cond:
+                if len(self.ready) + len(self.in_use) + self.pending >= self.min_objs:
+                    return
+                self.pending += 1
+
+            try:
+                obj = self.create_obj()
+            except Exception:
+                with self.cond:
+                    self.pending -= 1
+                    self.cond.notify_all()
+                raise
+
+            with self.cond:
+                self.pending -= 1
+                self.returned_at[obj] = time.time()
+                self.ready.append(obj)
+                self.cond.notify_all()
+
+    def reap_forever(self):
+        while not self.reaper_stop.wait(self.reap_interval):
+            swallow(Exception, self.reap)
+            swallow(Exception, self.log_leaks)
+
+    def find_leaks(self):
+        """
+            Returns (obj, seconds held, acquiring stack or None) for objects held longer than leak_threshold.
+        """
+        if self.leak_threshold is None:
+            return []
+
+        with self.cond:
+            now = time.time()
+            leaks = [
+                (obj, now - acquired_at, self.acquire_stacks.get(obj))
+                for obj, acquired_at in self.acquired_at.items()
+                if now - acquired_at > self.leak_threshold
+            ]
+
+        return [ (obj, held, format_stack(stack) if stack else None) for obj, held, stack in leaks ]
+
+    def log_leaks(self):
+        """
+            Logs each leaked object once per acquisition.
+        """
+        leaks = { (obj, self.acquired_at.get(obj)) : (held, stack) for obj, held, stack in self.find_leaks() }
+        for (obj, acquired_at), (held, stack) in leaks.items():
+            if (obj, acquired_at) not in self.reported_leaks:
+                logging.warning("Pool object %r held for %.1fs, acquired at:\n%s", obj, held,
+                    ''.join(stack) if stack else '(stack not sampled)')
+
+        self.reported_leaks = set(leaks)
+
+    def stats(self):
+        """
+            Returns a snapshot of the pool's size, utilization and counters, plus percentiles of
+            the time spent waiting for an object and holding it (in microseconds).
+        """
+        with self.cond:
+            def percentiles(p):
+                return { pct : p.percentile(pct) for pct in (0.5, 0.98, 1.0) }
+
+            return {
+                'ready'       : len(self.ready),
+                'in_use'      : len(self.in_use),
+                'waiters'     : len(self.waiters),
+                'utilization' : 1.0 * len(self.in_use) / self.max_objs if self.max_objs else 0.0,
+                'acquired'    : self.counts['acquired'],
+                'created'     : self.counts['created'],
+                'evicted'     : self.counts['evicted'],
+                'exhausted'   : self.counts['exhausted'],
+                'wait_us'     : percentiles(self.wait_us),
+                'hold_us'     : percentiles(self.hold_us),
+            }
+
+    def close(self):
+        """
+            Stops the reaper thread and closes all ready objects.
+        """
+        self.reaper_stop.set()
+        if self.reaper:
+            self.reaper.join()
+
+        with self.cond:
+            for obj in list(self.ready):
+                self.discard_obj(obj)
+
     def yield_obj(self, obj):
         """
             Puts an object back in the pool
         """
-        with self.lock:
+        with self.cond:
             try:
                 self.in_use.remove(obj)
-                self.put_func(obj)
-                self.ready.append(obj)
             except KeyError:
                 raise ObjPoolOwnershipError()
 
+            acquired_at = self.acquired_at.pop(obj, None)
+            if acquired_at is not None:
+                self.hold_us.add_value(max(0, int((time.time() - acquired_at) * 1000000)))
+            self.acquire_stacks.pop(obj, None)
+
+            # The object's capacity stays claimed while it is reset
+            self.pending += 1
+
+        try:
+            self.put_func(obj)
+            reusable = not self.is_expired(obj)
+        except Exception:
+            # The object could not be reset, so it isn't safe to reuse
+            reusable = False
+
+        with self.cond:
+            self.pending -= 1
+            if reusable:
+                self.returned_at[obj] = time.time()
+                self.ready.append(obj)
+            self.cond.notify_all()
+
+        if not reusable:
+            self.discard_obj(obj)
+
     def yield_all(self):
         with self.lock:
-            for name in list(self.names):
-                self.unname(name)
+            names = list(self.names)
+
+        for name in names:
+            swallow(ObjPoolNameError, self.unname, name)
+
+        with self.lock:
+            objs = list(self.in_use)
 
-            for obj in list(self.in_use):
-                self.yield_obj(obj)
+        for obj in objs:
+            swallow(ObjPoolOwnershipError, self.yield_obj, obj)
 
     def foreach(self, func, in_use=True):
         if in_use:
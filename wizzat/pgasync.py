@@ -0,0 +1,403 @@
+"""
+asyncio versions of the pghelper query functions and ConnMgr, built on psycopg2's async connection mode.
+
+Async connections are always in autocommit mode: issue BEGIN/COMMIT yourself for transactions.
+This module requires python 3.7+
+"""
+import asyncio
+import collections
+import contextlib
+import time
+
+import psycopg2, psycopg2.extensions, psycopg2.extras
+import wizzat.sqlhelper
+from wizzat.sqlhelper import QueryStats
+from wizzat.objpool import ObjPoolExhausted, ObjPoolOwnershipError
+from wizzat.util import set_defaults, set_strict_defaults
+
+__all__ = [
+    'AsyncConnMgr',
+    'async_pg_conn',
+    'execute',
+    'fetch_one',
+    'fetch_results',
+    'iter_results',
+    'wait',
+]
+
+async def wait(conn):
+    """
+    Polls an async connection until its current operation finishes, yielding to the event loop in between.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        elif state == psycopg2.extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError("poll() returned {}".format(state))
+
+        ready = loop.create_future()
+        add(conn.fileno(), lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(conn.fileno())
+
+async def async_pg_conn(conn_info):
+    conn_info = set_defaults(conn_info,
+        cursor_factory = psycopg2.extras.DictCursor,
+    )
+    conn_info.pop('autocommit', None)
+
+    conn = psycopg2.connect(async_ = True, **conn_info)
+    await wait(conn)
+    return conn
+
+async def _execute(conn, sql, bind_params):
+    cur = conn.cursor()
+    if wizzat.sqlhelper._log_func:
+        wizzat.sqlhelper._log_func(cur, sql, bind_params)
+
+    start = time.perf_counter()
+    try:
+        cur.execute(sql, bind_params)
+        await wait(conn)
+    except BaseException:
+        QueryStats.record(cur, sql, bind_params, time.perf_counter() - start, 0, error = True)
+        cur.close()
+        raise
+
+    QueryStats.record(cur, sql, bind_params, time.perf_counter() - start, max(cur.rowcount, 0))
+    return cur
+
+async def execute(conn, sql, **bind_params):
+    """
+    Executes a SQL command against the connection with optional bind params.
+    """
+    (await _execute(conn, sql, bind_params)).close()
+
+async def iter_results(conn, sql, **bind_params):
+    """
+    Yields the SQL results one row at a time.  The whole result set is fetched before the first row.
+    """
+    cur = await _execute(conn, sql, bind_params)
+    try:
+        for row in cur:
+            yield row
+    finally:
+        cur.close()
+
+async def fetch_results(conn, sql, **bind_params):
+    """
+    Immediately fetches the SQL results into memory
+    """
+    cur = await _execute(conn, sql, bind_params)
+    try:
+        return cur.fetchall()
+    finally:
+        cur.close()
+
+async def fetch_one(conn, sql, **bind_params):
+    """
+    Immediately fetches the SQL results into memory, and verifies that there is exactly one result
+    """
+    results = await fetch_results(conn, sql, **bind_params)
+    assert len(results) == 1
+    return results[0]
+
+
+class AsyncConnMgr(object):
+    def __init__(self, conn_info, **kwargs):
+        """
+            An asyncio pool of async psycopg2 connections.  Sizing and health checks match
+            ObjPool/ConnMgr, and waiting coroutines are served in FIFO order.  Call fill()
+            to create min_objs connections up front.
+            Parameters:
+                min_objs:          The minimum number of connections to keep available
+                max_objs:          The maximum number of connections
+                timeout:           Seconds to wait for a connection when all are in use.  0 raises
+                                   ObjPoolExhausted immediately, and None waits forever.
+                max_waiters:       The maximum number of waiting coroutines (None for no limit)
+                max_lifetime:      Seconds after creation that a connection is closed instead of reused
+                max_idle:          Seconds a connection may sit unused before it is closed
+                validate_interval: Seconds between SELECT 1 health checks of a connection before it is handed out
+
+            Example:
+
+            async with pool.acquire() as conn:
+                rows = await fetch_results(conn, "SELECT ...")
+        """
+        kwargs = set_strict_defaults(kwargs,
+            min_objs          = 0,
+            max_objs          = 1,
+            timeout           = 0,
+            max_waiters       = None,
+            max_lifetime      = None,
+            max_idle          = None,
+            validate_interval = 30,
+        )
+
+        self.conn_info         = conn_info
+        self.ready             = collections.deque()
+        self.in_use            = set()
+        self.pending           = 0
+        self.waiters           = collections.deque()
+        self.rollbacks         = set()
+        self.created_at        = {}
+        self.returned_at       = {}
+        self.validated_at      = {}
+        self.min_objs          = kwargs['min_objs']
+        self.max_objs          = kwargs['max_objs']
+        self.timeout           = kwargs['timeout']
+        self.max_waiters       = kwargs['max_waiters']
+        self.max_lifetime      = kwargs['max_lifetime']
+        self.max_idle          = kwargs['max_idle']
+        self.validate_interval = kwargs['validate_interval']
+
+        if self.max_objs < self.min_objs:
+            raise ValueError('max_objs {} < min_objs {}'.format(
+                self.max_objs,
+                self.min_objs,
+            ))
+
+    async def fill(self):
+        """
+            Creates connections until there are min_objs.
+        """
+        while len(self.ready) + len(self.in_use) + self.pending < self.min_objs:
+            self.pending += 1
+            try:
+                conn = await self.create_obj()
+            finally:
+                self.pending -= 1
+
+            self.returned_at[conn] = time.time()
+            self.ready.append(conn)
+            self.wake_waiter()
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, **kwargs):
+        """
+            Get a connection from the pool, and put it back when finished (even if the block raises).
+        """
+        conn = await self.new_obj(**kwargs)
+        try:
+            yield conn
+        finally:
+            self.yield_obj(conn)
+
+    async def new_obj(self, **kwargs):
+        """
+            Gets a connection from the pool, waiting for one to be returned if all are in use.
+            Parameters:
+                timeout: Overrides the pool's timeout
+        """
+        kwargs = set_strict_defaults(kwargs,
+            timeout = self.timeout,
+        )
+
+        # Don't jump the queue ahead of coroutines that are already waiting
+        if not self.waiters and self.available():
+            conn = await self.take_obj()
+            if conn:
+                return conn
+
+        timeout = kwargs['timeout']
+        if timeout == 0:
+            raise ObjPoolExhausted()
+
+        if self.max_waiters is not None and len(self.waiters) >= self.max_waiters:
+            raise ObjPoolExhausted()
+
+        deadline = None if timeout is None else time.time() + timeout
+        requeue = False
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            waiter = asyncio.get_running_loop().create_future()
+            if requeue:
+                self.waiters.appendleft(waiter)
+            else:
+                self.waiters.append(waiter)
+
+            finished = False
+            try:
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                finished = True
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+
+                if not waiter.done():
+                    waiter.cancel()
+                elif not finished:
+                    # Cancelled after being handed a connection or capacity, so pass it on
+                    self.release(waiter.result())
+
+            if waiter.cancelled():
+                raise ObjPoolExhausted()
+
+            # A connection is handed over directly, while None means capacity was freed
+            conn = waiter.result() or await self.take_obj()
+            if conn:
+                return conn
+
+            requeue = True
+
+    def available(self):
+        return bool(self.ready) or len(self.in_use) + self.pending < self.max_objs
+
+    async def take_obj(self):
+        while self.ready:
+            conn = self.ready.popleft()
+            self.in_use.add(conn)
+            try:
+                usable = not self.is_expired(conn) and await self.check_func(conn)
+            except BaseException:
+                # Cancelled during the check, which may have left a query running on conn
+                self.discard_obj(conn)
+                raise
+
+            if usable:
+                self.returned_at.pop(conn, None)
+                return conn
+
+            self.discard_obj(conn)
+
+        if len(self.in_use) + self.pending >= self.max_objs:
+            return None
+
+        self.pending += 1
+        try:
+            conn = await self.create_obj()
+        finally:
+            self.pending -= 1
+
+        self.in_use.add(conn)
+        return conn
+
+    async def create_obj(self):
+        conn = await async_pg_conn(self.conn_info)
+        now = time.time()
+        self.created_at[conn] = now
+        self.validated_at[conn] = now
+        return conn
+
+    async def check_func(self, conn):
+        if conn.closed:
+            return False
+
+        now = time.time()
+        if self.validate_interval is None or now - self.validated_at.get(conn, 0) < self.validate_interval:
+            return True
+
+        try:
+            await execute(conn, "SELECT 1")
+        except psycopg2.Error:
+            return False
+
+        self.validated_at[conn] = now
+        return True
+
+    def is_expired(self, conn, now = None):
+        now = now or time.time()
+        if self.max_lifetime is not None and now - self.created_at.get(conn, now) > self.max_lifetime:
+            return True
+
+        if self.max_idle is not None and now - self.returned_at.get(conn, now) > self.max_idle:
+            return True
+
+        return False
+
+    def discard_obj(self, conn):
+        """
+            Removes a connection from the pool entirely and closes it.
+        """
+        if conn in self.ready:
+            self.ready.remove(conn)
+        self.in_use.discard(conn)
+        self.created_at.pop(conn, None)
+        self.returned_at.pop(conn, None)
+        self.validated_at.pop(conn, None)
+
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+        self.wake_waiter()
+
+    def yield_obj(self, conn):
+        """
+            Puts a connection back in the pool, or hands it directly to the longest waiting coroutine.
+        """
+        if conn not in self.in_use:
+            raise ObjPoolOwnershipError()
+
+        if conn.closed or conn.isexecuting() or self.is_expired(conn):
+            self.discard_obj(conn)
+            return
+
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            # An open or failed transaction would leak into the next borrower, so roll it back first.
+            # The connection stays in in_use until the rollback finishes.
+            try:
+                task = asyncio.get_running_loop().create_task(self.rollback_obj(conn))
+            except RuntimeError:
+                self.discard_obj(conn)
+                return
+
+            self.rollbacks.add(task)
+            task.add_done_callback(self.rollbacks.discard)
+            return
+
+        self.release(conn)
+
+    async def rollback_obj(self, conn):
+        try:
+            await execute(conn, "ROLLBACK")
+        except psycopg2.Error:
+            self.discard_obj(conn)
+            return
+
+        self.release(conn)
+
+    def release(self, conn):
+        if conn is None:
+            self.wake_waiter()
+            return
+
+        # The connection stays in in_use while it is handed over, so it is never counted as free capacity
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(conn)
+                return
+
+        self.in_use.remove(conn)
+        self.returned_at[conn] = time.time()
+        self.ready.append(conn)
+
+    def wake_waiter(self):
+        """
+            Tells the longest waiting coroutine that there is capacity to create a connection.
+        """
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def close(self):
+        """
+            Closes all ready connections.
+        """
+        for conn in list(self.ready):
+            self.discard_obj(conn)
@@ -8,9 +8,14 @@ try:
 except ImportError:
     pass
 
+import binascii
 import collections
 import io
+import json
+import re
 import threading
+import time
+import weakref
 
 import psycopg2, psycopg2.extras, psycopg2.pool
 from wizzat.sqlhelper import *
@@ -18,22 +23,33 @@ from wizzat.util import set_defaults
 
 __all__ = [
     'ConnMgr',
+    'CopyRowStream',
     'PgIntegrityError',
     'PgOperationalError',
     'PgProgrammingError',
+    'PreparedSQL',
+    'QueryStats',
+    'StatementCache',
     'analyze',
     'copy_from',
     'copy_from_rows',
     'currval',
     'drop_table',
     'execute',
+    'execute_many',
+    'execute_statements',
+    'execute_values',
     'fetch_one',
     'fetch_results',
     'iter_results',
     'nextval',
+    'prepare',
     'relation_info',
+    'set_slow_query_threshold',
     'set_sql_log_func',
+    'sql_bind_params_from_params',
     'sql_where_from_params',
+    'statement_cache',
     'table_columns',
     'table_exists',
     'vacuum',
@@ -54,19 +70,112 @@ def copy_from(conn, fp, table_name, columns = None):
     fp.seek(0)
     conn.cursor().copy_from(fp, table_name, columns = columns)
 
-def copy_from_rows(conn, table_name, columns, rows):
+def copy_from_rows(conn, table_name, columns, rows, format = 'text', buffer_size = 65536):
     """
-    Creates a file object containing the tab separated rows.
+    Streams rows (iterables of python values) into the table with COPY ... FROM STDIN.
+    Rows are encoded lazily in buffer_size chunks, so memory use does not grow with the number of rows.
+    None becomes NULL, and dicts/lists are serialized as json.  Returns the number of rows copied.
 
     This method requires postgresql
     """
-    fp = io.StringIO()
-    for row in rows:
-        fp.write('\t'.join(row))
-        fp.write('\n')
+    sql = "COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT {format})".format(
+        table_name = table_name,
+        columns    = ', '.join(columns),
+        format     = format,
+    )
+
+    fp = CopyRowStream(rows, format = format)
+    cur = conn.cursor()
+    try:
+        cur.copy_expert(sql, fp, size = buffer_size)
+        return cur.rowcount
+    finally:
+        cur.close()
+
+class CopyRowStream(object):
+    """
+    A read only file-like object which encodes rows for COPY ... FROM STDIN on demand.
+    Supports the text (default) and csv COPY formats.
+    """
+    text_escapes = {
+        ord('\\') : '\\\\',
+        ord('\t') : '\\t',
+        ord('\n') : '\\n',
+        ord('\r') : '\\r',
+    }
+
+    def __init__(self, rows, format = 'text'):
+        if format == 'text':
+            encode_row = self.encode_text_row
+        elif format == 'csv':
+            encode_row = self.encode_csv_row
+        else:
+            raise ValueError("Unsupported COPY format: {}".format(format))
+
+        self.lines  = (encode_row(row) for row in rows)
+        self.buffer = ''
+
+    def read(self, size = -1):
+        pieces = [ self.buffer ]
+        length = len(self.buffer)
+        for line in self.lines:
+            pieces.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
 
-    copy_from(conn, fp, table_name, columns = columns)
-    del fp
+        data = ''.join(pieces)
+        if size < 0:
+            self.buffer = ''
+            return data
+
+        self.buffer = data[size:]
+        return data[:size]
+
+    @classmethod
+    def format_value(cls, value):
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        elif isinstance(value, (list, tuple)):
+            return cls.format_array(value)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            return '\\x' + binascii.hexlify(bytes(value)).decode('ascii')
+        elif isinstance(value, dict):
+            return json.dumps(value)
+        else:
+            return str(value)
+
+    @classmethod
+    def format_array(cls, value):
+        """
+        Encodes a list as a Postgres array literal, like psycopg2 does for lists bound to INTEGER[] or TEXT[].
+        Nested lists become multidimensional arrays, and every other element is quoted.
+        """
+        elements = []
+        for element in value:
+            if element is None:
+                elements.append('NULL')
+            elif isinstance(element, (list, tuple)):
+                elements.append(cls.format_array(element))
+            else:
+                elements.append('"{}"'.format(cls.format_value(element).replace('\\', '\\\\').replace('"', '\\"')))
+
+        return '{' + ','.join(elements) + '}'
+
+    @classmethod
+    def encode_text_row(cls, row):
+        return '\t'.join([
+            '\\N' if value is None else cls.format_value(value).translate(cls.text_escapes)
+            for value in row
+        ]) + '\n'
+
+    @classmethod
+    def encode_csv_row(cls, row):
+        # Quoting every value distinguishes empty strings from NULL, which is written as nothing
+        return ','.join([
+            '' if value is None else '"{}"'.format(cls.format_value(value).replace('"', '""'))
+            for value in row
+        ]) + '\n'
 
 def relation_info(conn, relname, relkind = 'r'):
     """
@@ -162,31 +271,168 @@ def nextval(conn, sequence):
     """
     return fetch_results(conn, "select nextval(%(sequence)s)", sequence = sequence)[0][0]
 
+class PreparedSQL(str):
+    """
+    The EXECUTE statement for a prepared statement.  Statement names are numbered per connection,
+    so QueryStats records it under source_sql, the SQL it was prepared from.
+    """
+    def __new__(cls, execute_sql, source_sql):
+        obj = super(PreparedSQL, cls).__new__(cls, execute_sql)
+        obj.source_sql = source_sql
+        return obj
+
+class StatementCache(object):
+    """
+    The PREPAREd statements for a single connection, keyed by SQL text.
+    Since the generated SQL is a function of the table, operation and field set, so is the key.
+    Hit and miss counts are kept in stats.
+    """
+    max_statements = 1000
+    bind_re = re.compile(r'%%|%\((\w+)\)s')
+
+    def __init__(self):
+        self.statements = {}
+        self.stats = collections.Counter()
+
+    def prepare(self, conn, sql):
+        try:
+            execute_sql = self.statements[sql]
+            self.stats['hit'] += 1
+            return execute_sql
+        except KeyError:
+            self.stats['miss'] += 1
+
+        if len(self.statements) >= self.max_statements:
+            return sql
+
+        bind_names = []
+        def positional(match):
+            if not match.group(1):
+                return match.group(0)
+            if match.group(1) not in bind_names:
+                bind_names.append(match.group(1))
+            return '${}'.format(bind_names.index(match.group(1)) + 1)
+
+        stmt_name = 'wizzat_stmt_{}'.format(len(self.statements))
+        execute(conn, "PREPARE {} AS {}".format(stmt_name, self.bind_re.sub(positional, sql)))
+
+        execute_sql = self.statements[sql] = PreparedSQL("EXECUTE {}{}".format(
+            stmt_name,
+            " ({})".format(', '.join([ '%({})s'.format(x) for x in bind_names ])) if bind_names else '',
+        ), sql)
+
+        return execute_sql
+
+    def clear(self, conn):
+        execute(conn, "DEALLOCATE ALL")
+        self.statements.clear()
+
+_statement_caches = weakref.WeakKeyDictionary()
+def statement_cache(conn):
+    """
+    Returns the StatementCache for the connection.
+    """
+    try:
+        return _statement_caches[conn]
+    except KeyError:
+        cache = _statement_caches[conn] = StatementCache()
+        return cache
+
+def prepare(conn, sql, **bind_params):
+    """
+    Returns SQL which EXECUTEs a prepared statement for sql, PREPAREing it on this connection the first time it is seen.
+    The result is run with the same bind params through execute, fetch_results, etc.
+
+    Tuple bind params expand into a variable length list and cannot be prepared, so sql is returned unchanged.
+    Prepared statements are not transactional, but are invalidated by DISCARD ALL and reconnection.
+
+    This method requires postgresql
+    """
+    if any(isinstance(x, tuple) for x in bind_params.values()):
+        return sql
+
+    return statement_cache(conn).prepare(conn, sql)
+
+_where_patterns = {
+    'null'    : "{0} is null",
+    'list'    : "{0} in (%({1})s)",
+    'any'     : "{0} = ANY(%({1})s)",
+    'in'      : "{0} in %({1})s",
+    'eq'      : "{0} = %({1})s",
+    'gt'      : "{0} > %({1})s",
+    'gte'     : "{0} >= %({1})s",
+    'lt'      : "{0} < %({1})s",
+    'lte'     : "{0} <= %({1})s",
+    'between' : "{0} between %({1}_0)s and %({1}_1)s",
+}
+
+_where_operators = frozenset([ 'any', 'gt', 'gte', 'lt', 'lte', 'between' ])
+
+def _where_column(key):
+    column, _, kind = key.rpartition('__')
+    return column if column and kind in _where_operators else key
+
+def _where_kind(key, value):
+    column = _where_column(key)
+    if column != key:
+        kind = key[len(column) + 2:]
+        if kind == 'any' and not value:
+            return 'empty'
+        return kind
+    elif value is None:
+        return 'null'
+    elif isinstance(value, (tuple, list)):
+        if not value:
+            return 'empty'
+        return 'list' if isinstance(value, list) else 'in'
+    else:
+        return 'eq'
+
+_where_cache = {}
 def sql_where_from_params(**kwargs):
     """
     Utility function for converting a param dictionary into a where clause
-    Lists and tuples become in clauses
+    None becomes is null, lists are compared to array columns, and tuples become in clauses.
+    Keys ending in __any, __gt, __gte, __lt, __lte or __between compare the column instead.
+
+    __any takes a list, which is bound as a single array (col = ANY(array)), so the SQL (and any
+    prepared plan) is the same for every length.  Prefer it to tuples for large lists.
+
+    __between takes a (low, high) pair, and its bind params must be expanded with sql_bind_params_from_params.
+    Clauses are cached by the keys and kinds of their values.
     """
+    signature = tuple(sorted([ (key, _where_kind(key, value)) for key, value in iteritems(kwargs) ]))
+    try:
+        return _where_cache[signature]
+    except KeyError:
+        pass
+
     clauses = [ 'true' ]
-    type_handler = collections.OrderedDict()
-    type_handler[type(None)] = "{0} is null"
-    type_handler[list]       = "{0} in (%({0})s)"
-    type_handler[tuple]      = "{0} in %({0})s"
-
-    for key, value in sorted(iteritems(kwargs)):
-        if isinstance(value, (tuple, list)):
-            if not value:
-                clauses = [ 'true = false' ]
-                break
+    for key, kind in signature:
+        if kind == 'empty':
+            clauses = [ 'true = false' ]
+            break
 
-        for proposed_type, pattern in iteritems(type_handler):
-            if isinstance(value, proposed_type):
-                clauses.append(pattern.format(key))
-                break
+        clauses.append(_where_patterns[kind].format(_where_column(key), key))
+
+    if len(_where_cache) >= 1000:
+        _where_cache.clear()
+    clause = _where_cache[signature] = ' and '.join(clauses)
+
+    return clause
+
+def sql_bind_params_from_params(**kwargs):
+    """
+    Returns the bind params for sql_where_from_params(**kwargs), with __between pairs split into two params.
+    """
+    bind_params = {}
+    for key, value in iteritems(kwargs):
+        if key.endswith('__between'):
+            bind_params[key + '_0'], bind_params[key + '_1'] = value
         else:
-            clauses.append("{0} = %({0})s".format(key))
+            bind_params[key] = value
 
-    return ' and '.join(clauses)
+    return bind_params
 
 def pg_conn(conn_info):
     conn_info = set_defaults(conn_info,
@@ -205,12 +451,44 @@ def pg_conn(conn_info):
 import wizzat.objpool
 
 class ConnMgr(wizzat.objpool.ObjPool):
+    """
+    A pool of psycopg2 connections.  Accepts the ObjPool parameters, and:
+        validate_interval: Seconds between SELECT 1 health checks of a connection before it is handed out.
+                           Closed connections are always replaced.  None checks only for closed connections.
+    """
     def __init__(self, conn_info, **kwargs):
-        self.conn_info = conn_info
+        self.conn_info         = conn_info
+        self.autocommit        = conn_info.get('autocommit', False)
+        self.validate_interval = kwargs.pop('validate_interval', 30)
+        self.validated_at      = {}
         super().__init__(**kwargs)
 
     def new_func(self):
-        return pg_conn(self.conn_info)
+        conn = pg_conn(self.conn_info)
+        self.validated_at[conn] = time.time()
+        return conn
 
     def put_func(self, conn):
         conn.rollback()
+        conn.autocommit = self.autocommit
+
+    def check_func(self, conn):
+        if conn.closed:
+            return False
+
+        now = time.time()
+        if self.validate_interval is None or now - self.validated_at.get(conn, 0) < self.validate_interval:
+            return True
+
+        try:
+            execute(conn, "SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+
+        self.validated_at[conn] = now
+        return True
+
+    def close_func(self, conn):
+        self.validated_at.pop(conn, None)
+        conn.close()
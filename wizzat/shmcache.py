@@ -0,0 +1,287 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from builtins import *
+
+import contextlib
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+import types
+
+__all__ = [
+    'SharedMemoryCache',
+]
+
+class SharedMemoryCache(object):
+    """
+        A dict-like cache of pickled values in a memory mapped file, shared by every process
+        on the host which opens the same name (eg, prefork web workers).  Used by memoize(backend='shm').
+
+        The file is a fixed size hash table of slot_size byte slots.  Each key may live in any of
+        the probe_slots slots after its hash, and when they are all full one is evicted in CLOCK
+        (second chance) order.  Values which don't fit in a slot are not cached.
+
+        Access is serialized by a thread lock and an flock on the file.  Keys and values are pickled,
+        so values are copies rather than shared objects, and functions in keys are identified by name.
+
+        Arguments:
+            name        - identifies the cache.  The file is created in /dev/shm when it exists.
+            max_bytes   - size of the table (default 64MB)
+            max_size    - number of slots, which sets slot_size to max_bytes / max_size (default 4kb slots)
+            until       - func returning the expiration time of a new value
+            ignore_nulls           - don't store None values
+            stale_while_revalidate - seconds after expiration that a value is still returned (see is_stale)
+    """
+    magic       = b'WZMEMO01'
+    header      = struct.Struct(str('<8sII'))
+    slot_header = struct.Struct(str('<QBdII'))
+    probe_slots = 8
+
+    USED       = 1
+    REFERENCED = 2
+
+    def __init__(self, name, max_bytes = 0, max_size = 0, until = None, ignore_nulls = False, stale_while_revalidate = 0):
+        max_bytes = max_bytes or 64 * 1024 * 1024
+        if max_size:
+            self.slot_size = max_bytes // max_size
+            self.num_slots = max_size
+        else:
+            self.slot_size = 4096
+            self.num_slots = max(1, max_bytes // self.slot_size)
+
+        if self.slot_size <= self.slot_header.size:
+            raise ValueError("Slots of {} bytes are too small".format(self.slot_size))
+
+        self.name         = name
+        self.expire_func  = until
+        self.ignore_nulls = ignore_nulls
+        self.filename     = os.path.join(self.shm_dir(), 'wizzat_memoize_{}'.format(name))
+        self.total_size   = self.header.size + self.num_slots * self.slot_size
+        self.stale_while_revalidate = stale_while_revalidate
+
+        self.pid  = os.getpid()
+        self.lock = threading.Lock()
+        self.fd   = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o600)
+        with self.locked():
+            if os.fstat(self.fd).st_size == 0:
+                os.ftruncate(self.fd, self.total_size)
+                os.write(self.fd, self.header.pack(self.magic, self.slot_size, self.num_slots))
+
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            header = os.read(self.fd, self.header.size)
+
+        if header != self.header.pack(self.magic, self.slot_size, self.num_slots):
+            os.close(self.fd)
+            raise ValueError("{} exists with a different size".format(self.filename))
+
+        self.mmap = mmap.mmap(self.fd, self.total_size)
+
+    @staticmethod
+    def shm_dir():
+        return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+    @contextlib.contextmanager
+    def locked(self):
+        # flock doesn't exclude processes sharing an inherited descriptor, so reopen the file after a fork
+        if self.pid != os.getpid():
+            os.close(self.fd)
+            self.pid  = os.getpid()
+            self.lock = threading.Lock()
+            self.fd   = os.open(self.filename, os.O_RDWR)
+
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    @classmethod
+    def key_bytes(cls, key):
+        # memoize keys start with the function, which is identified by name so every process agrees
+        if isinstance(key, tuple):
+            key = tuple(cls.func_name(x) if isinstance(x, types.FunctionType) else x for x in key)
+
+        key_bytes = pickle.dumps(key, 2)
+        return key_bytes, struct.unpack(str('<Q'), hashlib.md5(key_bytes).digest()[:8])[0]
+
+    @staticmethod
+    def func_name(func):
+        return '{}.{}'.format(func.__module__, getattr(func, '__qualname__', func.__name__))
+
+    def slot_offsets(self, key_hash):
+        for idx in range(self.probe_slots):
+            yield self.header.size + ((key_hash + idx) % self.num_slots) * self.slot_size
+
+    def find_slot(self, key_bytes, key_hash):
+        for offset in self.slot_offsets(key_hash):
+            slot_hash, flags, expiration, key_len, value_len = self.slot_header.unpack_from(self.mmap, offset)
+            if flags & self.USED and slot_hash == key_hash:
+                start = offset + self.slot_header.size
+                if self.mmap[start:start + key_len] == key_bytes:
+                    return offset, flags, expiration, start + key_len, value_len
+
+        return None
+
+    def set_flags(self, offset, flags):
+        struct.pack_into(str('<B'), self.mmap, offset + 8, flags)
+
+    def __getitem__(self, key):
+        key_bytes, key_hash = self.key_bytes(key)
+        with self.locked():
+            slot = self.find_slot(key_bytes, key_hash)
+            if slot is None:
+                raise KeyError(key)
+
+            offset, flags, expiration, value_start, value_len = slot
+            if expiration and expiration + self.stale_while_revalidate < time.time():
+                self.set_flags(offset, 0)
+                raise KeyError(key)
+
+            self.set_flags(offset, flags | self.REFERENCED)
+            value_bytes = self.mmap[value_start:value_start + value_len]
+
+        return pickle.loads(value_bytes)
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def put(self, key, value, expiration = 0):
+        """
+            Stores the value with the given expiration, or a new one from until when it is 0.
+        """
+        if value is None and self.ignore_nulls:
+            return
+
+        key_bytes, key_hash = self.key_bytes(key)
+        value_bytes = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if not expiration and self.expire_func:
+            expiration = self.expire_func()
+
+        if self.slot_header.size + len(key_bytes) + len(value_bytes) > self.slot_size:
+            self.pop(key, None)
+            return
+
+        with self.locked():
+            slot = self.find_slot(key_bytes, key_hash)
+            offset = slot[0] if slot else self.free_slot(key_hash)
+
+            self.slot_header.pack_into(self.mmap, offset, key_hash, self.USED, expiration, len(key_bytes), len(value_bytes))
+            start = offset + self.slot_header.size
+            self.mmap[start:start + len(key_bytes) + len(value_bytes)] = key_bytes + value_bytes
+
+    def free_slot(self, key_hash):
+        """
+            Returns an empty or expired slot for the key, or evicts the first slot that hasn't been
+            referenced since the last pass (clearing referenced bits on the way).
+        """
+        now = time.time()
+        offsets = list(self.slot_offsets(key_hash))
+        for offset in offsets:
+            _, flags, expiration, _, _ = self.slot_header.unpack_from(self.mmap, offset)
+            if not flags & self.USED or (expiration and expiration + self.stale_while_revalidate < now):
+                return offset
+
+        for offset in offsets + offsets[:1]:
+            flags = self.slot_header.unpack_from(self.mmap, offset)[1]
+            if not flags & self.REFERENCED:
+                return offset
+            self.set_flags(offset, flags & ~self.REFERENCED)
+
+    def __delitem__(self, key):
+        key_bytes, key_hash = self.key_bytes(key)
+        with self.locked():
+            slot = self.find_slot(key_bytes, key_hash)
+            if slot is None:
+                raise KeyError(key)
+            self.set_flags(slot[0], 0)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def __len__(self):
+        with self.locked():
+            return len(self.used_slots())
+
+    def used_slots(self):
+        slots = []
+        for idx in range(self.num_slots):
+            offset = self.header.size + idx * self.slot_size
+            header = self.slot_header.unpack_from(self.mmap, offset)
+            if header[1] & self.USED:
+                slots.append((offset, header))
+
+        return slots
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+            del self[key]
+            return value
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+
+    def is_stale(self, key):
+        """
+            Returns whether the key's value has expired, but is still returned for stale_while_revalidate.
+        """
+        key_bytes, key_hash = self.key_bytes(key)
+        with self.locked():
+            slot = self.find_slot(key_bytes, key_hash)
+            if slot is None:
+                raise KeyError(key)
+
+        return bool(slot[2]) and slot[2] < time.time()
+
+    def expire(self, now = None):
+        """
+            Frees expired slots, and returns how many were freed.
+        """
+        now = now or time.time()
+        with self.locked():
+            expired = [ offset for offset, header in self.used_slots() if header[2] and header[2] + self.stale_while_revalidate < now ]
+            for offset in expired:
+                self.set_flags(offset, 0)
+
+        return len(expired)
+
+    def clear(self):
+        """
+            Empties the cache for every process sharing it.
+        """
+        with self.locked():
+            for idx in range(self.num_slots):
+                self.set_flags(self.header.size + idx * self.slot_size, 0)
+
+    @property
+    def current_size(self):
+        with self.locked():
+            return sum(self.slot_header.size + header[3] + header[4] for _, header in self.used_slots())
+
+    def close(self):
+        self.mmap.close()
+        os.close(self.fd)
+
+    def unlink(self):
+        """
+            Closes the cache and removes its file.  Processes which already have it open keep using their copy.
+        """
+        self.close()
+        os.unlink(self.filename)
@@ -1,9 +1,24 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 from builtins import *
+from future.utils import iteritems
+
+import itertools
+import logging
+import re
+import threading
+import time
+
+import wizzat.textutil
+from wizzat.mathutil import Percentile
 
 __all__ = [
+    'QueryStats',
+    'set_slow_query_threshold',
     'set_sql_log_func',
     'execute',
+    'execute_many',
+    'execute_statements',
+    'execute_values',
     'iter_results',
     'fetch_results',
     'fetch_one',
@@ -27,70 +42,357 @@ def set_sql_log_func(func):
     global _log_func
     _log_func = func
 
+def set_slow_query_threshold(seconds, log_func = None):
+    """
+    Logs queries which take longer than seconds (None to disable).  The default log
+    function logs a warning with the duration, row count and mogrified SQL.  A custom
+    log function should look something like:
+
+    def log_func(cur, sql, bind_params, elapsed, rows):
+        pass
+    """
+    QueryStats.slow_threshold = seconds
+    QueryStats.slow_log_func  = log_func
+
+def _log_slow_query(cur, sql, bind_params, elapsed, rows):
+    try:
+        query = cur.mogrify(sql, bind_params)
+    except Exception:
+        query = "{}\n{!r}".format(sql, bind_params)
+
+    logging.warning("Slow query (%.3fs, %s rows)\n%s", elapsed, rows, query)
+
+
+class QueryStats(object):
+    """
+    Shared state query statistics container.  Every query run through sqlhelper
+    records its latency (in microseconds), row count and errors by statement shape.
+    The shape is the SQL with whitespace collapsed, numbered bind params
+    (eg, %(id_12)s) folded together and multi-row VALUES lists truncated
+    to their first row, so generated queries share an entry.  Prepared statements
+    are recorded and logged under the SQL they were prepared from.
+    """
+    stats          = {}
+    shapes         = {}
+    max_shapes     = 1000
+    slow_threshold = None
+    slow_log_func  = None
+    lock           = threading.Lock()
+
+    @classmethod
+    def clear(cls):
+        """
+            Clear all query statistics.
+        """
+        with cls.lock:
+            cls.stats.clear()
+            cls.shapes.clear()
+
+    @classmethod
+    def shape(cls, sql):
+        shape = cls.shapes.get(sql)
+        if shape is None:
+            shape = ' '.join(sql.split())
+            shape = re.sub(r'%\((\w+?)_\d+\)s', r'%(\1_N)s', shape)
+            shape = re.sub(r'(\((?:[^()]|\(\w*\))*\))(, ?\((?:[^()]|\(\w*\))*\))+', r'\1, ...', shape)
+
+            if len(cls.shapes) >= cls.max_shapes:
+                cls.shapes.clear()
+            cls.shapes[sql] = shape
+
+        return shape
+
+    @classmethod
+    def record(cls, cur, sql, bind_params, elapsed, rows, error = False):
+        sql = getattr(sql, 'source_sql', sql)
+        shape = cls.shape(sql)
+        with cls.lock:
+            stats = cls.stats.get(shape)
+            if stats is None:
+                if len(cls.stats) >= cls.max_shapes:
+                    shape = '<other>'
+                stats = cls.stats.setdefault(shape, {
+                    'calls'      : 0,
+                    'errors'     : 0,
+                    'rows'       : 0,
+                    'total_us'   : 0,
+                    'latency_us' : Percentile(),
+                })
+
+            elapsed_us = max(0, int(elapsed * 1000000))
+            stats['calls']    += 1
+            stats['errors']   += bool(error)
+            stats['rows']     += rows
+            stats['total_us'] += elapsed_us
+            stats['latency_us'].add_value(elapsed_us)
+
+        if cls.slow_threshold is not None and elapsed >= cls.slow_threshold:
+            (cls.slow_log_func or _log_slow_query)(cur, sql, bind_params, elapsed, rows)
+
+    @classmethod
+    def format_stats(cls, max_width = 80):
+        """
+            Calculates the statistics for all queries.
+            Returns a text table formatted string containing:
+            - Query shape (truncated to max_width)
+            - Calls
+            - Errors
+            - Rows
+            - Total, median, 98th percentile and max latency in ms
+        """
+        def ms(us):
+            return "{:.3f}".format((us or 0) / 1000.0)
+
+        rows = []
+        with cls.lock:
+            for shape, stats in sorted(iteritems(cls.stats), key=lambda x: x[1]['total_us']):
+                rows.append([
+                    shape[:max_width],                          # 'Query',
+                    stats['calls'],                             # 'Calls',
+                    stats['errors'],                            # 'Errors',
+                    stats['rows'],                              # 'Rows',
+                    ms(stats['total_us']),                      # 'Total ms',
+                    ms(stats['latency_us'].percentile(0.5)),    # 'Median ms',
+                    ms(stats['latency_us'].percentile(0.98)),   # '98% ms',
+                    ms(stats['latency_us'].percentile(1.0)),    # 'Max ms',
+                ])
+
+        table = wizzat.textutil.text_table([
+            'Query',
+            'Calls',
+            'Errors',
+            'Rows',
+            'Total ms',
+            'Median ms',
+            '98% ms',
+            'Max ms',
+        ], rows)
+
+        return "Query Stats By Shape\n\n" + table
+
+def _execute(cur, sql, bind_params):
+    global _log_func
+    if _log_func:
+        _log_func(cur, sql, bind_params)
+
+    start = time.perf_counter()
+    try:
+        cur.execute(sql, bind_params)
+    except Exception:
+        QueryStats.record(cur, sql, bind_params, time.perf_counter() - start, 0, error = True)
+        raise
+
+    return start
+
 def execute(conn, sql, **bind_params):
     """
     Executes a SQL command against the connection with optional bind params.
     """
+    try:
+        cur = conn.cursor()
+        start = _execute(cur, sql, bind_params)
+        QueryStats.record(cur, sql, bind_params, time.perf_counter() - start, max(cur.rowcount, 0))
+    finally:
+        cur.close()
+
+def _pages(iterable, page_size):
+    iterator = iter(iterable)
+    while True:
+        page = list(itertools.islice(iterator, page_size))
+        if not page:
+            return
+        yield page
+
+def execute_many(conn, sql, param_iter, page_size = 100):
+    """
+    Executes a SQL command once for each set of bind params in param_iter.
+
+    Cursors with mogrify (psycopg2) send page_size statements per round trip as
+    a single multi-statement query.  Other cursors fall back to executemany.
+    Only the first statement of each page is passed to the log function, and
+    each page is recorded in QueryStats as a single call.
+    """
     global _log_func
 
     try:
         cur = conn.cursor()
+        for page in _pages(param_iter, page_size):
+            if _log_func:
+                _log_func(cur, sql, page[0])
 
-        if _log_func:
-            _log_func(cur, sql, bind_params)
+            start = time.perf_counter()
+            try:
+                if hasattr(cur, 'mogrify'):
+                    cur.execute(b';'.join([ cur.mogrify(sql, bind_params) for bind_params in page ]))
+                else:
+                    cur.executemany(sql, page)
+            except Exception:
+                QueryStats.record(cur, sql, page[0], time.perf_counter() - start, 0, error = True)
+                raise
 
-        cur.execute(sql, bind_params)
+            QueryStats.record(cur, sql, page[0], time.perf_counter() - start, len(page))
     finally:
         cur.close()
 
-def iter_results(conn, sql, **bind_params):
+def execute_statements(conn, statements, page_size = 100):
     """
-    Delays fetching the SQL results into memory until iteration
-    Keeps memory footprint low, but means you cannot run another query
-    on this connection.
+    Executes (sql, bind_params) pairs page_size per round trip, and returns the number of rows
+    each statement returned.  Requires a cursor with mogrify.
+
+    Each statement must be an INSERT, UPDATE or DELETE with a RETURNING clause.  A page runs as
+    one statement of data modifying CTEs, so its statements see the same snapshot and must not
+    modify the same row.  Only the first statement of each page is passed to the log function,
+    and each page is recorded in QueryStats as a single call.
     """
     global _log_func
+
+    counts = []
     try:
         cur = conn.cursor()
-        if _log_func:
-            _log_func(cur, sql, bind_params)
+        for page in _pages(statements, page_size):
+            first_sql, first_params = page[0]
+            if _log_func:
+                _log_func(cur, first_sql, first_params)
 
-        cur.execute(sql, bind_params)
-        for row in cur:
-            yield row
+            start = time.perf_counter()
+            try:
+                ctes = b', '.join([
+                    'stmt_{} AS ('.format(idx).encode('ascii') + cur.mogrify(sql, bind_params) + b')'
+                    for idx, (sql, bind_params) in enumerate(page)
+                ])
+                select = 'SELECT ARRAY[{}]'.format(', '.join([
+                    '(SELECT count(*) FROM stmt_{})'.format(idx) for idx in range(len(page))
+                ]))
+                cur.execute(b'WITH ' + ctes + b' ' + select.encode('ascii'))
+                page_counts = cur.fetchone()[0]
+            except Exception:
+                QueryStats.record(cur, first_sql, first_params, time.perf_counter() - start, 0, error = True)
+                raise
+
+            QueryStats.record(cur, first_sql, first_params, time.perf_counter() - start, sum(page_counts))
+            counts.extend(page_counts)
     finally:
         cur.close()
 
-def fetch_results(conn, sql, **bind_params):
+    return counts
+
+def execute_values(conn, sql, rows, template = None, page_size = 100, fetch = False):
     """
-    Immediately fetches the SQL results into memory
-    Trades memory for the ability to immediately execute another query
+    Executes a SQL command containing a single %s placeholder, which is replaced by
+    a VALUES list of up to page_size rows per round trip.  Requires a cursor with mogrify.
+
+    template is the SQL for a single row, by default one %s per column.
+    fetch = True returns the concatenated results of each page (eg, for RETURNING).
+    Only the first row of each page is passed to the log function, and
+    each page is recorded in QueryStats as a single call.
+
+    Example:
+    execute_values(conn, "INSERT INTO foo (a, b) VALUES %s", [ (1, 'x'), (2, 'y') ])
     """
     global _log_func
+
+    # %% is an escaped %, so only a %s which isn't part of one is the placeholder
+    placeholders = [ x for x in re.finditer(r'%[%s]', sql) if x.group() == '%s' ]
+    if len(placeholders) != 1:
+        raise ValueError("execute_values requires exactly one %s placeholder, found {}".format(len(placeholders)))
+
+    prefix, suffix = sql[:placeholders[0].start()], sql[placeholders[0].end():]
+    results = []
     try:
         cur = conn.cursor()
-        if _log_func:
-            _log_func(cur, sql, bind_params)
+        # Formatting with no params unescapes %% the way the full statement would have been
+        sql_prefix, sql_suffix = [ cur.mogrify(x, ()) if x.strip() else b'' for x in (prefix, suffix) ]
+        for page in _pages(rows, page_size):
+            row_template = template or '({})'.format(', '.join([ '%s' ] * len(page[0])))
+            first_sql = prefix + row_template + suffix
+            if _log_func:
+                _log_func(cur, first_sql, page[0])
 
-        cur.execute(sql, bind_params)
-        return cur.fetchall()
+            start = time.perf_counter()
+            try:
+                values = b','.join([ cur.mogrify(row_template, row) for row in page ])
+                cur.execute(sql_prefix + values + sql_suffix)
+                if fetch:
+                    results.extend(cur.fetchall())
+            except Exception:
+                QueryStats.record(cur, first_sql, page[0], time.perf_counter() - start, 0, error = True)
+                raise
+
+            QueryStats.record(cur, first_sql, page[0], time.perf_counter() - start, len(page))
     finally:
         cur.close()
 
-def fetch_one(conn, sql, **bind_params):
+    if fetch:
+        return results
+
+_cursor_ids = itertools.count()
+def iter_results(conn, sql, server_side = False, itersize = 2000, **bind_params):
     """
-    Immediately fetches the SQL results into memory, and verifies that there is exactly one result
+    Yields the SQL results one row at a time.  You cannot run another query on
+    this connection until iteration finishes.
+
+    By default the driver still fetches the whole result set before the first row
+    is yielded.  server_side = True uses a named (server side) cursor instead, which
+    fetches itersize rows per round trip and keeps memory use constant for large scans.
+
+    The query's recorded latency excludes time spent by the caller between rows.
     """
-    global _log_func
-    try:
+    if server_side:
+        # Outside of a transaction the cursor must be WITH HOLD to survive the implicit commit
+        cur = conn.cursor('wizzat_cursor_{}'.format(next(_cursor_ids)), withhold = conn.autocommit)
+        cur.itersize = itersize
+    else:
         cur = conn.cursor()
-        if _log_func:
-            _log_func(cur, sql, bind_params)
 
-        cur.execute(sql, bind_params)
+    rows = None
+    try:
+        start = _execute(cur, sql, bind_params)
+        elapsed = time.perf_counter() - start
+        rows = 0
+        error = True
+
+        results = iter(cur)
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(results)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+
+            rows += 1
+            try:
+                yield row
+            except GeneratorExit:
+                # The caller stopped iterating early, which isn't a query error
+                error = False
+                raise
+
+        error = False
+    finally:
+        if rows is not None:
+            QueryStats.record(cur, sql, bind_params, elapsed, rows, error = error)
+        cur.close()
+
+def fetch_results(conn, sql, **bind_params):
+    """
+    Immediately fetches the SQL results into memory
+    Trades memory for the ability to immediately execute another query
+    """
+    try:
+        cur = conn.cursor()
+        start = _execute(cur, sql, bind_params)
         results = cur.fetchall()
-        assert len(results) == 1
-        return results[0]
+        QueryStats.record(cur, sql, bind_params, time.perf_counter() - start, len(results))
+        return results
     finally:
         cur.close()
 
+def fetch_one(conn, sql, **bind_params):
+    """
+    Immediately fetches the SQL results into memory, and verifies that there is exactly one result
+    """
+    results = fetch_results(conn, sql, **bind_params)
+    assert len(results) == 1
+    return results[0]